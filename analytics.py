@@ -1,11 +1,39 @@
 # analytics.py
+import atexit
+import logging
+import queue
+import struct
 import time
 import csv
 import os
-from threading import Lock
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 LOG_FILE = "network_stats.csv"
-_LOCK = Lock()
+_LOCK = threading.Lock()
+
+# Rows go through a bounded queue to one background writer thread, which
+# appends them in batches; callers never wait on the file
+QUEUE_SIZE = int(os.environ.get("ANALYTICS_QUEUE", 10000))
+BATCH_SIZE = int(os.environ.get("ANALYTICS_BATCH", 256))
+FLUSH_INTERVAL = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", 1.0))
+
+# "csv" (network_stats.csv), "binary" (time-partitioned segments) or "both"
+SINK = os.environ.get("ANALYTICS_SINK", "csv")
+SEGMENT_DIR = os.environ.get("ANALYTICS_DIR", "network_stats")
+# A new segment is started for every partition of this many seconds...
+PARTITION_SECONDS = int(os.environ.get("ANALYTICS_PARTITION", 3600))
+# ...and whenever the current one reaches this size
+SEGMENT_MAX_BYTES = int(os.environ.get("ANALYTICS_SEGMENT_BYTES", 64 * 1024 * 1024))
+
+_queue = queue.Queue(maxsize=QUEUE_SIZE)
+_writer = None
+_counters = {"queued": 0, "written": 0, "dropped": 0, "batches": 0, "errors": 0}
 
 _FIELDNAMES = [
     "timestamp",
@@ -23,6 +51,30 @@ _FIELDNAMES = [
 ]
 
 
+# Segment layout: SEGMENT_MAGIC, then fixed-width little-endian records.
+# Segments are named "<partition start, epoch seconds>-<sequence>.seg".
+SEGMENT_MAGIC = b"NSTATS\x00\x01"
+_RECORD = struct.Struct("<dddqdd8s16s16s8s128s128s")
+_NUMERIC = ["epoch", "start_clock", "end_clock", "bytes", "duration_sec", "data_rate_MBps"]
+_TEXT = ["role", "operation", "command", "status", "file_name", "note"]
+
+_segment = {"file": None, "partition": None, "size": 0}
+
+# Set in each process of a multi-process server; rows get a "worker=<n>" note
+_worker = None
+
+
+def set_worker(worker):
+    global _worker
+    _worker = worker
+
+
+def _tag(note: str) -> str:
+    if _worker is None:
+        return note
+    return f"{note};worker={_worker}" if note else f"worker={_worker}"
+
+
 def now():
     """
     High-resolution timer for measuring durations.
@@ -31,16 +83,217 @@ def now():
     return time.perf_counter()
 
 
+def _append_csv(rows):
+    """
+    Append a batch of rows to the CSV with one open(). The file is locked
+    meanwhile, so server processes sharing it neither interleave their
+    batches nor both write the header.
+    """
+    with open(LOG_FILE, "a", newline="") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        writer = csv.DictWriter(f, fieldnames=_FIELDNAMES, extrasaction="ignore")
+        if f.seek(0, os.SEEK_END) == 0:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def _pack(row: dict) -> bytes:
+    text = [str(row[name] or "").encode("utf-8")[:size] for name, size in zip(_TEXT, (8, 16, 16, 8, 128, 128))]
+    return _RECORD.pack(
+        row["epoch"], row["start_clock"], row["end_clock"], int(row["bytes"] or 0),
+        row["duration_sec"], row["data_rate_MBps"], *text,
+    )
+
+
+def _open_segment(partition: int):
+    os.makedirs(SEGMENT_DIR, exist_ok=True)
+    prefix = f"{partition}-"
+    seqs = [int(n[len(prefix):-4]) for n in os.listdir(SEGMENT_DIR) if n.startswith(prefix) and n.endswith(".seg")]
+    seq = max(seqs, default=-1) + 1
+    # Other processes may be opening segments too; never append to theirs
+    while True:
+        try:
+            f = open(os.path.join(SEGMENT_DIR, f"{prefix}{seq:04d}.seg"), "xb")
+            break
+        except FileExistsError:
+            seq += 1
+    f.write(SEGMENT_MAGIC)
+    _segment.update(file=f, partition=partition, size=len(SEGMENT_MAGIC))
+
+
+def _append_segments(rows):
+    """Append rows to the current segment, rotating on partition or size."""
+    for row in rows:
+        partition = int(row["epoch"]) // PARTITION_SECONDS * PARTITION_SECONDS
+        if (_segment["file"] is None or partition != _segment["partition"]
+                or _segment["size"] + _RECORD.size > SEGMENT_MAX_BYTES):
+            if _segment["file"] is not None:
+                _segment["file"].close()
+            _open_segment(partition)
+        _segment["file"].write(_pack(row))
+        _segment["size"] += _RECORD.size
+    _segment["file"].flush()
+
+
+def _append_rows(rows):
+    if SINK in ("csv", "both"):
+        _append_csv(rows)
+    if SINK in ("binary", "both"):
+        _append_segments(rows)
+
+
+def read_segment(path: str, first: int = 0, start: float = None, end: float = None):
+    """
+    Yield the rows of one segment file from record number `first` on,
+    limited to epoch times between `start` and `end` (either may be None).
+    "timestamp" is a datetime (local time).
+    """
+    with open(path, "rb") as f:
+        if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            return
+        f.seek(len(SEGMENT_MAGIC) + first * _RECORD.size)
+        data = f.read()
+    # A crash (or a write in progress) can leave half a record at the end; it is skipped
+    usable = len(data) - len(data) % _RECORD.size
+    for values in _RECORD.iter_unpack(memoryview(data)[:usable]):
+        row = dict(zip(_NUMERIC, values[:6]))
+        if start is not None and row["epoch"] < start:
+            continue
+        if end is not None and row["epoch"] > end:
+            continue
+        for field, raw in zip(_TEXT, values[6:]):
+            row[field] = raw.rstrip(b"\0").decode("utf-8", "ignore")
+        row["timestamp"] = datetime.fromtimestamp(row["epoch"])
+        yield row
+
+
+def segment_records(path: str) -> int:
+    """Number of complete records in a segment file."""
+    return max(os.path.getsize(path) - len(SEGMENT_MAGIC), 0) // _RECORD.size
+
+
+def list_segments(start: float = None, end: float = None, directory: str = None):
+    """Paths of the segments whose partition overlaps [start, end], oldest first."""
+    directory = directory or SEGMENT_DIR
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+    paths = []
+    for name in names:
+        if not name.endswith(".seg"):
+            continue
+        partition = int(name.split("-")[0])
+        if start is not None and partition + PARTITION_SECONDS <= start:
+            continue
+        if end is not None and partition > end:
+            continue
+        paths.append(os.path.join(directory, name))
+    return paths
+
+
+def read_segments(start: float = None, end: float = None, directory: str = None):
+    """
+    Yield the rows recorded in binary segments between the epoch times
+    `start` and `end` (either may be None). Only segments whose partition
+    overlaps the range are opened.
+    """
+    for path in list_segments(start, end, directory):
+        yield from read_segment(path, 0, start, end)
+
+
+def _run_writer():
+    batch = []
+    deadline = time.monotonic() + FLUSH_INTERVAL
+    while True:
+        try:
+            item = _queue.get(timeout=max(deadline - time.monotonic(), 0.01))
+        except queue.Empty:
+            item = None
+
+        # flush() puts an Event in the queue and waits for it to be set
+        marker = item if isinstance(item, threading.Event) else None
+        if item is not None and marker is None:
+            batch.append(item)
+
+        if batch and (marker or len(batch) >= BATCH_SIZE or time.monotonic() >= deadline):
+            try:
+                _append_rows(batch)
+                with _LOCK:
+                    _counters["written"] += len(batch)
+                    _counters["batches"] += 1
+            except Exception as e:
+                # A bad row or a full disk costs this batch, never the writer thread
+                with _LOCK:
+                    _counters["dropped"] += len(batch)
+                    first = not _counters["errors"]
+                    _counters["errors"] += 1
+                if first:
+                    logging.error("analytics: dropped %d rows (%s: %s)", len(batch), type(e).__name__, e)
+            batch = []
+        if time.monotonic() >= deadline:
+            deadline = time.monotonic() + FLUSH_INTERVAL
+        if marker:
+            marker.set()
+
+
+def _start_writer():
+    global _writer
+    with _LOCK:
+        if _writer is None:
+            _writer = threading.Thread(target=_run_writer, name="analytics", daemon=True)
+            _writer.start()
+
+
 def _write_row(row: dict):
-    """Internal helper to append one row to the CSV in a thread-safe way."""
-    file_exists = os.path.isfile(LOG_FILE)
+    """Queue one row for the background writer; drops it if the queue is full."""
+    if _writer is None:
+        _start_writer()
+    try:
+        _queue.put_nowait(row)
+        counter = "queued"
+    except queue.Full:
+        counter = "dropped"
+    with _LOCK:
+        _counters[counter] += 1
+
+
+def flush(timeout: float = 5.0) -> bool:
+    """Write out every row queued so far. Returns False on timeout."""
+    if _writer is None:
+        return True
+    done = threading.Event()
+    try:
+        _queue.put(done, timeout=timeout)
+    except queue.Full:
+        return False
+    return done.wait(timeout)
+
 
+def set_destination(log_file: str, segment_dir: str):
+    """
+    Record into `log_file` and `segment_dir` from now on, e.g. during a
+    scratch run. Rows already queued are written where they were headed
+    first; call it while nothing else is recording.
+    """
+    global LOG_FILE, SEGMENT_DIR
+    flush()
+    LOG_FILE, SEGMENT_DIR = log_file, segment_dir
+    if _segment["file"] is not None:
+        _segment["file"].close()
+        _segment["file"] = None
+
+
+def stats() -> dict:
+    """Counters of rows queued, written and dropped, plus the current backlog."""
     with _LOCK:
-        with open(LOG_FILE, "a", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=_FIELDNAMES)
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(row)
+        counters = dict(_counters)
+    counters["pending"] = _queue.qsize()
+    return counters
+
+
+atexit.register(flush)
 
 
 def record_transfer(
@@ -52,6 +305,7 @@ def record_transfer(
     end: float,
     status: str = "OK",
     note: str = "",
+    io_path: str = "",
 ):
     """
     Record a file transfer (UPLOAD or DOWNLOAD).
@@ -60,15 +314,21 @@ def record_transfer(
     op_type  : "UPLOAD" or "DOWNLOAD"
     num_bytes: total bytes transferred
     start/end: timestamps from now()
+    io_path  : how the bytes were moved ("sendfile" or "buffered"),
+               stored in the note column as "path=<io_path>"
     """
+    if io_path:
+        note = f"path={io_path};{note}" if note else f"path={io_path}"
     duration = max(end - start, 0.0)
     data_rate = 0.0
     if duration > 0 and num_bytes is not None:
         # bytes/sec -> MB/sec
         data_rate = num_bytes / duration / (1024 * 1024)
 
+    epoch = time.time()
     row = {
-        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "epoch": epoch,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(epoch)),
         "role": role,
         "operation": op_type,
         "command": "",
@@ -77,7 +337,7 @@ def record_transfer(
         "duration_sec": round(duration, 6),
         "data_rate_MBps": round(data_rate, 6),
         "status": status,
-        "note": note,
+        "note": _tag(note),
         "start_clock": start,
         "end_clock": end,
     }
@@ -101,8 +361,10 @@ def record_event(
     """
     duration = max(end - start, 0.0)
 
+    epoch = time.time()
     row = {
-        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "epoch": epoch,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(epoch)),
         "role": role,
         "operation": "EVENT",
         "command": event,
@@ -111,7 +373,7 @@ def record_event(
         "duration_sec": round(duration, 6),
         "data_rate_MBps": 0.0,
         "status": status,
-        "note": note,
+        "note": _tag(note),
         "start_clock": start,
         "end_clock": end,
     }
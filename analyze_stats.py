@@ -1,14 +1,44 @@
+import csv
+import json
+import math
+import os
+import re
+import sys
+
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from analytics import list_segments, read_segment, read_segments, segment_records
+
+
+def _epoch(value):
+    """datetime / "YYYY-MM-DD HH:MM" string / None -> epoch seconds (local time)."""
+    if value is None:
+        return None
+    return pd.Timestamp(value).to_pydatetime().timestamp()
+
 
-def load_data(csv_path="network_stats.csv"):
-    df = pd.read_csv(csv_path)
+def load_data(csv_path="network_stats.csv", start=None, end=None):
+    """
+    Load network_stats.csv, or the binary segments if csv_path is the
+    segment directory (ANALYTICS_SINK=binary). start/end limit the rows to
+    a time range; for segments only the partitions in that range are read.
+    """
+    if os.path.isdir(csv_path):
+        df = pd.DataFrame(list(read_segments(_epoch(start), _epoch(end), csv_path)))
+        if df.empty:
+            df = pd.DataFrame(columns=["timestamp", "role", "operation", "command", "bytes"])
+    else:
+        df = pd.read_csv(csv_path)
 
     # If these columns exist, they’re already in good shape
     # Just make sure types are right
     if "timestamp" in df.columns:
         df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce")
+        if start is not None:
+            df = df[df["timestamp"] >= pd.Timestamp(start)]
+        if end is not None:
+            df = df[df["timestamp"] <= pd.Timestamp(end)]
 
     if "bytes" in df.columns:
         df["MB"] = df["bytes"] / (1024 * 1024)
@@ -26,6 +56,28 @@ def print_summary(df):
         print(transfers[["role", "operation", "file_name", "MB","duration_sec", "data_rate_MBps"]].head())
         print("\nBasic stats:")
         print(transfers[["MB", "duration_sec", "data_rate_MBps"]].describe())
+
+        # record_transfer stores the send path (sendfile/buffered) as "path=..." in note
+        if "note" in transfers.columns:
+            paths = transfers["note"].fillna("").astype(str).str.extract(r"path=(\w+)")[0]
+            by_path = transfers.assign(io_path=paths).dropna(subset=["io_path"])
+            if not by_path.empty:
+                print("\nData rate by I/O path:")
+                print(by_path.groupby(["operation", "io_path"])["data_rate_MBps"].describe())
+            # Server downloads note whether the file cache already held the file
+            cache = transfers["note"].fillna("").astype(str).str.extract(r"cache=(\w+)")[0].dropna()
+            if not cache.empty:
+                print("\nFile cache (server downloads):")
+                print(cache.value_counts().to_string())
+                print(f"hit rate: {(cache == 'hit').mean():.1%}")
+            # A multi-process server tags its rows with "worker=<n>"
+            worker = transfers["note"].fillna("").astype(str).str.extract(r"worker=(\d+)")[0]
+            by_worker = transfers.assign(worker=worker).dropna(subset=["worker"])
+            if not by_worker.empty:
+                print("\nServer transfers by worker process:")
+                print(by_worker.groupby("worker").agg(
+                    transfers=("MB", "size"), MB=("MB", "sum"), mean_MBps=("data_rate_MBps", "mean"),
+                ).to_string())
     else:
         print("No transfer rows found (UPLOAD/DOWNLOAD).")
 
@@ -120,8 +172,206 @@ def plot_response_times(df):
     print("Saved response_times.png")
 
 
+# ----- incremental mode -----
+#
+# python analyze_stats.py --incremental [network_stats.csv | network_stats/] [state.json]
+#
+# Only rows added since the last run are read (the CSV from a saved byte
+# offset, segments from a saved record count) and folded into running
+# aggregates kept in the state file, so history is never rescanned.
+
+STATE_FILE = "analyze_state.json"
+COMMANDS = ["DIR", "DELETE", "SUBFOLDER"]
+
+
+def new_state():
+    return {
+        "csv": {"offset": 0, "header": None},
+        "segments": {},
+        "transfers": {},    # "OPERATION/role" -> stats of MB, duration_sec, data_rate_MBps
+        "paths": {},        # "OPERATION/io_path" -> stats of data_rate_MBps
+        "size_bins": {},    # "OPERATION/log2(MB)" -> stats of MB, duration_sec
+        "commands": {},     # client EVENT command -> stats of duration_sec
+        "cache": {},        # "hit" / "miss" -> server downloads
+        "workers": {},      # server worker process -> stats of MB, data_rate_MBps
+    }
+
+
+def load_state(path=STATE_FILE):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return new_state()
+
+
+def save_state(state, path=STATE_FILE):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _accumulate(table, key, **values):
+    entry = table.setdefault(key, {})
+    for name, value in values.items():
+        s = entry.setdefault(name, {"count": 0, "sum": 0.0, "min": value, "max": value})
+        s["count"] += 1
+        s["sum"] += value
+        s["min"] = min(s["min"], value)
+        s["max"] = max(s["max"], value)
+
+
+def update_state(state, row):
+    """Fold one row (dict of CSV strings or segment values) into the aggregates."""
+    operation = row.get("operation")
+    try:
+        duration = float(row.get("duration_sec") or 0)
+        if operation in ("UPLOAD", "DOWNLOAD"):
+            mb = float(row.get("bytes") or 0) / (1024 * 1024)
+            rate = float(row.get("data_rate_MBps") or 0)
+        elif operation != "EVENT":
+            return
+    except ValueError:
+        return
+
+    if operation == "EVENT":
+        if row.get("role") == "client":
+            _accumulate(state["commands"], row.get("command", ""), duration_sec=duration)
+        return
+
+    _accumulate(state["transfers"], f"{operation}/{row.get('role')}", MB=mb, duration_sec=duration, data_rate_MBps=rate)
+    match = re.search(r"path=(\w+)", str(row.get("note") or ""))
+    if match:
+        _accumulate(state["paths"], f"{operation}/{match.group(1)}", data_rate_MBps=rate)
+    match = re.search(r"cache=(\w+)", str(row.get("note") or ""))
+    if match:
+        cache = state.setdefault("cache", {})
+        cache[match.group(1)] = cache.get(match.group(1), 0) + 1
+    match = re.search(r"worker=(\d+)", str(row.get("note") or ""))
+    if match:
+        _accumulate(state.setdefault("workers", {}), match.group(1), MB=mb, data_rate_MBps=rate)
+    if mb > 0:
+        _accumulate(state["size_bins"], f"{operation}/{math.floor(math.log2(mb))}", MB=mb, duration_sec=duration)
+
+
+def scan_csv(state, csv_path):
+    """Read the CSV rows appended since the saved offset."""
+    checkpoint = state["csv"]
+    if os.path.getsize(csv_path) < checkpoint["offset"]:
+        # The log was truncated or replaced: start over on the new file
+        checkpoint.update(offset=0, header=None)
+
+    rows = 0
+    with open(csv_path, "rb") as f:
+        f.seek(checkpoint["offset"])
+        for line in f:
+            if not line.endswith(b"\n"):
+                break       # row still being written; pick it up next run
+            checkpoint["offset"] += len(line)
+            fields = next(csv.reader([line.decode("utf-8", "replace")]), None)
+            if not fields:
+                continue
+            if checkpoint["header"] is None:
+                checkpoint["header"] = fields
+                continue
+            update_state(state, dict(zip(checkpoint["header"], fields)))
+            rows += 1
+    return rows
+
+
+def scan_segments(state, directory):
+    """Read the records appended to binary segments since the last run."""
+    rows = 0
+    for path in list_segments(directory=directory):
+        name = os.path.basename(path)
+        first = state["segments"].get(name, 0)
+        if segment_records(path) <= first:
+            continue
+        for row in read_segment(path, first):
+            update_state(state, row)
+            first += 1
+            rows += 1
+        state["segments"][name] = first
+    return rows
+
+
+def _mean(s):
+    return s["sum"] / s["count"] if s["count"] else 0.0
+
+
+def print_incremental_summary(state):
+    print("\n=== TRANSFER SUMMARY (UPLOAD/DOWNLOAD, all runs) ===")
+    if not state["transfers"]:
+        print("No transfer rows found (UPLOAD/DOWNLOAD).")
+        return
+    print(f"{'operation/role':<20} {'count':>7} {'mean MB':>9} {'mean s':>9} {'mean MB/s':>10} {'min MB/s':>9} {'max MB/s':>9}")
+    for key, entry in sorted(state["transfers"].items()):
+        rate = entry["data_rate_MBps"]
+        print(
+            f"{key:<20} {rate['count']:>7} {_mean(entry['MB']):>9.2f} {_mean(entry['duration_sec']):>9.3f} "
+            f"{_mean(rate):>10.2f} {rate['min']:>9.2f} {rate['max']:>9.2f}"
+        )
+    if state["paths"]:
+        print("\nData rate by I/O path:")
+        for key, entry in sorted(state["paths"].items()):
+            rate = entry["data_rate_MBps"]
+            print(f"{key:<20} {rate['count']:>7} {_mean(rate):>10.2f} MB/s")
+    cache = state.get("cache")
+    if cache:
+        hits, total = cache.get("hit", 0), sum(cache.values())
+        print(f"\nFile cache (server downloads): {hits} hits / {total} ({hits / total:.1%})")
+    if state.get("workers"):
+        print("\nServer transfers by worker process:")
+        for key, entry in sorted(state["workers"].items(), key=lambda item: int(item[0])):
+            mb = entry["MB"]
+            print(f"worker {key:<13} {mb['count']:>7} {mb['sum']:>9.1f} MB {_mean(entry['data_rate_MBps']):>10.2f} MB/s")
+
+
+def aggregate_frames(state):
+    """Small DataFrames in the shape the plot_* functions expect."""
+    rates = pd.DataFrame([
+        {"operation": key.split("/")[0], "role": key.split("/")[1], "data_rate_MBps": _mean(e["data_rate_MBps"])}
+        for key, e in state["transfers"].items()
+    ], columns=["operation", "role", "data_rate_MBps"])
+    sizes = pd.DataFrame([
+        {"operation": key.split("/")[0], "MB": _mean(e["MB"]), "duration_sec": _mean(e["duration_sec"])}
+        for key, e in state["size_bins"].items()
+    ], columns=["operation", "MB", "duration_sec"])
+    events = pd.DataFrame([
+        {"operation": "EVENT", "role": "client", "command": command, "duration_sec": _mean(e["duration_sec"])}
+        for command, e in state["commands"].items() if command in COMMANDS
+    ], columns=["operation", "role", "command", "duration_sec"])
+    return rates, sizes, events
+
+
+def run_incremental(source="network_stats.csv", state_path=STATE_FILE):
+    state = load_state(state_path)
+    if os.path.isdir(source):
+        rows = scan_segments(state, source)
+    else:
+        rows = scan_csv(state, source)
+    save_state(state, state_path)
+    print(f"Read {rows} new rows from {source}")
+
+    print_incremental_summary(state)
+    rates, sizes, events = aggregate_frames(state)
+    plot_avg_data_rate(rates)
+    plot_size_vs_time(sizes)
+    plot_response_times(events)
+
+
 def main():
-    df = load_data("network_stats.csv")
+    if "--incremental" in sys.argv[1:]:
+        args = [a for a in sys.argv[1:] if a != "--incremental"]
+        run_incremental(*args[:2])
+        return
+
+    # python analyze_stats.py [network_stats.csv | network_stats/] [start] [end]
+    source = sys.argv[1] if len(sys.argv) > 1 else "network_stats.csv"
+    start = sys.argv[2] if len(sys.argv) > 2 else None
+    end = sys.argv[3] if len(sys.argv) > 3 else None
+    df = load_data(source, start, end)
     print_summary(df)
     plot_avg_data_rate(df)
     plot_size_vs_time(df)
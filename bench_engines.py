@@ -0,0 +1,217 @@
+# bench_engines.py
+"""
+Compare the threaded and event-loop server engines on loopback.
+
+For each engine a server-basic.py process is started on its own port, then:
+  1. HOLD: open and authenticate N connections and keep them idle,
+     reporting how many the server held plus its thread count and RSS.
+  2. RPS:  W client threads send DIR in lock-step for a few seconds,
+     reporting requests/sec.
+
+Usage: python bench_engines.py [connections] [client_threads] [seconds]
+"""
+import contextlib
+import hashlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(BASE_DIR, "server-basic.py")
+FORMAT = "utf-8"
+SIZE = 64 * 1024
+
+BENCH_USER = "bench"
+BENCH_PASSWORD = "bench123"
+
+
+def write_users_file(workdir):
+    salt = os.urandom(16)
+    hashed_pw = hashlib.sha256(BENCH_PASSWORD.encode() + salt).hexdigest()
+    with open(os.path.join(workdir, "users.txt"), "w") as f:
+        f.write(f"{BENCH_USER}:{hashed_pw}:{salt.hex()}\n")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_server(engine, port, workdir, env=None):
+    """
+    Start server-basic.py in `workdir`, storing its files in workdir/server,
+    and wait until it accepts; `env` adds environment variables.
+    """
+    # Never the real server tree: a scratch server must not touch the files
+    # (or the .workers directory) of a server running from this checkout
+    env = dict(os.environ, SERVER_ENGINE=engine, SERVER_PORT=str(port),
+               SERVER_PATH=os.path.join(workdir, "server"), **(env or {}))
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{engine} server did not start on port {port}")
+
+
+@contextlib.contextmanager
+def client_workdir(workdir):
+    """
+    Run client code from `workdir`: its downloads, session token file and
+    analytics rows land there instead of in this checkout.
+    """
+    import analytics
+    import client
+
+    cwd, token_file = os.getcwd(), client.TOKEN_FILE
+    destination = (analytics.LOG_FILE, analytics.SEGMENT_DIR)
+    os.chdir(workdir)
+    client.TOKEN_FILE = os.path.join(workdir, ".session_token")
+    analytics.set_destination(os.path.join(workdir, "network_stats.csv"), os.path.join(workdir, "network_stats"))
+    try:
+        yield
+    finally:
+        # Flushes the scratch rows before the real files are used again
+        analytics.set_destination(*destination)
+        client.TOKEN_FILE = token_file
+        os.chdir(cwd)
+
+
+def login(port):
+    sock = socket.create_connection(("localhost", port))
+    sock.recv(SIZE)                                  # AUTH@USERNAME
+    sock.send(BENCH_USER.encode(FORMAT))
+    sock.recv(SIZE)                                  # AUTH@PASSWORD
+    sock.send(BENCH_PASSWORD.encode(FORMAT))
+    reply = ""
+    # AUTH@OK and the welcome line may arrive together or separately
+    while "Welcome" not in reply:
+        data = sock.recv(SIZE).decode(FORMAT)
+        if not data or "FAIL" in data:
+            sock.close()
+            raise RuntimeError("login failed")
+        reply += data
+    return sock
+
+
+def proc_status(pid):
+    """Threads and VmRSS (kB) from /proc, or None off Linux."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["Threads"]), int(fields["VmRSS"].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def try_login(port):
+    try:
+        return login(port)
+    except (OSError, RuntimeError):
+        return None
+
+
+def bench_hold(port, pid, count):
+    start = time.perf_counter()
+    # Logins are latency-bound (several small round trips), so open them in parallel
+    with ThreadPoolExecutor(max_workers=64) as pool:
+        held = [s for s in pool.map(try_login, [port] * count) if s is not None]
+    elapsed = time.perf_counter() - start
+    time.sleep(0.5)
+    threads, rss_kb = proc_status(pid)
+
+    # Every held connection should still be served
+    alive = 0
+    for sock in held:
+        try:
+            sock.send("DIR".encode(FORMAT))
+            if sock.recv(SIZE).startswith(b"OK"):
+                alive += 1
+        except OSError:
+            pass
+
+    for sock in held:
+        try:
+            sock.send("LOGOUT".encode(FORMAT))
+        except OSError:
+            pass
+        sock.close()
+    return {
+        "held": alive,
+        "connect_per_sec": len(held) / elapsed if elapsed else 0.0,
+        "threads": threads,
+        "rss_mb": rss_kb / 1024 if rss_kb else None,
+    }
+
+
+def bench_rps(port, workers, seconds):
+    counts = [0] * workers
+    stop = time.perf_counter() + seconds
+
+    def run(i):
+        sock = login(port)
+        try:
+            while time.perf_counter() < stop:
+                sock.send("DIR".encode(FORMAT))
+                if not sock.recv(SIZE):
+                    break
+                counts[i] += 1
+            sock.send("LOGOUT".encode(FORMAT))
+        finally:
+            sock.close()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts) / seconds
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        write_users_file(workdir)
+        for engine in ["threaded", "eventloop"]:
+            port = free_port()
+            proc = start_server(engine, port, workdir)
+            try:
+                hold = bench_hold(port, proc.pid, connections)
+                hold["rps"] = bench_rps(port, workers, seconds)
+                results[engine] = hold
+            finally:
+                proc.kill()
+                proc.wait()
+
+    print(f"\n{connections} idle connections, {workers} DIR clients for {seconds:g}s")
+    print(f"{'engine':<10} {'held':>6} {'conn/s':>8} {'threads':>8} {'RSS MB':>8} {'DIR req/s':>10}")
+    for engine, r in results.items():
+        rss = f"{r['rss_mb']:.1f}" if r["rss_mb"] else "n/a"
+        print(
+            f"{engine:<10} {r['held']:>6} {r['connect_per_sec']:>8.0f} "
+            f"{str(r['threads']):>8} {rss:>8} {r['rps']:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
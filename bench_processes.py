@@ -0,0 +1,116 @@
+# bench_processes.py
+"""
+Scaling of the multi-process server mode (SERVER_PROCESSES) with the
+number of worker processes.
+
+For every count from 1 to N a server-basic.py is started on its own port,
+then loaded for a few seconds by several client processes (each running
+a few threads, so the load generator isn't held back by one interpreter
+lock either):
+  DIR:   lock-step DIR@recursive=1 requests on long-lived connections
+  LOGIN: connect, log in and LOGOUT, over and over
+
+reporting requests/sec and the speedup over a single process. Workers
+can only run in parallel on as many cores as the machine has, so the
+speedup flattens beyond os.cpu_count().
+
+Usage: python bench_processes.py [max_processes] [client_processes] [threads_per_client] [seconds] [engine]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bench_engines import FORMAT, SIZE, free_port, login, start_server, write_users_file
+
+
+def dir_requests(port, stop):
+    sock = login(port)
+    count = 0
+    try:
+        while time.time() < stop:
+            sock.send("DIR@recursive=1".encode(FORMAT))
+            if not sock.recv(SIZE):
+                break
+            count += 1
+        sock.send("LOGOUT".encode(FORMAT))
+    finally:
+        sock.close()
+    return count
+
+
+def login_requests(port, stop):
+    count = 0
+    while time.time() < stop:
+        sock = login(port)
+        sock.send("LOGOUT".encode(FORMAT))
+        sock.close()
+        count += 1
+    return count
+
+
+SCENARIOS = {"DIR": dir_requests, "LOGIN": login_requests}
+
+
+def client_process(scenario, port, threads, stop):
+    """Requests completed by `threads` threads of one client process."""
+    counts = [0] * threads
+
+    def run(i):
+        try:
+            counts[i] = SCENARIOS[scenario](port, stop)
+        except (OSError, RuntimeError):
+            pass
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(counts)
+
+
+def bench(scenario, port, clients, threads, seconds):
+    # Every client process starts at the same wall-clock time
+    start = time.time() + 1.0
+    stop = start + seconds
+    with ProcessPoolExecutor(max_workers=clients) as pool:
+        futures = [pool.submit(client_process, scenario, port, threads, stop) for _ in range(clients)]
+        return sum(f.result() for f in futures) / seconds
+
+
+def main():
+    max_processes = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    seconds = float(sys.argv[4]) if len(sys.argv) > 4 else 5
+    engine = sys.argv[5] if len(sys.argv) > 5 else "threaded"
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        write_users_file(workdir)
+        for processes in range(1, max_processes + 1):
+            port = free_port()
+            proc = start_server(engine, port, workdir, {"SERVER_PROCESSES": str(processes)})
+            try:
+                # Give every worker time to bind before measuring
+                time.sleep(0.5)
+                results[processes] = {s: bench(s, port, clients, threads, seconds) for s in SCENARIOS}
+            finally:
+                # SIGTERM, so the server stops its workers too
+                proc.terminate()
+                proc.wait()
+
+    print(f"\n{engine} engine, {clients} client processes x {threads} threads, {seconds:g}s, "
+          f"{os.cpu_count()} CPUs")
+    print(f"{'processes':>9}" + "".join(f" {s + ' req/s':>12} {'speedup':>8}" for s in SCENARIOS))
+    for processes, r in results.items():
+        print(f"{processes:>9}" + "".join(
+            f" {r[s]:>12.0f} {r[s] / results[1][s] if results[1][s] else 0:>7.2f}x" for s in SCENARIOS
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# bench_streams.py
+"""
+Parallel multi-stream transfers on loopback: upload and download one file
+with 1, 2, 4 and 8 connections (client.parallel_upload_file / parallel_download_file)
+against a freshly started server, and report MB/s for each.
+
+Usage: python bench_streams.py [megabytes]
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import client
+from bench_engines import BENCH_PASSWORD, BENCH_USER, client_workdir, free_port, start_server, write_users_file
+
+STREAM_COUNTS = [1, 2, 4, 8]
+
+
+def timed(func, *args):
+    # The client prints a login line for every connection; keep the table readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        func(*args)
+        return time.perf_counter() - start
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    size = megabytes * 1024 * 1024
+    name = "bench_streams.txt"    # .txt has the smallest size floor (25 MB)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        write_users_file(workdir)
+        src = os.path.join(workdir, name)
+        with open(src, "wb") as f:
+            for _ in range(megabytes):
+                f.write(os.urandom(1024 * 1024))
+
+        port = free_port()
+        proc = start_server("threaded", port, workdir)
+        client.ADDR = ("localhost", port)
+        credentials = {"username": BENCH_USER, "password": BENCH_PASSWORD}
+        try:
+            # downloads/, the token file and the analytics rows land in the temp dir
+            with client_workdir(workdir):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    session = client.open_session(credentials)
+                print(f"{megabytes} MB file on loopback")
+                print(f"{'streams':>7} {'upload MB/s':>12} {'download MB/s':>14}")
+                for streams in STREAM_COUNTS:
+                    up = timed(client.parallel_upload_file, session, credentials, src, streams, True)
+                    down = timed(client.parallel_download_file, session, credentials, name, streams)
+                    print(f"{streams:>7} {megabytes / up:>12.1f} {megabytes / down:>14.1f}")
+                client.logout(session)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    session = client.open_session(credentials)
+                    client.pipeline(session, [("DELETE", name)])
+                    client.logout(session)
+        finally:
+            proc.kill()
+            proc.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# bench_suite.py
+"""
+Regression benchmarks: fixed loadgen scenarios against a throwaway server
+on loopback, compared with a saved baseline.
+
+Usage:
+  python bench_suite.py [--engine threaded|eventloop] [--duration S]
+                        [--save baseline.json] [--baseline baseline.json]
+                        [--threshold 0.2]
+
+--save writes this run's numbers as the new baseline. With --baseline,
+every scenario whose throughput dropped, or whose p99 latency rose, by
+more than --threshold (a fraction) is reported and the exit code is 1.
+"""
+import argparse
+import json
+import sys
+
+from loadgen import local_server, run_load
+
+# name -> loadgen arguments
+SCENARIOS = {
+    "dir": {"users": 8, "mix": "dir=1"},
+    "upload": {"users": 2, "mix": "upload=1", "sizes": "25"},
+    "download": {"users": 4, "mix": "upload=1,download=9", "sizes": "25"},
+    "mixed": {"users": 8, "mix": "upload=1,download=3,dir=5,delete=1", "sizes": "25"},
+}
+
+
+def run_suite(engine, duration, names=None):
+    results = {}
+    with local_server(engine) as (port, credentials):
+        for name in names or SCENARIOS:
+            summary = run_load("localhost", port, credentials, duration=duration, seed=0, **SCENARIOS[name])
+            results[name] = {
+                "ops_per_sec": summary["ops_per_sec"],
+                "MBps": summary["MBps"],
+                "errors": summary["errors"] + len(summary["user_errors"]),
+                "p50_ms": max((r["p50_ms"] for r in summary["per_op"].values()), default=0.0),
+                "p99_ms": max((r["p99_ms"] for r in summary["per_op"].values()), default=0.0),
+            }
+            r = results[name]
+            print(
+                f"{name:<10} {r['ops_per_sec']:>9.1f} ops/s {r['MBps']:>8.1f} MB/s "
+                f"p50 {r['p50_ms']:>8.2f} ms  p99 {r['p99_ms']:>8.2f} ms  errors {r['errors']}"
+            )
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Human-readable regressions of `results` against `baseline`."""
+    problems = []
+    for name, r in results.items():
+        if r["errors"]:
+            problems.append(f"{name}: {r['errors']} errors")
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key in ("ops_per_sec", "MBps"):
+            if base[key] and r[key] < base[key] * (1 - threshold):
+                problems.append(f"{name}: {key} {r[key]} vs baseline {base[key]}")
+        if base["p99_ms"] and r["p99_ms"] > base["p99_ms"] * (1 + threshold):
+            problems.append(f"{name}: p99_ms {r['p99_ms']} vs baseline {base['p99_ms']}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="File server regression benchmarks")
+    parser.add_argument("--engine", default="threaded")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--save")
+    parser.add_argument("--baseline")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run_suite(args.engine, args.duration, args.scenario)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        problems = compare(results, baseline, args.threshold)
+        for line in problems:
+            print("REGRESSION", line)
+        if problems:
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%} of {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# bench_transfer.py
+"""
+Micro-benchmark of the receive loop: the old recv()-per-chunk loop versus
+transfer.recv_to_file (recv_into a preallocated buffer), over a loopback
+TCP connection, writing to /dev/null so disk speed doesn't dominate.
+
+Usage: python bench_transfer.py [megabytes] [sockbuf_bytes]
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+import transfer
+
+SIZE = 64 * 1024
+
+
+def recv_loop_old(conn, f, count):
+    received = 0
+    while received < count:
+        chunk = conn.recv(min(SIZE, count - received))
+        if not chunk:
+            break
+        f.write(chunk)
+        received += len(chunk)
+    return received
+
+
+def recv_loop_into(buffer_size):
+    buf = memoryview(bytearray(buffer_size))
+
+    def run(conn, f, count):
+        return transfer.recv_to_file(conn, f, count, buf)
+    return run
+
+
+def run_once(receiver, total, sockbuf):
+    listener = socket.socket()
+    transfer.tune_socket(listener, sockbuf, sockbuf)
+    listener.bind(("localhost", 0))
+    listener.listen(1)
+    payload = memoryview(os.urandom(4 * 1024 * 1024))
+
+    def sender():
+        out = socket.create_connection(listener.getsockname())
+        transfer.tune_socket(out, sockbuf, sockbuf)
+        sent = 0
+        while sent < total:
+            n = min(len(payload), total - sent)
+            out.sendall(payload[:n])
+            sent += n
+        out.close()
+
+    t = threading.Thread(target=sender)
+    t.start()
+    conn, _ = listener.accept()
+    with open(os.devnull, "wb") as f:
+        start = time.perf_counter()
+        received = receiver(conn, f, total)
+        elapsed = time.perf_counter() - start
+    t.join()
+    conn.close()
+    listener.close()
+    assert received == total, (received, total)
+    return total / elapsed / (1024 * 1024)
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    sockbuf = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    total = megabytes * 1024 * 1024
+
+    cases = [("recv() 64 KiB (old)", recv_loop_old)]
+    for kib in (64, 256, 1024, 4096):
+        cases.append((f"recv_into {kib} KiB", recv_loop_into(kib * 1024)))
+
+    print(f"{megabytes} MB over loopback, SO_RCVBUF/SO_SNDBUF={sockbuf or 'default'}")
+    for name, receiver in cases:
+        rates = [run_once(receiver, total, sockbuf) for _ in range(3)]
+        print(f"  {name:<22} {max(rates):>9.1f} MB/s (best of 3)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,206 +1,530 @@
+import contextlib
 import socket
+import json
 import os
+import threading
 import time
 import getpass
 
-
-try:
-    from analytics import record_transfer, record_event
-except Exception:
-    def record_transfer(*args, **kwargs):
-        pass
-
-    def record_event(*args, **kwargs):
-        pass
+from fileclient import (
+    ClientError, dedup_upload, download, download_ranges, parallel_download, parallel_upload, upload,
+)
+from protocol import PROTO_FRAMED, Multiplexer, ProtocolError, TextChannel, open_channel
+from transfer import tune_socket
 
 IP = "localhost" 
 PORT = 4450
 ADDR = (IP, PORT)
 SIZE = 64 * 1024
 FORMAT = "utf-8"
+# Ask the server for the length-prefixed framed protocol (see protocol.py)
+USE_FRAMING = os.environ.get("CLIENT_FRAMING", "1") != "0"
+# Connections used by pupload/pdownload when no count is given
+PARALLEL_STREAMS = 4
+# Session tokens from earlier logins, per server, so reconnecting skips the password
+TOKEN_FILE = os.environ.get("CLIENT_TOKEN_FILE", ".session_token")
+# End-to-end checksum for uploads and downloads (see checksum.py); "none" turns it off
+CHECKSUM = os.environ.get("CLIENT_CHECKSUM", "sha256")
+if CHECKSUM == "none":
+    CHECKSUM = None
+# Transfer compression to ask for on framed connections (see compression.py): "auto", a codec or "none"
+COMPRESSION = os.environ.get("CLIENT_COMPRESSION", "auto")
 
 
 def connection_to_server():
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tune_socket(client_socket)
     client_socket.connect(ADDR)
     print(f"Connected to server at {IP}:{PORT}")
     return client_socket
 
 
-def authenticate(client_socket):
+def negotiate(chan):
+    """
+    Ask for the framed protocol in reply to the first AUTH@USERNAME.
+    The server then waits for the username in the mode it answered with.
+    """
+    chan.send_msg("PROTO", PROTO_FRAMED)
+    reply = chan.recv_msg()
+    if not reply or reply[0] != "PROTO" or len(reply) < 2:
+        raise ConnectionError(f"Unexpected reply to PROTO: {reply}")
+    return open_channel(chan.sock, reply[1])
+
+
+def _token_key():
+    return f"{ADDR[0]}:{ADDR[1]}"
+
+
+def _read_tokens():
+    try:
+        with open(TOKEN_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_tokens(tokens):
+    # Parallel-transfer helpers log in (and save) at the same time; each writes its own temp file
+    tmp_path = f"{TOKEN_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    # Tokens are credentials: readable by the owner only, from the moment the file exists
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(tokens, f)
+    os.replace(tmp_path, TOKEN_FILE)
+
+
+def load_token(credentials=None):
+    """(username, token) saved for this server, or (None, None)."""
+    if credentials and "token" in credentials:
+        return credentials.get("username"), credentials["token"]
+    entry = _read_tokens().get(_token_key())
+    if not entry:
+        return None, None
+    if credentials and credentials.get("username", entry["username"]) != entry["username"]:
+        return None, None
+    return entry["username"], entry["token"]
+
+
+def save_token(credentials, username, token):
+    if credentials is not None:
+        credentials["token"] = token
+    tokens = _read_tokens()
+    tokens[_token_key()] = {"username": username, "token": token}
+    try:
+        _write_tokens(tokens)
+    except OSError as e:
+        print("Could not save session token:", e)
+
+
+def forget_token(credentials=None):
+    if credentials is not None:
+        credentials.pop("token", None)
+    tokens = _read_tokens()
+    if tokens.pop(_token_key(), None) is not None:
+        try:
+            _write_tokens(tokens)
+        except OSError:
+            pass
+
+
+def authenticate(client_socket, credentials=None):
     """
     Handles the AUTH handshake with the server.
+    Returns the channel to use for the session, or None on failure.
+
+    credentials: optional dict; a "username"/"password" already in it is used
+    instead of prompting, and prompted values are stored in it so extra
+    connections (parallel transfers) can log in again.
+
+    A session token saved by an earlier login is tried first; the server
+    asks for the username again if it no longer accepts it.
     """
+    chan = TextChannel(client_socket)
+    username, token = load_token(credentials)
+    resumed = False
     while True:
-        msg = client_socket.recv(SIZE).decode(FORMAT)
-        if not msg:
+        parts = chan.recv_msg()
+        if not parts:
             print("Server closed connection during authentication.")
-            return False
+            return None
 
-        parts = msg.strip().split("@")
         tag = parts[0]
 
         if tag == "AUTH":
             if len(parts) < 2:
                 print("Malformed AUTH message from server.")
-                return False
+                return None
             step = parts[1]
 
             if step == "USERNAME":
-                username = input("Username: ")
-                client_socket.send(username.encode(FORMAT))
+                if USE_FRAMING and chan.mode != PROTO_FRAMED:
+                    chan = negotiate(chan)
+                if token:
+                    # One message instead of the username/password round trips
+                    chan.send_msg("TOKEN", token)
+                    token = None
+                    resumed = True
+                    continue
+                if resumed:
+                    print("Saved session expired, please log in again.")
+                    forget_token(credentials)
+                    resumed = False
+                if credentials and "username" in credentials:
+                    username = credentials["username"]
+                else:
+                    username = input("Username: ")
+                    if credentials is not None:
+                        credentials["username"] = username
+                chan.send_msg(username)
 
             elif step == "PASSWORD":
-                password = getpass.getpass("Password: ")
-                client_socket.send(password.encode(FORMAT))
+                if credentials and "password" in credentials:
+                    password = credentials["password"]
+                else:
+                    password = getpass.getpass("Password: ")
+                    if credentials is not None:
+                        credentials["password"] = password
+                chan.send_msg(password)
 
             elif step == "OK":
                 print("Login successful.")
+                if len(parts) > 2:
+                    save_token(credentials, username, parts[2])
                 # Receive welcome line sent right after login
-                welcome = client_socket.recv(SIZE).decode(FORMAT)
+                welcome = chan.recv_msg()
                 if welcome:
-                    print("Server:", welcome)
-                return True
+                    print("Server:", "@".join(welcome))
+                return chan
 
             elif step == "FAIL":
                 print("Invalid username or password.")
-                return False
+                return None
 
         elif tag == "ERR":
-            print("Authentication error from server:", "@".join(parts[1:]))
-            return False
+            if len(parts) > 2 and parts[1] == "BUSY":
+                print(f"Server is busy, try again in {parts[2]}s.")
+            else:
+                print("Authentication error from server:", "@".join(parts[1:]))
+            return None
 
         else:
             # Any other message before login is unexpected
-            print("Unexpected message during authentication:", msg)
-            return False
-
-
-def upload_file(client_socket, filename):  # file uploading function
-    if not os.path.exists(filename):
-        print("File cant be found OH OH")
-        return
-
-    filesize = os.path.getsize(filename)
-    base_name = os.path.basename(filename)
-
-    client_socket.send(f"UPLOAD@{base_name}@{filesize}\n".encode(FORMAT))
-
-    #first response: either error, overwrite prompt, or READY
-    response = client_socket.recv(SIZE).decode(FORMAT)
-    status, msg = response.split("@", 1)
-
-    #handle "file exists, overwrite?"
-    if status == "ERR" and "Overwrite" in msg:
-        choice = input("Server says file exists. Overwrite? (y/n): ").strip().lower()
-        client_socket.send(choice.encode(FORMAT))
-        response = client_socket.recv(SIZE).decode(FORMAT)
-        status, msg = response.split("@", 1)
-        if status == "OK" and "cancelled" in msg:
-            print("Upload cancelled.")
-            return
-        elif status == "ERR":
-            print("Server error:", msg)
-            return
-
-    #if server is ready, stream the file
-    if status == "OK":
-        start = time.perf_counter()
-        with open(filename, "rb") as f:
-            while True:
-                data = f.read(SIZE)
-                if not data:
-                    break
-                client_socket.sendall(data)
-        end = time.perf_counter()
-
-        # Log analytics
-        record_transfer("client", "UPLOAD", base_name, filesize, start, end)
-
-        # Final confirmation from server
-        final_msg = client_socket.recv(SIZE).decode(FORMAT)
-        print("Server:", final_msg)
+            print("Unexpected message during authentication:", "@".join(parts))
+            return None
+
+
+def start_session(chan):
+    """
+    After login: framed connections get a Multiplexer with a reader thread so
+    requests can be pipelined; text connections are used lock-step as they are.
+    """
+    if chan.mode != PROTO_FRAMED:
+        return chan
+    mux = Multiplexer(chan)
+    threading.Thread(target=mux.run, daemon=True).start()
+    return mux
+
+
+def open_session(credentials):
+    """Connect and log in with saved credentials; returns the session."""
+    sock = connection_to_server()
+    chan = authenticate(sock, credentials)
+    if not chan:
+        sock.close()
+        raise ConnectionError("Login failed")
+    return start_session(chan)
+
+
+def logout(session):
+    """LOGOUT (which also revokes the session token) and close the connection."""
+    try:
+        session.open_stream().send_msg("LOGOUT")
+    except OSError:
+        pass
+    disconnect(session)
+
+
+def disconnect(session):
+    """Close the connection but leave the session token valid for other connections."""
+    chan = session.chan if isinstance(session, Multiplexer) else session
+    chan.close()
+
+
+def run_on_streams(session, func, names, *args):
+    """
+    Call func(stream, name, *args) for every name. On a multiplexed session
+    each call gets its own stream and they all run at once over the one
+    connection; in text mode they run one after another.
+    """
+    def run(name):
+        stream = session.open_stream()
+        try:
+            func(stream, name, *args)
+        except (OSError, ValueError, ProtocolError, ClientError) as e:
+            print(f"{name}: {e}")
+        finally:
+            stream.release()
+
+    if isinstance(session, Multiplexer) and len(names) > 1:
+        threads = [threading.Thread(target=run, args=(name,)) for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
     else:
-        print("Server error:", msg)
+        for name in names:
+            run(name)
+
+
+def pipeline(session, requests):
+    """
+    Send a batch of simple requests, e.g. [("DELETE", "a.txt"), ("DIR",)],
+    and return their (status, msg) replies in order. On a multiplexed
+    session every request is sent before the first reply is read.
+    """
+    if not isinstance(session, Multiplexer):
+        replies = []
+        for request in requests:
+            session.send_msg(*request)
+            replies.append(split_reply(session.recv_msg()))
+        return replies
+
+    streams = []
+    for request in requests:
+        stream = session.open_stream()
+        stream.send_msg(*request)
+        streams.append(stream)
+
+    replies = []
+    for stream in streams:
+        try:
+            replies.append(split_reply(stream.recv_msg()))
+        finally:
+            stream.release()
+    return replies
+
+
+def split_reply(parts):
+    """[status, *args] from the server -> (status, rest joined back with "@")."""
+    if not parts:
+        raise ConnectionError("Server closed the connection")
+    return parts[0], "@".join(parts[1:])
+
+
+def ask_overwrite(name) -> bool:
+    """Overwrite prompt for the menu, asked only if `name` exists on the server."""
+    return input(f"Server says {name} exists. Overwrite? (y/n): ").strip().lower() == "y"
+
 
+def upload_file(chan, filename, overwrite=False, resume=False) -> dict:
+    """
+    fileclient.upload with this client's CHECKSUM and COMPRESSION settings.
+    resume=True continues an earlier, interrupted upload from the offset
+    the server already has. Raises ClientError (or OSError).
+    """
+    return upload(chan, filename, overwrite=overwrite, resume=resume,
+                  checksum_algorithm=CHECKSUM, codec=COMPRESSION)
 
-def download_file(client_socket, filename):
-    client_socket.send(f"DOWNLOAD@{filename}".encode(FORMAT))
-    response = client_socket.recv(SIZE).decode(FORMAT)
 
-    status, msg = response.split("@", 1)
-    if status == "ERR":
-        print("Server error:", msg)
-        return
+def download_file(chan, filename) -> dict:
+    """
+    fileclient.download into downloads/ with this client's CHECKSUM and
+    COMPRESSION settings, continuing from a .part file left by an earlier
+    interrupted download. Raises ClientError (or OSError).
+    """
+    return download(chan, filename, "downloads", checksum_algorithm=CHECKSUM, codec=COMPRESSION)
 
-    filesize = int(msg)
-    client_socket.send("READY".encode(FORMAT))
 
+def save_ranges(chan, filename, ranges):
+    """
+    Fetch `ranges` of `filename` into downloads/<filename>.ranges, each at
+    its own offset (a sparse file). Returns (path, ranges as served).
+    """
     os.makedirs("downloads", exist_ok=True)
-    filepath = os.path.join("downloads", filename)
+    path = os.path.join("downloads", filename + ".ranges")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        served = download_ranges(chan, filename, ranges, lambda offset, data: os.pwrite(fd, data, offset),
+                                 checksum_algorithm=CHECKSUM)
+    finally:
+        os.close(fd)
+    return path, served
+
+
+@contextlib.contextmanager
+def request_stream(session):
+    """A stream on `session` for one request."""
+    stream = session.open_stream()
+    try:
+        yield stream
+    finally:
+        stream.release()
+
+
+@contextlib.contextmanager
+def helper_stream(credentials):
+    """A stream on a new connection logged in with `credentials`, closed afterwards."""
+    session = open_session(credentials)
+    try:
+        yield session.open_stream()
+    finally:
+        # Helpers share the main connection's token, so no LOGOUT here
+        disconnect(session)
+
+
+def parallel_upload_file(session, credentials, filename, streams=PARALLEL_STREAMS, overwrite=False) -> dict:
+    """
+    fileclient.parallel_upload: start and commit on `session`, every range
+    on a connection of its own. Raises ClientError (or OSError).
+    """
+    return parallel_upload(lambda: request_stream(session), lambda: helper_stream(credentials),
+                           filename, overwrite=overwrite, streams=streams)
+
 
-    start = time.perf_counter()
-    remaining = filesize
-    with open(filepath, "wb") as f:
-        while remaining > 0:
-            chunk = client_socket.recv(min(SIZE, remaining))
-            if not chunk:
-                break
-            f.write(chunk)
-            remaining -= len(chunk)
-    end = time.perf_counter()
+def parallel_download_file(session, credentials, filename, streams=PARALLEL_STREAMS) -> dict:
+    """fileclient.parallel_download into downloads/, as parallel_upload_file. Raises ClientError (or OSError)."""
+    return parallel_download(lambda: request_stream(session), lambda: helper_stream(credentials),
+                             filename, "downloads", streams)
 
-    record_transfer("client", "DOWNLOAD", filename, filesize, start, end, status="OK")
-    print(f"Downloaded '{filename}' to downloads/")
+
+def menu_upload(chan, filename, overwrite=ask_overwrite, resume=False):
+    result = upload_file(chan, filename, overwrite, resume)
+    resumed = f", resumed at byte {result['offset']}" if result["offset"] else ""
+    print(f"Uploaded '{result['name']}' ({result['bytes']} bytes{resumed})")
+
+
+def menu_download(chan, filename):
+    result = download_file(chan, filename)
+    resumed = f", resumed at byte {result['offset']}" if result["offset"] else ""
+    print(f"Downloaded '{filename}' to downloads/ ({result['bytes']} bytes{resumed})")
+
+
+def menu_dedup_upload(chan, filename, overwrite=ask_overwrite):
+    result = dedup_upload(chan, filename, overwrite=overwrite)
+    sent = result["chunks"] - result["skipped_chunks"]
+    print(f"Uploaded '{result['name']}' ({sent} of {result['chunks']} chunks sent)")
+
+
+def menu_parallel(session, credentials, command, filename, streams):
+    if command == "pupload":
+        result = parallel_upload_file(session, credentials, filename, streams, ask_overwrite)
+        print(f"Uploaded '{result['name']}' over {result['streams']} connections")
+    else:
+        parallel_download_file(session, credentials, filename, streams)
+        print(f"Downloaded '{filename}' to downloads/ over {streams} connections")
 
 
-def menu_client(client_socket):
+def menu_ranges(chan, filename, ranges):
+    path, served = save_ranges(chan, filename, ranges)
+    print(f"Saved {sum(n for _, n in served)} bytes in {len(served)} ranges to {path}")
+
+
+def menu_client(session, credentials):
     while True:
         print("\n----- Menu -----")
-        print(" upload <filename>")
-        print(" download <filename>")
-        print(" delete <filename>")
-        print(" dir")
+        print(" upload <filename> [filename ...]")
+        print(" download <filename> [filename ...]")
+        print(" delete <filename> [filename ...]")
+        print(" pupload <filename> [streams]")
+        print(" pdownload <filename> [streams]")
+        print(" ranges <filename> <offset:length> [offset:length ...]")
+        print(" resume <filename>")
+        print(" dupload <filename> [filename ...]")
+        print(" dir [folder] [-r] [type=file|folder] [ext=.txt] [match=<glob>] [offset=N]")
+        print(" stats")
         print(" subfolder <create|delete> <foldername>")
+        print(" logout")
         print(" exit")
 
         command = input("\nEnter command: ").strip()
         if not command:
             continue
 
+        # exit keeps the saved session token for the next launch; logout ends it
         if command.lower() == "exit":
-            client_socket.send("LOGOUT".encode(FORMAT))
             print("Exiting...")
             break
 
+        if command.lower() == "logout":
+            session.open_stream().send_msg("LOGOUT")
+            forget_token(credentials)
+            print("Logged out.")
+            break
+
         parts = command.split()
 
-        if parts[0] == "upload" and len(parts) == 2:
-            upload_file(client_socket, parts[1])
+        # Several files at once run concurrently over the one connection
+        if parts[0] == "upload" and len(parts) >= 2:
+            overwrite = ask_overwrite
+            if len(parts) > 2:
+                # Threads can't share the prompt, so ask once up front
+                answer = input("Overwrite files that already exist? (y/n): ")
+                overwrite = answer.strip().lower() == "y"
+            run_on_streams(session, menu_upload, parts[1:], overwrite)
+            continue
+
+        # Continue an interrupted upload from what the server already has
+        if parts[0] == "resume" and len(parts) == 2:
+            run_on_streams(session, menu_upload, parts[1:], ask_overwrite, True)
+            continue
+
+        # Deduplicated upload: chunks the server already stores are skipped
+        if parts[0] == "dupload" and len(parts) >= 2:
+            overwrite = ask_overwrite
+            if len(parts) > 2:
+                answer = input("Overwrite files that already exist? (y/n): ")
+                overwrite = answer.strip().lower() == "y"
+            run_on_streams(session, menu_dedup_upload, parts[1:], overwrite)
+            continue
+
+        if parts[0] == "download" and len(parts) >= 2:
+            run_on_streams(session, menu_download, parts[1:])
+            continue
+
+        # One large file split over several connections
+        if parts[0] in ("pupload", "pdownload") and len(parts) in (2, 3):
+            streams = int(parts[2]) if len(parts) == 3 and parts[2].isdigit() else PARALLEL_STREAMS
+            try:
+                menu_parallel(session, credentials, parts[0], parts[1], streams)
+            except (OSError, ValueError, ProtocolError, ClientError) as e:
+                print("Transfer failed:", e)
+            continue
+
+        # Just some byte ranges of a file, e.g. to preview a video
+        if parts[0] == "ranges" and len(parts) >= 3:
+            try:
+                ranges = [(int(offset), int(length)) for offset, length in (r.split(":") for r in parts[2:])]
+            except ValueError:
+                print("Ranges are <offset>:<length>")
+                continue
+            run_on_streams(session, menu_ranges, [parts[1]], ranges)
+            continue
+
+        if parts[0] == "stats" and len(parts) == 1:
+            status, msg = pipeline(session, [("STATS",)])[0]
+            if status == "OK":
+                for key, value in json.loads(msg).items():
+                    print(f"  {key}: {value}")
+            else:
+                print(f"Server: {status}@{msg}")
             continue
 
-        if parts[0] == "download" and len(parts) == 2:
-            download_file(client_socket, parts[1])
+        # Paged, filterable listing; plain "dir" keeps the simple one below
+        if parts[0] == "dir" and len(parts) > 1:
+            options = ["recursive=1" if p == "-r" else p if "=" in p else f"path={p}" for p in parts[1:]]
+            status, msg = pipeline(session, [("DIR", *options)])[0]
+            if status != "OK":
+                print(f"Server: {status}@{msg}")
+                continue
+            page = json.loads(msg)
+            for entry in page["entries"]:
+                name = entry["path"] + ("/" if entry["type"] == "folder" else "")
+                modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["mtime"]))
+                print(f"  {name:<40} {entry['size']:>14}  {modified}")
+            if page["next"] is not None:
+                print(f"  ... {page['total'] - page['next']} more (offset={page['next']})")
             continue
 
         # Simple commands handled directly
         if parts[0] == "dir" and len(parts) == 1:
-            client_socket.send("DIR".encode(FORMAT))
-        elif parts[0] == "delete" and len(parts) == 2:
-            client_socket.send(f"DELETE@{parts[1]}".encode(FORMAT))
+            requests = [("DIR",)]
+        elif parts[0] == "delete" and len(parts) >= 2:
+            requests = [("DELETE", name) for name in parts[1:]]
         elif parts[0] == "subfolder" and len(parts) == 3:
-            client_socket.send(f"SUBFOLDER@{parts[1]}@{parts[2]}".encode(FORMAT))
+            requests = [("SUBFOLDER", parts[1], parts[2])]
         else:
             print("Invalid command syntax.")
             continue
 
-        data = client_socket.recv(SIZE).decode(FORMAT)
-        print("Server:", data)
+        for status, msg in pipeline(session, requests):
+            print(f"Server: {status}@{msg}")
 
 
 if __name__ == "__main__":
     sock = connection_to_server()
-    if authenticate(sock):
-        menu_client(sock)
+    credentials = {}
+    chan = authenticate(sock, credentials)
+    if chan:
+        menu_client(start_session(chan), credentials)
     sock.close()
     print("Connection closed.")
\ No newline at end of file
@@ -0,0 +1,304 @@
+# compression.py
+"""
+Streaming compression for transfers (and large DIR pages).
+
+UPLOAD and DOWNLOAD take a "zip=<codec>" option; the server echoes
+"zip=<codec>" in its READY / size reply when it accepts. It declines for
+extensions that are compressed already and on text-mode connections,
+whose raw data has no end marker. A compressed transfer is a series of
+blocks sent as DATA frames:
+
+    kind (1: 0 raw, 1 compressed, 2 rest) | payload length (4) | payload
+
+Each block holds up to BLOCK_SIZE bytes of the file and is compressed on
+its own; a block that would decompress to more is rejected, as is a
+transfer that decompresses to more bytes than were announced. A block
+that doesn't shrink (judged from a sample of it first) is sent raw, and
+after GIVE_UP raw blocks in a row the sender gives up: an empty "rest"
+block says the rest of the transfer follows as plain bytes, which go out
+with sendfile and are written straight to the file, as in an uncompressed
+transfer. Compression runs on a worker thread a few blocks ahead of the
+socket, and decompression on a worker thread behind it.
+"""
+import base64
+import lzma
+import os
+import queue
+import struct
+import threading
+import zlib
+
+class CompressionError(Exception):
+    pass
+
+
+# Decompressors take (data, limit) and raise CompressionError rather than
+# produce more than `limit` bytes, so a small block can't expand unchecked
+
+def _zlib_decompress(data: bytes, limit: int) -> bytes:
+    d = zlib.decompressobj()
+    try:
+        out = d.decompress(data, limit)
+    except zlib.error as e:
+        raise CompressionError(str(e))
+    if d.unconsumed_tail or not d.eof:
+        raise CompressionError(f"block is truncated or decompresses past {limit} bytes")
+    return out
+
+
+def _lzma_decompress(data: bytes, limit: int) -> bytes:
+    d = lzma.LZMADecompressor()
+    try:
+        out = d.decompress(data, limit)
+    except lzma.LZMAError as e:
+        raise CompressionError(str(e))
+    if not d.eof:
+        raise CompressionError(f"block is truncated or decompresses past {limit} bytes")
+    return out
+
+
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 1), _zlib_decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=1), _lzma_decompress),
+}
+try:
+    import zstandard
+
+    def _zstd_decompress(data: bytes, limit: int) -> bytes:
+        # Our frames carry their content size, which is checked against the limit
+        try:
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=limit)
+        except zstandard.ZstdError as e:
+            raise CompressionError(str(e))
+
+    CODECS["zstd"] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data), _zstd_decompress)
+except ImportError:
+    pass
+
+# What "auto" picks for compressible files
+PREFERRED = "zstd" if "zstd" in CODECS else "zlib"
+# Media formats that are compressed already
+COMPRESSED_EXTS = {".mp3", ".mp4", ".avi", ".mkv"}
+
+BLOCK = struct.Struct("!BI")
+BLOCK_RAW = 0
+BLOCK_COMPRESSED = 1
+BLOCK_REST = 2
+BLOCK_SIZE = 1024 * 1024
+# Blocks compressed ahead of the socket
+PIPELINE_DEPTH = 4
+# Consecutive blocks that didn't shrink before the sender stops compressing
+GIVE_UP = 2
+# A block is only compressed if this much of it, compressed on its own,
+# shrinks below SAMPLE_RATIO; a miss then costs a fraction of a block
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_RATIO = 0.9
+# DIR pages shorter than this are not worth compressing
+MIN_MESSAGE_SIZE = 4096
+# Most bytes a compressed DIR page may decompress to
+MAX_MESSAGE_SIZE = BLOCK_SIZE
+
+
+def choose(filename: str, codec: str = "auto"):
+    """The codec to use for `filename` ("auto", a codec name or "none"), or None."""
+    if not codec or codec == "none":
+        return None
+    if os.path.splitext(filename)[1].lower() in COMPRESSED_EXTS:
+        return None
+    return PREFERRED if codec == "auto" else codec
+
+
+def wire_bound(size: int) -> int:
+    """Most bytes a compressed transfer of `size` bytes can take on the wire."""
+    return size + (size // BLOCK_SIZE + 1) * BLOCK.size
+
+
+class BlockCompressor:
+    """
+    Iterates over `count` bytes of `f` from `offset` as encoded blocks, for
+    FramedChannel.send_blocks. Once compression stops paying, the last items
+    are a "rest" block and (f, offset, count) of what is left, so that part
+    is sent from the file. `raw` counts the file bytes covered so far, `wire`
+    the bytes handed out.
+    """
+
+    def __init__(self, f, offset: int, count: int, codec: str):
+        self.compress = CODECS[codec][0]
+        self.raw = 0
+        self.wire = 0
+        self._queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(f, offset, count), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self, f, offset, count):
+        misses = 0
+        try:
+            f.seek(offset)
+            remaining = count
+            while remaining > 0 and not self._stop.is_set():
+                if misses >= GIVE_UP:
+                    self._put((0, BLOCK.pack(BLOCK_REST, 0)))
+                    self._put((remaining, (f, offset + count - remaining, remaining)))
+                    break
+                data = f.read(min(BLOCK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                packed = self.compress(data) if self._worth_compressing(data) else data
+                if len(packed) < len(data):
+                    misses = 0
+                    self._put((len(data), BLOCK.pack(BLOCK_COMPRESSED, len(packed)) + packed))
+                else:
+                    misses += 1
+                    self._put((len(data), BLOCK.pack(BLOCK_RAW, len(data)) + data))
+        except Exception as e:
+            self._put(e)
+        self._put(None)
+
+    def _worth_compressing(self, data: bytes) -> bool:
+        if len(data) <= SAMPLE_SIZE:
+            return True
+        sample = data[:SAMPLE_SIZE]
+        return len(self.compress(sample)) < len(sample) * SAMPLE_RATIO
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                raw, block = item
+                self.raw += raw
+                self.wire += raw if isinstance(block, tuple) else len(block)
+                yield block
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+
+
+class DecompressingWriter:
+    """
+    File-like sink for a compressed transfer: write() takes wire bytes in
+    any pieces and splits them into blocks, a worker thread decodes them
+    into `f`. After a "rest" block the bytes go straight to `f` instead.
+    close() waits for the worker and returns the number of bytes written
+    to `f`; a block cut off by an interrupted transfer is dropped,
+    undecodable data raises. So does data decoding to more than `limit`
+    bytes in all: nothing more is decoded or written once it passes the limit.
+    """
+
+    def __init__(self, f, codec: str, limit: int = None):
+        self.f = f
+        self.decompress = CODECS[codec][1]
+        self.limit = limit
+        self.raw = 0
+        self.error = None
+        self._header = bytearray()
+        self._kind = None
+        self._block = None
+        self._length = 0
+        self._direct = False
+        self._queue = queue.Queue(maxsize=PIPELINE_DEPTH * 16)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, data) -> int:
+        size = len(data)
+        # After an error the rest of the transfer is only drained
+        if self.error:
+            return size
+        view = memoryview(data)
+        try:
+            while view and not self._direct:
+                view = self._split(view)
+            if view:
+                self._write_out(view)
+        except CompressionError as e:
+            self.error = e
+        return size
+
+    def _split(self, view: memoryview) -> memoryview:
+        """Take what `view` holds of the current block; returns the rest."""
+        if self._block is None:
+            take = min(BLOCK.size - len(self._header), len(view))
+            self._header += view[:take]
+            if len(self._header) < BLOCK.size:
+                return view[take:]
+            kind, length = BLOCK.unpack(self._header)
+            self._header.clear()
+            if kind == BLOCK_REST:
+                if length:
+                    raise CompressionError(f"rest block with a {length} byte payload")
+                # Everything queued so far must reach `f` before the plain bytes
+                drained = threading.Event()
+                self._queue.put(drained)
+                drained.wait()
+                if self.error:
+                    return view[:0]
+                self._direct = True
+                return view[take:]
+            if length > (2 * BLOCK_SIZE if kind == BLOCK_COMPRESSED else BLOCK_SIZE):
+                raise CompressionError(f"block of {length} bytes")
+            self._kind, self._length, self._block = kind, length, bytearray()
+            view = view[take:]
+        take = min(self._length - len(self._block), len(view))
+        # The caller reuses its buffer, so the block is collected in a copy
+        self._block += view[:take]
+        if len(self._block) == self._length:
+            self._queue.put((self._kind, self._block))
+            self._block = None
+        return view[take:]
+
+    def _write_out(self, data):
+        if self.limit is not None and self.raw + len(data) > self.limit:
+            raise CompressionError(f"data decompresses past the announced {self.limit} bytes")
+        self.f.write(data)
+        self.raw += len(data)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            if self.error:
+                continue
+            kind, payload = item
+            try:
+                self._write_out(self.decompress(payload, BLOCK_SIZE) if kind == BLOCK_COMPRESSED else payload)
+            except Exception as e:
+                self.error = e
+
+    def close(self) -> int:
+        self._queue.put(None)
+        self._thread.join()
+        if self.error:
+            raise CompressionError(str(self.error))
+        return self.raw
+
+
+def pack_text(text: str, codec: str) -> str:
+    return base64.b64encode(CODECS[codec][0](text.encode())).decode()
+
+
+def unpack_text(msg: str) -> str:
+    """A reply that may be "<codec>@<base64>" (see pack_text) -> the plain text."""
+    codec, sep, data = msg.partition("@")
+    if sep and codec in CODECS:
+        return CODECS[codec][1](base64.b64decode(data), MAX_MESSAGE_SIZE).decode()
+    return msg
@@ -0,0 +1,127 @@
+# credentials.py
+"""
+users.txt, loaded once into memory and checked with PBKDF2.
+
+Line formats (one user per line):
+
+    username:pbkdf2_sha256:<iterations>:<salt hex>:<hash hex>
+    username:pbkdf2_sha256_legacy:<iterations>:<salt hex>:<hash hex>:<legacy salt hex>
+    username:<sha256 hex>:<salt hex>                       (original format)
+
+The "legacy" form is an original entry migrated without knowing the
+password: PBKDF2 is run over the old sha256(password + salt) hex digest.
+"""
+import hashlib
+import hmac
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEME = "pbkdf2_sha256"
+LEGACY_SCHEME = "pbkdf2_sha256_legacy"
+# PBKDF2-HMAC-SHA256 rounds for newly hashed passwords (stored per line)
+ITERATIONS = int(os.environ.get("AUTH_PBKDF2_ITERATIONS", 600_000))
+# Password checks run here, so a burst of logins can't tie up the connection handlers
+AUTH_WORKERS = int(os.environ.get("AUTH_WORKERS", 4))
+
+
+def _pbkdf2(secret: bytes, salt: bytes, iterations: int) -> str:
+    return hashlib.pbkdf2_hmac("sha256", secret, salt, iterations).hex()
+
+
+def _legacy_digest(password: str, salt_hex: str) -> str:
+    return hashlib.sha256(password.encode() + bytes.fromhex(salt_hex)).hexdigest()
+
+
+def hash_password(username: str, password: str, iterations: int = ITERATIONS) -> str:
+    """users.txt line (without newline) for a new password."""
+    salt = os.urandom(16)
+    return f"{username}:{SCHEME}:{iterations}:{salt.hex()}:{_pbkdf2(password.encode(), salt, iterations)}"
+
+
+def migrate_line(line: str, iterations: int = ITERATIONS) -> str:
+    """Wrap an original sha256 line in PBKDF2; other lines are returned unchanged."""
+    fields = line.split(":")
+    if len(fields) != 3:
+        return line
+    username, legacy_hash, legacy_salt = fields
+    salt = os.urandom(16)
+    wrapped = _pbkdf2(legacy_hash.encode(), salt, iterations)
+    return f"{username}:{LEGACY_SCHEME}:{iterations}:{salt.hex()}:{wrapped}:{legacy_salt}"
+
+
+def verify_entry(fields, password: str) -> bool:
+    """Check `password` against the stored fields of one user (username removed)."""
+    if len(fields) == 2:
+        legacy_hash, legacy_salt = fields
+        return hmac.compare_digest(_legacy_digest(password, legacy_salt), legacy_hash)
+
+    scheme, iterations, salt, stored = fields[:4]
+    secret = password
+    if scheme == LEGACY_SCHEME:
+        secret = _legacy_digest(password, fields[4])
+    elif scheme != SCHEME:
+        raise ValueError(f"unknown password scheme {scheme}")
+    candidate = _pbkdf2(secret.encode(), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(candidate, stored)
+
+
+class CredentialStore:
+    """
+    Username -> stored fields, read once and reloaded when the file's
+    mtime changes. verify() is safe to call from any thread.
+    """
+
+    def __init__(self, path: str = "users.txt", workers: int = AUTH_WORKERS):
+        self.path = path
+        self._lock = threading.Lock()
+        self._users = {}
+        self._stamp = None
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auth")
+        # Unknown users still pay for one KDF run, so timing doesn't reveal them;
+        # only the iteration count matters, so the entry costs nothing to build
+        self._dummy = [SCHEME, str(ITERATIONS), "00" * 16, "00" * 32]
+
+    def _reload(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            logging.error("%s not found for authentication", self.path)
+            with self._lock:
+                self._users, self._stamp = {}, None
+            return
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            users = {}
+            with open(self.path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    fields = line.split(":")
+                    if len(fields) not in (3, 5, 6):
+                        logging.error("Malformed line in %s", self.path)
+                        continue
+                    users[fields[0]] = fields[1:]
+            self._users, self._stamp = users, stamp
+            logging.info("Loaded %d users from %s", len(users), self.path)
+
+    def verify(self, username: str, password: str) -> bool:
+        self._reload()
+        with self._lock:
+            fields = self._users.get(username)
+        try:
+            if fields is None:
+                verify_entry(self._dummy, password)
+                return False
+            return verify_entry(fields, password)
+        except ValueError as e:
+            logging.error("Bad entry for %s in %s: %s", username, self.path, e)
+            return False
+
+    def submit(self, username: str, password: str):
+        """Run verify() on the auth pool; returns a Future[bool]."""
+        return self._pool.submit(self.verify, username, password)
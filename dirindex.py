@@ -0,0 +1,221 @@
+# dirindex.py
+"""
+In-memory index of the files and folders on the server, so DIR is answered
+without rescanning the disk.
+
+Entries are keyed by their path relative to the server folder ("docs/a.txt")
+and hold name, path, size, mtime, type ("file" or "folder") and the folder
+they are in ("" for the top level). Each folder keeps its children in a
+sorted list, and all paths are kept in one more sorted list in which
+everything below a folder is a contiguous run. An unfiltered page is
+therefore a bisection plus a slice, however large the folder is; filters
+(type, extension, glob) have to scan the folder.
+
+The server updates the index as files are uploaded or deleted and folders
+created or removed; build() rescans the disk at start-up.
+
+Server processes that each keep an index share their changes through a
+journal file (share()): every change is appended to it as a JSON line and
+applied by replaying the journal, so all processes apply the same changes
+in the same order. refresh() catches up with the others' changes.
+"""
+import bisect
+import fnmatch
+import json
+import os
+import posixpath
+import threading
+import time
+
+
+def normalize(path: str) -> str:
+    """Client-supplied path -> index key ("" is the top folder)."""
+    path = posixpath.normpath(path.replace(os.sep, "/")).strip("/")
+    return "" if path == "." else path
+
+
+def _insert(items: list, value):
+    index = bisect.bisect_left(items, value)
+    if index == len(items) or items[index] != value:
+        items.insert(index, value)
+
+
+def _discard(items: list, value):
+    index = bisect.bisect_left(items, value)
+    if index < len(items) and items[index] == value:
+        del items[index]
+
+
+class DirectoryIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}          # path -> entry dict
+        self._children = {"": []}   # folder path -> sorted child names
+        self._paths = []            # every path, sorted
+        self._journal = None
+        self._journal_pos = 0
+
+    def build(self, root: str, extra=()):
+        """
+        Index everything under `root` (skipping dot-names, which hold the
+        server's own state) plus `extra`, an iterable of (path, size, mtime)
+        for files that aren't stored as plain files.
+        """
+        with self._lock:
+            self._entries = {}
+            self._children = {"": []}
+            self._paths = []
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+                folder = normalize(os.path.relpath(dirpath, root))
+                for name in dirnames:
+                    st = os.stat(os.path.join(dirpath, name))
+                    self._add(posixpath.join(folder, name), 0, st.st_mtime, "folder")
+                for name in filenames:
+                    if name.startswith("."):
+                        continue
+                    try:
+                        st = os.stat(os.path.join(dirpath, name))
+                    except OSError:
+                        continue
+                    self._add(posixpath.join(folder, name), st.st_size, st.st_mtime, "file")
+            for path, size, mtime in extra:
+                self._add(normalize(path), size, mtime, "file")
+
+    def _add(self, path: str, size: int, mtime: float, kind: str):
+        folder, name = posixpath.split(path)
+        if folder and folder not in self._entries:
+            self._add(folder, 0, mtime, "folder")
+        self._entries[path] = {
+            "name": name,
+            "path": path,
+            "size": size,
+            "mtime": int(mtime),
+            "type": kind,
+            "folder": folder,
+        }
+        _insert(self._children.setdefault(folder, []), name)
+        if kind == "folder":
+            self._children.setdefault(path, [])
+        _insert(self._paths, path)
+
+    def add_file(self, path: str, size: int, mtime: float = None):
+        self._change(["file", normalize(path), size, time.time() if mtime is None else mtime])
+
+    def add_folder(self, path: str, mtime: float = None):
+        self._change(["folder", normalize(path), time.time() if mtime is None else mtime])
+
+    def remove(self, path: str):
+        """Drop a file, or a folder and everything indexed below it."""
+        self._change(["remove", normalize(path)])
+
+    def _change(self, change: list):
+        if self._journal is None:
+            with self._lock:
+                self._apply(change)
+            return
+        line = (json.dumps(change, separators=(",", ":")) + "\n").encode()
+        # One O_APPEND write per line, so lines from several processes don't interleave
+        fd = os.open(self._journal, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self.refresh()
+
+    def _apply(self, change: list):
+        op, path = change[0], change[1]
+        if op == "file":
+            self._add(path, change[2], change[3], "file")
+        elif op == "folder":
+            self._add(path, 0, change[2], "folder")
+        else:
+            self._remove(path)
+
+    def _remove(self, path: str):
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return
+        _discard(self._children.get(entry["folder"], []), entry["name"])
+        _discard(self._paths, path)
+        if entry["type"] == "folder":
+            del self._children[path]
+            start, end = self._subtree(path)
+            for child in self._paths[start:end]:
+                self._entries.pop(child, None)
+                self._children.pop(child, None)
+            del self._paths[start:end]
+
+    def share(self, journal: str):
+        """
+        Share changes through the `journal` file from now on. Call it after
+        build() and before starting the other processes; it starts the
+        journal afresh.
+        """
+        with self._lock:
+            with open(journal, "wb"):
+                pass
+            self._journal = journal
+            self._journal_pos = 0
+
+    def refresh(self):
+        """Apply the journal lines added since the last call (by any process)."""
+        if self._journal is None or os.path.getsize(self._journal) == self._journal_pos:
+            return
+        with self._lock:
+            with open(self._journal, "rb") as f:
+                f.seek(self._journal_pos)
+                data = f.read()
+            # A line still being written is picked up next time
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                self._apply(json.loads(line))
+            self._journal_pos += end
+
+    def get(self, path: str):
+        return self._entries.get(normalize(path))
+
+    def _subtree(self, folder: str):
+        """Range of self._paths holding everything below `folder`."""
+        if not folder:
+            return 0, len(self._paths)
+        # "0" is the character right after "/"
+        return bisect.bisect_left(self._paths, folder + "/"), bisect.bisect_left(self._paths, folder + "0")
+
+    def page(self, folder: str = "", recursive: bool = False, offset: int = 0, limit: int = 100,
+             kind: str = None, ext: str = None, match: str = None):
+        """
+        (entries, total) for one page of `folder`, sorted by path. With
+        `recursive`, everything below the folder is listed. kind, ext and
+        match (a glob on the name) filter the listing; total counts the
+        entries that pass. Raises KeyError for an unknown folder.
+        """
+        folder = normalize(folder)
+        with self._lock:
+            if folder not in self._children:
+                raise KeyError(folder)
+            if recursive:
+                keys = self._paths
+                lo, hi = self._subtree(folder)
+                path_of = keys.__getitem__
+            else:
+                keys = self._children[folder]
+                lo, hi = 0, len(keys)
+                path_of = lambda i: posixpath.join(folder, keys[i])
+
+            if not (kind or ext or match):
+                page = range(lo + offset, min(lo + offset + limit, hi))
+                return [dict(self._entries[path_of(i)]) for i in page], hi - lo
+
+            ext = ext.lower() if ext else None
+            matched = []
+            for i in range(lo, hi):
+                entry = self._entries[path_of(i)]
+                if kind and entry["type"] != kind:
+                    continue
+                if ext and not (entry["type"] == "file" and entry["name"].lower().endswith(ext)):
+                    continue
+                if match and not fnmatch.fnmatch(entry["name"], match):
+                    continue
+                matched.append(entry)
+            return [dict(e) for e in matched[offset:offset + limit]], len(matched)
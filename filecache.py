@@ -0,0 +1,154 @@
+# filecache.py
+"""
+Read cache for files that are downloaded again and again.
+
+Files up to SMALL_FILE bytes are held in memory; larger ones are kept open
+and mmap'd read-only, one mapping shared by every download of the file.
+The cache holds at most a byte budget of them (a file over a quarter of it
+is never cached, so one huge download can't flush everything else) and
+evicts the least recently used first.
+
+A cached file is handed out as a CachedFile. Reads return memoryview
+slices of the cached bytes without copying them, which helps the paths
+that need the data in user space (checksums, compression, throttling);
+for a large file fileno() is the cached descriptor, so plain sends still
+use sendfile but skip the open().
+
+Entries are only used while the file keeps the inode, size and mtime it
+had when cached (checksum.stat_key); the server also invalidates a path
+when it is uploaded over or deleted. Evicted or invalidated entries stay
+alive until the downloads using them finish.
+"""
+import io
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+# Bytes of file data the cache may hold; 0 turns it off
+CACHE_BYTES = int(os.environ.get("SERVER_CACHE_BYTES", 256 * 1024 * 1024))
+# Files up to this size are read into memory, larger ones mmap'd
+SMALL_FILE = int(os.environ.get("SERVER_CACHE_SMALL", 1024 * 1024))
+
+
+def _key(st: os.stat_result):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class _Entry:
+    """One cached file; the descriptor closes once nothing refers to the entry."""
+
+    def __init__(self, key, data, fd=None):
+        self.key = key
+        self.size = key[1]
+        self.data = data            # bytes or mmap
+        self.fd = fd
+
+    def __del__(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+
+class CachedFile:
+    """Read-only file object over a cache entry, with its own position."""
+
+    def __init__(self, entry: _Entry, hit: bool):
+        self._entry = entry
+        self._view = memoryview(entry.data)
+        self._pos = 0
+        self.hit = hit
+
+    def read(self, n: int = -1):
+        end = len(self._view) if n is None or n < 0 else min(self._pos + n, len(self._view))
+        data = self._view[self._pos:end]
+        self._pos = max(end, self._pos)
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def fileno(self) -> int:
+        if self._entry.fd is None:
+            raise io.UnsupportedOperation("cached in memory; no file descriptor")
+        return self._entry.fd
+
+    def close(self):
+        self._view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FileCache:
+    def __init__(self, budget: int = CACHE_BYTES, small_file: int = SMALL_FILE):
+        self.budget = budget
+        self.small_file = small_file
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # path -> _Entry
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def open(self, path: str):
+        """
+        A CachedFile for `path` (its `hit` says whether it was cached
+        already), or None if the file isn't cacheable; open it normally then.
+        Raises OSError if the file can't be read.
+        """
+        if not self.budget:
+            return None
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry.key == _key(st):
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return CachedFile(entry, True)
+            self.misses += 1
+        if st.st_size > self.budget // 4:
+            return None
+
+        entry = self._load(path)
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old:
+                self.bytes -= old.size
+            self._entries[path] = entry
+            self.bytes += entry.size
+            while self.bytes > self.budget:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+        return CachedFile(entry, False)
+
+    def _load(self, path: str) -> _Entry:
+        # The key comes from the descriptor actually read, not the earlier stat
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            if st.st_size > self.small_file:
+                return _Entry(_key(st), mmap.mmap(fd, st.st_size, access=mmap.ACCESS_READ), fd)
+        except BaseException:
+            os.close(fd)
+            raise
+        with os.fdopen(fd, "rb") as f:
+            return _Entry(_key(st), f.read())
+
+    def invalidate(self, path: str):
+        """Drop `path`, or everything below it if it is a folder."""
+        prefix = path.rstrip(os.sep) + os.sep
+        with self._lock:
+            for cached in [p for p in self._entries if p == path or p.startswith(prefix)]:
+                self.bytes -= self._entries.pop(cached).size
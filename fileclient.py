@@ -0,0 +1,765 @@
+# fileclient.py
+"""
+Importable, non-interactive client: no input(), getpass or print. Methods
+return results and raise ClientError subclasses; a FileClient keeps a pool
+of authenticated connections and reuses them across calls.
+
+    with FileClient("localhost", 4450, "naibys", "admin123") as fc:
+        fc.upload("song.mp3", overwrite=True)
+        fc.download("song.mp3", "downloads")
+        print(fc.list())
+
+Batch CLI (transfers run concurrently over the connection pool):
+
+    python fileclient.py [--host H] [--port P] --username U [--password P]
+                         [-j N] [--overwrite] [--dest DIR]
+                         {upload,download,delete,list} [targets ...] [-r]
+
+upload takes files, directories (their files) and glob patterns; download
+takes names or glob patterns matched against the server listing; list
+takes an optional folder (-r lists everything below it). The password can
+also come from FILECLIENT_PASSWORD.
+"""
+import argparse
+import contextlib
+import fnmatch
+import glob
+import hashlib
+import io
+import json
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import checksum
+import compression
+from checksum import HashingReader, HashingWriter
+from protocol import PROTO_FRAMED, Multiplexer, ProtocolError, TextChannel, open_channel, split_options
+from storage import CHUNK_SIZE
+from transfer import OffsetWriter, SinkWriter, tune_socket
+
+try:
+    from analytics import record_transfer
+except Exception:
+    def record_transfer(*args, **kwargs):
+        pass
+
+
+# Parallel transfer ranges are multiples of this
+RANGE_ALIGN = 1024 * 1024
+
+
+class ClientError(Exception):
+    pass
+
+
+class AuthError(ClientError):
+    pass
+
+
+class ServerError(ClientError):
+    """The server answered ERR@<message>."""
+
+
+class FileExistsOnServer(ServerError):
+    pass
+
+
+class ChecksumMismatch(ClientError):
+    """The data failed its end-to-end checksum and was discarded."""
+
+
+class ServerBusy(ServerError):
+    """ERR@BUSY@<seconds>: the server is saturated; retry after `retry_after`."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Server busy, retry after {retry_after:g}s")
+        self.retry_after = retry_after
+
+
+def _error(msg: str) -> ServerError:
+    parts = msg.split("@")
+    if parts[0] == "BUSY":
+        try:
+            return ServerBusy(float(parts[1]) if len(parts) > 1 else 1.0)
+        except ValueError:
+            return ServerBusy(1.0)
+    return ServerError(msg)
+
+
+def _reply(chan):
+    """Next (status, message) from the server."""
+    parts = chan.recv_msg()
+    if not parts:
+        raise ClientError("Server closed the connection")
+    return parts[0], "@".join(parts[1:])
+
+
+def _expect_ok(chan):
+    status, msg = _reply(chan)
+    if status != "OK":
+        raise _error(msg)
+    return msg
+
+
+def login(sock, username: str, password: str, framing: bool = True):
+    """Run the AUTH handshake on a connected socket; returns the channel."""
+    chan = TextChannel(sock)
+    while True:
+        parts = chan.recv_msg()
+        if not parts:
+            raise AuthError("Server closed the connection during login")
+        if parts[0] == "ERR":
+            if len(parts) > 1 and parts[1] == "BUSY":
+                raise _error("@".join(parts[1:]))
+            raise AuthError("@".join(parts[1:]))
+        if parts[0] != "AUTH" or len(parts) < 2:
+            raise AuthError(f"Unexpected message during login: {'@'.join(parts)}")
+
+        step = parts[1]
+        if step == "USERNAME":
+            if framing and chan.mode != PROTO_FRAMED:
+                chan.send_msg("PROTO", PROTO_FRAMED)
+                reply = chan.recv_msg()
+                if not reply or reply[0] != "PROTO" or len(reply) < 2:
+                    raise AuthError(f"Unexpected reply to PROTO: {reply}")
+                chan = open_channel(sock, reply[1])
+            chan.send_msg(username)
+        elif step == "PASSWORD":
+            chan.send_msg(password)
+        elif step == "OK":
+            chan.recv_msg()         # welcome line
+            return chan
+        elif step == "FAIL":
+            raise AuthError("Invalid username or password")
+        else:
+            raise AuthError(f"Unexpected AUTH step {step}")
+
+
+def _confirm(chan, name: str, overwrite) -> str:
+    """
+    Message of the OK that starts a transfer, answering the server's "file
+    exists, overwrite?" question first if it asks (see upload's overwrite).
+    """
+    status, msg = _reply(chan)
+    if status == "ERR" and "Overwrite" in msg:
+        allowed = overwrite(name) if callable(overwrite) else overwrite
+        chan.send_msg("y" if allowed else "n")
+        status, msg = _reply(chan)
+        if status == "OK" and "cancelled" in msg:
+            raise FileExistsOnServer(f"{name} already exists on the server")
+    if status != "OK":
+        raise _error(msg)
+    return msg
+
+
+def _codec(chan, name: str, codec: str):
+    """What to ask for with zip=: compression only runs on framed connections."""
+    return compression.choose(name, codec) if chan.mode == PROTO_FRAMED else None
+
+
+def upload(chan, path: str, name: str = None, overwrite: bool = False, resume: bool = False,
+           checksum_algorithm: str = "sha256", codec: str = "auto") -> dict:
+    """
+    Upload `path` (as `name`, default its basename). overwrite may be a bool
+    or a callable(name) -> bool asked only if the file exists on the server.
+    The server checks the data against `checksum_algorithm` (None: no check).
+    `codec` ("auto", a name in compression.CODECS or None) compresses the data.
+    """
+    name = name or os.path.basename(path)
+    filesize = os.path.getsize(path)
+    args = [name, str(filesize)]
+    if resume:
+        args.append("resume")
+    if checksum_algorithm:
+        args.append(f"sum={checksum_algorithm}")
+    codec = _codec(chan, name, codec)
+    if codec:
+        args.append(f"zip={codec}")
+    chan.send_msg("UPLOAD", *args)
+    msg = _confirm(chan, name, overwrite)
+
+    ready, options = split_options(msg.split("@"))
+    offset = int(ready[1]) if len(ready) > 1 else 0
+    codec = options.get("zip")
+    hasher = checksum.new(checksum_algorithm) if checksum_algorithm else None
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        source = HashingReader(f, hasher) if hasher else f
+        if codec:
+            blocks = compression.BlockCompressor(source, offset, filesize - offset, codec)
+            wire = chan.send_blocks(blocks)
+            sent, io_path = blocks.raw, "compressed"
+        else:
+            sent, io_path = chan.send_file(source, offset, filesize - offset)
+            wire = sent
+    end = time.perf_counter()
+    if hasher:
+        chan.send_msg("SUM", checksum_algorithm, hasher.hexdigest())
+    note = f"resumed_from={offset}" if offset else ""
+    record_transfer("client", "UPLOAD", name, sent, start, end, note=note, io_path=io_path)
+    status, msg = _reply(chan)
+    if status != "OK":
+        if msg.startswith("Checksum mismatch"):
+            raise ChecksumMismatch(f"{name}: {msg}")
+        raise _error(msg)
+    return {"name": name, "bytes": sent, "offset": offset, "seconds": end - start,
+            "checksum": hasher.hexdigest() if hasher else None, "compression": codec, "wire_bytes": wire}
+
+
+def download(chan, name: str, dest: str = ".", checksum_algorithm: str = "sha256",
+             codec: str = "auto") -> dict:
+    """
+    Download `name` into the directory `dest` via <name>.part, continuing
+    from a .part file left by an earlier interrupted download. The data is
+    checked against the server's `checksum_algorithm` digest (None: no check)
+    and sent compressed with `codec` if the server agrees.
+    """
+    os.makedirs(dest, exist_ok=True)
+    filepath = os.path.join(dest, name)
+    part_path = filepath + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    args = [name, str(offset)] if offset else [name]
+    if checksum_algorithm:
+        args.append(f"sum={checksum_algorithm}")
+    codec = _codec(chan, name, codec)
+    if codec:
+        args.append(f"zip={codec}")
+    chan.send_msg("DOWNLOAD", *args)
+    status, msg = _reply(chan)
+    if status != "OK":
+        error = _error(msg)
+        if offset and not isinstance(error, ServerBusy):
+            os.remove(part_path)
+        raise error
+
+    sizes, options = split_options(msg.split("@"))
+    remaining = int(sizes[0])
+    codec = options.get("zip")
+    chan.send_msg("READY")
+    hasher = checksum.new(checksum_algorithm) if checksum_algorithm else None
+    start = time.perf_counter()
+    with open(part_path, "r+b" if offset else "wb") as f:
+        f.seek(offset)
+        sink = HashingWriter(f, hasher) if hasher else f
+        if codec:
+            sink = compression.DecompressingWriter(sink, codec, remaining)
+            wire = chan.recv_file(sink, compression.wire_bound(remaining))
+            try:
+                received = sink.close()
+            except compression.CompressionError as e:
+                f.close()
+                os.remove(part_path)
+                raise ClientError(f"{name}: bad compressed data ({e}), download discarded")
+        else:
+            wire = received = chan.recv_file(sink, remaining)
+    end = time.perf_counter()
+    if received < remaining:
+        record_transfer("client", "DOWNLOAD", name, received, start, end, status="PARTIAL")
+        raise ClientError(f"Download of {name} interrupted at {offset + received} bytes")
+
+    if hasher:
+        trailer = chan.recv_msg() or [""]
+        if trailer[0] != "SUM" or trailer[-1] != hasher.hexdigest():
+            os.remove(part_path)
+            record_transfer("client", "DOWNLOAD", name, received, start, end, status="CORRUPT")
+            raise ChecksumMismatch(f"{name}: {checksum_algorithm} mismatch, download discarded")
+
+    os.replace(part_path, filepath)
+    note = f"resumed_from={offset}" if offset else ""
+    record_transfer("client", "DOWNLOAD", name, received, start, end, note=note)
+    return {"name": name, "bytes": received, "offset": offset, "seconds": end - start, "path": filepath,
+            "checksum": hasher.hexdigest() if hasher else None, "compression": codec, "wire_bytes": wire}
+
+
+def download_ranges(chan, name: str, ranges, sink, checksum_algorithm: str = "sha256") -> list:
+    """
+    Stream the byte ranges [(offset, length), ...] of `name` to
+    sink(offset, data) without fetching the rest of the file. `data` may be
+    a view of a reused buffer; copy it to keep it. Returns the ranges as the
+    server clipped them to the file. A checksum covers all the ranges in
+    order and is checked after the last one reached the sink.
+    """
+    spec = ",".join(f"{offset}:{length}" for offset, length in ranges)
+    args = [name, f"ranges={spec}"]
+    if checksum_algorithm:
+        args.append(f"sum={checksum_algorithm}")
+    chan.send_msg("DOWNLOAD", *args)
+    _, options = split_options(_expect_ok(chan).split("@"))
+    served = [tuple(map(int, r.split(":"))) for r in options.get("ranges", "").split(",") if r]
+    chan.send_msg("READY")
+
+    hasher = checksum.new(checksum_algorithm) if checksum_algorithm else None
+    start = time.perf_counter()
+    received = 0
+    for offset, length in served:
+        writer = SinkWriter(sink, offset)
+        got = chan.recv_file(HashingWriter(writer, hasher) if hasher else writer, length)
+        received += got
+        if got < length:
+            record_transfer("client", "DOWNLOAD", name, received, start, time.perf_counter(), status="PARTIAL")
+            raise ClientError(f"Range download of {name} interrupted at byte {offset + got}")
+    end = time.perf_counter()
+    if hasher:
+        trailer = chan.recv_msg() or [""]
+        if trailer[0] != "SUM" or trailer[-1] != hasher.hexdigest():
+            record_transfer("client", "DOWNLOAD", name, received, start, end, status="CORRUPT")
+            raise ChecksumMismatch(f"{name}: {checksum_algorithm} mismatch in the ranges received")
+    record_transfer("client", "DOWNLOAD", name, received, start, end, note=f"ranges={len(served)}")
+    return served
+
+
+def dedup_upload(chan, path: str, name: str = None, overwrite: bool = False,
+                 chunk_size: int = CHUNK_SIZE) -> dict:
+    """
+    Upload `path` into the server's chunk store: the SHA-256 digest of every
+    chunk goes first, then only the chunks the server doesn't have yet.
+    overwrite is as for upload().
+    """
+    name = name or os.path.basename(path)
+    filesize = os.path.getsize(path)
+    chan.send_msg("DEDUP_UPLOAD", name, str(filesize), str(chunk_size))
+    _confirm(chan, name, overwrite)
+
+    start = time.perf_counter()
+    digests = []
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digests.append(hashlib.sha256(chunk).digest())
+    digest_list = b"".join(digests)
+    chan.send_file(io.BytesIO(digest_list), 0, len(digest_list))
+
+    bitmap = int(_expect_ok(chan).split("@")[1], 16)
+    sent = 0
+    io_path = "sendfile"
+    with open(path, "rb") as f:
+        for index in range(len(digests)):
+            if bitmap >> index & 1:
+                offset = index * chunk_size
+                n, used = chan.send_file(f, offset, min(chunk_size, filesize - offset))
+                sent += n
+                if used != "sendfile":
+                    io_path = used
+    end = time.perf_counter()
+
+    skipped = len(digests) - bin(bitmap).count("1")
+    record_transfer("client", "UPLOAD", name, sent, start, end, note=f"dedup;skipped_chunks={skipped}",
+                    io_path=io_path)
+    _expect_ok(chan)
+    return {"name": name, "bytes": sent, "size": filesize, "chunks": len(digests),
+            "skipped_chunks": skipped, "seconds": end - start}
+
+
+def split_ranges(size: int, count: int):
+    """Split [0, size) into at most `count` (offset, length) ranges."""
+    step = -(-size // max(count, 1))
+    step = max(RANGE_ALIGN, -(-step // RANGE_ALIGN) * RANGE_ALIGN)
+    return [(offset, min(step, size - offset)) for offset in range(0, size, step)] or [(0, 0)]
+
+
+def _run_ranges(open_connection, ranges, transfer_range):
+    """
+    Run transfer_range(chan, offset, length) for every range at once, each
+    on a channel from open_connection() (a context manager). Raises a
+    ClientError naming every range that failed.
+    """
+    errors = []
+
+    def run(offset, length):
+        try:
+            with open_connection() as part:
+                transfer_range(part, offset, length)
+        except (OSError, ValueError, ProtocolError, ClientError) as e:
+            errors.append(f"range at {offset}: {e}")
+
+    threads = [threading.Thread(target=run, args=r) for r in ranges]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise ClientError("; ".join(errors))
+
+
+def parallel_upload(open_request, open_connection, path: str, name: str = None, overwrite: bool = False,
+                    streams: int = 4) -> dict:
+    """
+    Upload `path` as `streams` byte ranges at once; the server writes each
+    range in place and renames the file on commit. open_request() and
+    open_connection() are context managers giving a channel for one request:
+    the first for the short start and commit requests, the second for each
+    range, on a connection of its own. overwrite is as for upload().
+    """
+    name = name or os.path.basename(path)
+    filesize = os.path.getsize(path)
+    with open_request() as chan:
+        chan.send_msg("UPLOAD_INIT", name, str(filesize))
+        upload_id = _confirm(chan, name, overwrite)
+
+    def send_range(part, offset, length):
+        part.send_msg("UPLOAD_PART", upload_id, str(offset), str(length))
+        _expect_ok(part)
+        with open(path, "rb") as f:
+            part.send_file(f, offset, length)
+        _expect_ok(part)
+
+    ranges = split_ranges(filesize, streams)
+    start = time.perf_counter()
+    _run_ranges(open_connection, ranges, send_range)
+    with open_request() as chan:
+        chan.send_msg("UPLOAD_COMMIT", upload_id)
+        _expect_ok(chan)
+    end = time.perf_counter()
+
+    record_transfer("client", "UPLOAD", name, filesize, start, end, note=f"streams={len(ranges)}")
+    return {"name": name, "bytes": filesize, "streams": len(ranges), "seconds": end - start}
+
+
+def parallel_download(open_request, open_connection, name: str, dest: str = ".", streams: int = 4) -> dict:
+    """
+    Download `name` into the directory `dest` as `streams` byte ranges at
+    once, each written in place into a preallocated file. open_request and
+    open_connection are as for parallel_upload().
+    """
+    # DOWNLOAD answers with the size first; decline the transfer itself
+    with open_request() as chan:
+        chan.send_msg("DOWNLOAD", name)
+        filesize = int(split_options(_expect_ok(chan).split("@"))[0][0])
+        chan.send_msg("CANCEL")
+
+    os.makedirs(dest, exist_ok=True)
+    filepath = os.path.join(dest, name)
+    with open(filepath, "wb") as f:
+        f.truncate(filesize)
+
+    def fetch_range(part, offset, length):
+        part.send_msg("DOWNLOAD", name, str(offset), str(length))
+        _expect_ok(part)
+        part.send_msg("READY")
+        fd = os.open(filepath, os.O_WRONLY)
+        try:
+            received = part.recv_file(OffsetWriter(fd, offset), length)
+        finally:
+            os.close(fd)
+        if received != length:
+            raise ClientError(f"short range at {offset} ({received} of {length} bytes)")
+
+    ranges = split_ranges(filesize, streams)
+    start = time.perf_counter()
+    _run_ranges(open_connection, ranges, fetch_range)
+    end = time.perf_counter()
+
+    record_transfer("client", "DOWNLOAD", name, filesize, start, end, note=f"streams={len(ranges)}")
+    return {"name": name, "bytes": filesize, "streams": len(ranges), "seconds": end - start, "path": filepath}
+
+
+class FileClient:
+    """
+    Pool of up to `connections` authenticated connections. Each call checks
+    one out for its duration; a connection that failed mid-request is closed
+    instead of being reused. Calls answered ERR@BUSY are retried up to
+    `busy_retries` times after the delay the server asks for. Transfers are
+    verified end to end with `checksum` (an algorithm in checksum.py, or None)
+    and compressed with `compression` ("auto", a codec or None) where it helps.
+    """
+
+    def __init__(self, host="localhost", port=4450, username=None, password=None,
+                 connections=4, framing=True, timeout=None, busy_retries=3, checksum="sha256",
+                 compression="auto"):
+        self.addr = (host, port)
+        self.username = username
+        self.password = password
+        self.connections = connections
+        self.framing = framing
+        self.timeout = timeout
+        self.busy_retries = busy_retries
+        self.checksum = checksum
+        self.compression = compression
+        self._idle = queue.LifoQueue()
+        self._open = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tune_socket(sock)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.addr)
+            chan = login(sock, self.username, self.password, self.framing)
+        except BaseException:
+            sock.close()
+            raise
+        if chan.mode != PROTO_FRAMED:
+            return chan
+        # Framed connections need a reader thread routing replies to streams
+        mux = Multiplexer(chan)
+        threading.Thread(target=mux.run, daemon=True).start()
+        return mux
+
+    @contextlib.contextmanager
+    def _channel(self):
+        """A request channel (stream) on a pooled connection."""
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._open < self.connections:
+                    self._open += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    session = self._connect()
+                except BaseException:
+                    with self._lock:
+                        self._open -= 1
+                    raise
+            else:
+                session = self._idle.get()
+
+        stream = session.open_stream()
+        try:
+            yield stream
+        except ServerError:
+            # An ERR reply leaves the connection in step; anything else may not
+            self._idle.put(session)
+            raise
+        except BaseException:
+            self._discard(session)
+            raise
+        else:
+            self._idle.put(session)
+        finally:
+            stream.release()
+
+    @contextlib.contextmanager
+    def _extra_channel(self):
+        """A request channel on a connection of its own, outside the pool (parallel ranges)."""
+        session = self._connect()
+        stream = session.open_stream()
+        try:
+            yield stream
+        finally:
+            stream.release()
+            chan = session.chan if isinstance(session, Multiplexer) else session
+            chan.close()
+
+    def _discard(self, session):
+        with self._lock:
+            self._open -= 1
+        chan = session.chan if isinstance(session, Multiplexer) else session
+        try:
+            chan.close()
+        except OSError:
+            pass
+
+    def _call(self, func, *args):
+        """func(stream, *args) on a pooled connection, retrying while busy."""
+        for attempt in range(self.busy_retries + 1):
+            try:
+                with self._channel() as chan:
+                    return func(chan, *args)
+            except ServerBusy as e:
+                if attempt == self.busy_retries:
+                    raise
+                time.sleep(e.retry_after)
+
+    def _request(self, *msg) -> str:
+        def request(chan):
+            chan.send_msg(*msg)
+            return _expect_ok(chan)
+        return self._call(request)
+
+    # ----- operations -----
+
+    def upload(self, path, name=None, overwrite=False, resume=False) -> dict:
+        return self._call(upload, path, name, overwrite, resume, self.checksum, self.compression)
+
+    def download(self, name, dest=".") -> dict:
+        return self._call(download, name, dest, self.checksum, self.compression)
+
+    def dedup_upload(self, path, name=None, overwrite=False) -> dict:
+        return self._call(dedup_upload, path, name, overwrite)
+
+    def parallel_upload(self, path, name=None, overwrite=False, streams=4) -> dict:
+        return parallel_upload(self._channel, self._extra_channel, path, name, overwrite, streams)
+
+    def parallel_download(self, name, dest=".", streams=4) -> dict:
+        return parallel_download(self._channel, self._extra_channel, name, dest, streams)
+
+    def read_ranges(self, name, ranges, sink=None):
+        """
+        Byte ranges [(offset, length), ...] of `name`: streamed to
+        sink(offset, data) if given (returns the clipped ranges), otherwise
+        returned as [(offset, bytes)].
+        """
+        if sink is not None:
+            return self._call(download_ranges, name, ranges, sink, self.checksum)
+        # Ranges arrive in order, so one buffer can be cut up afterwards
+        buffer = bytearray()
+        served = self._call(download_ranges, name, ranges, lambda offset, data: buffer.extend(data),
+                            self.checksum)
+        pieces, start = [], 0
+        for offset, length in served:
+            pieces.append((offset, bytes(buffer[start:start + length])))
+            start += length
+        return pieces
+
+    def delete(self, name):
+        self._request("DELETE", name)
+
+    def entries(self, path="", recursive=False, **filters):
+        """
+        Entry dicts (name, path, size, mtime, type, folder) in `path`,
+        fetched a page at a time. filters: type="file"|"folder", ext, match.
+        """
+        options = [f"path={path}", "limit=250"] + (["recursive=1"] if recursive else [])
+        options += [f"{key}={value}" for key, value in filters.items() if value]
+        if self.compression:
+            options.append(f"zip={self.compression}")
+        def request(chan, offset):
+            chan.send_msg("DIR", *options, f"offset={offset}")
+            # Decoded while the connection is checked out: a page that doesn't
+            # parse leaves it out of step, so it is closed instead of reused
+            return json.loads(compression.unpack_text(_expect_ok(chan)))
+
+        offset = 0
+        while offset is not None:
+            page = self._call(request, offset)
+            yield from page["entries"]
+            offset = page["next"]
+
+    def list(self, path="", recursive=False):
+        """Paths of everything in `path` (below it, with recursive)."""
+        return [entry["path"] for entry in self.entries(path, recursive)]
+
+    def subfolder(self, action, name):
+        self._request("SUBFOLDER", action, name)
+
+    def stats(self) -> dict:
+        return json.loads(self._request("STATS"))
+
+    def map(self, func, items, workers=None):
+        """
+        Run func(item) for every item on a worker pool sized to the connection
+        pool. Returns [(item, result or the exception it raised)] in order.
+        """
+        def run(item):
+            try:
+                return item, func(item)
+            except (OSError, ClientError, ProtocolError, ValueError) as e:
+                return item, e
+
+        with ThreadPoolExecutor(max_workers=workers or self.connections) as pool:
+            return list(pool.map(run, items))
+
+    def upload_many(self, paths, overwrite=False, workers=None):
+        return self.map(lambda p: self.upload(p, overwrite=overwrite), paths, workers)
+
+    def download_many(self, names, dest=".", workers=None):
+        return self.map(lambda n: self.download(n, dest), names, workers)
+
+    def close(self):
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                session.open_stream().send_msg("LOGOUT")
+            except OSError:
+                pass
+            self._discard(session)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def expand_paths(targets):
+    """Files named directly, the files inside named directories, and glob matches."""
+    paths = []
+    for target in targets:
+        matches = glob.glob(target) if glob.has_magic(target) else [target]
+        for match in sorted(matches):
+            if os.path.isdir(match):
+                paths.extend(sorted(
+                    os.path.join(match, n) for n in os.listdir(match)
+                    if os.path.isfile(os.path.join(match, n))
+                ))
+            else:
+                paths.append(match)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch file transfer client")
+    parser.add_argument("command", choices=["upload", "download", "delete", "list"])
+    parser.add_argument("targets", nargs="*")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=4450)
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", default=os.environ.get("FILECLIENT_PASSWORD"))
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="connections / concurrent transfers")
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--dest", default="downloads")
+    parser.add_argument("--text", action="store_true", help="use the text protocol instead of framing")
+    parser.add_argument("--checksum", default="sha256", choices=sorted(checksum.ALGORITHMS) + ["none"])
+    parser.add_argument("--compression", default="auto", choices=["auto", "none"] + sorted(compression.CODECS))
+    parser.add_argument("-r", "--recursive", action="store_true", help="list: include subfolders")
+    args = parser.parse_args()
+    if args.password is None:
+        parser.error("--password or FILECLIENT_PASSWORD is required")
+
+    failed = 0
+    with FileClient(args.host, args.port, args.username, args.password,
+                    connections=args.jobs, framing=not args.text,
+                    checksum=None if args.checksum == "none" else args.checksum,
+                    compression=None if args.compression == "none" else args.compression) as fc:
+        try:
+            if args.command == "list":
+                for name in fc.list(args.targets[0] if args.targets else "", args.recursive):
+                    print(name)
+                return 0
+
+            if args.command == "upload":
+                results = fc.upload_many(expand_paths(args.targets), overwrite=args.overwrite)
+            else:
+                names = args.targets
+                if any(glob.has_magic(t) for t in names) or not names:
+                    listing = [entry["path"] for entry in fc.entries(type="file")]
+                    patterns = names or ["*"]
+                    names = [n for n in listing if any(fnmatch.fnmatch(n, p) for p in patterns)]
+                if args.command == "download":
+                    results = fc.download_many(names, args.dest)
+                else:
+                    results = fc.map(fc.delete, names)
+        except ClientError as e:
+            print(f"error: {e}", file=sys.stderr)
+            return 1
+
+    for item, result in results:
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"FAIL {item}: {result}")
+        elif isinstance(result, dict):
+            rate = result["bytes"] / result["seconds"] / (1024 * 1024) if result["seconds"] else 0.0
+            print(f"OK   {item} ({result['bytes']} bytes, {rate:.1f} MB/s)")
+        else:
+            print(f"OK   {item}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+# filelocks.py
+"""
+Named locks shared by every thread and every worker process of the server.
+
+Each name maps to a lock file in one directory, held with flock(). A flock
+belongs to the open file, so two opens of the same lock file exclude each
+other even inside one process, and the kernel drops the lock when its
+holder exits, so a crashed worker can't leave a name locked. Lock files
+are never removed (unlinking a lock file someone may be opening is racy);
+they are empty.
+
+Without fcntl (Windows) the locks fall back to threading locks, which is
+enough for a single server process.
+"""
+import contextlib
+import hashlib
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FileLocks:
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._local = {}            # name -> threading.Lock, without fcntl
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(name.encode()).hexdigest() + ".lock")
+
+    @contextlib.contextmanager
+    def hold(self, name: str, wait: bool = True):
+        """
+        Hold `name` for the with block, which gets True. With wait=False the
+        block gets False straight away if someone else holds it.
+        """
+        if fcntl is None:
+            with self._lock:
+                lock = self._local.setdefault(name, threading.Lock())
+            if not lock.acquire(wait):
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                lock.release()
+            return
+
+        fd = os.open(self._path(name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
@@ -0,0 +1,273 @@
+# loadgen.py
+"""
+Scripted load generator: many simulated users, each on its own connection,
+running a weighted mix of UPLOAD / DOWNLOAD / DIR / DELETE through the
+client.py protocol code (no prompts), then reporting throughput, latency
+percentiles and errors per operation.
+
+Usage:
+  python loadgen.py [--host H] [--port P] [--users N] [--duration S]
+                    [--mix upload=1,download=3,dir=5,delete=1] [--sizes 25,50]
+                    [--username U --password P] [--start-server [--engine E] [--processes N]]
+                    [--json results.json]
+
+--start-server runs server-basic.py in a scratch directory on a free port
+with a throwaway user, so no existing setup is needed.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import client
+from bench_engines import BENCH_PASSWORD, BENCH_USER, client_workdir, free_port, start_server, write_users_file
+
+MB = 1024 * 1024
+DEFAULT_MIX = "upload=1,download=3,dir=5,delete=1"
+# .txt uploads must be at least 25 MB (server size rules)
+DEFAULT_SIZES = "25"
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}     # op -> [seconds]
+        self.errors = {}        # op -> count
+        self.bytes = 0
+
+    def add(self, op, seconds, ok, num_bytes=0):
+        with self._lock:
+            if ok:
+                self.latencies.setdefault(op, []).append(seconds)
+                self.bytes += num_bytes
+            else:
+                self.errors[op] = self.errors.get(op, 0) + 1
+
+    def summary(self, elapsed):
+        ops = {}
+        for op in sorted(set(self.latencies) | set(self.errors)):
+            lat = self.latencies.get(op, [])
+            ops[op] = {
+                "count": len(lat),
+                "errors": self.errors.get(op, 0),
+                "ops_per_sec": round(len(lat) / elapsed, 2),
+                "p50_ms": round(percentile(lat, 0.50) * 1000, 2),
+                "p99_ms": round(percentile(lat, 0.99) * 1000, 2),
+            }
+        total = sum(o["count"] for o in ops.values())
+        return {
+            "elapsed_sec": round(elapsed, 2),
+            "ops": total,
+            "ops_per_sec": round(total / elapsed, 2),
+            "errors": sum(self.errors.values()),
+            "MBps": round(self.bytes / elapsed / MB, 2),
+            "per_op": ops,
+        }
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        op, _, weight = item.partition("=")
+        mix[op.strip()] = float(weight or 1)
+    unknown = set(mix) - {"upload", "download", "dir", "delete"}
+    if unknown:
+        raise ValueError(f"unknown operations in mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def make_seed_files(workdir, sizes):
+    """One random file per size; users upload hard links named after themselves."""
+    seeds = {}
+    block = os.urandom(MB)
+    for size in sizes:
+        path = os.path.join(workdir, f"seed-{size}mb.txt")
+        with open(path, "wb") as f:
+            for _ in range(size):
+                f.write(block)
+        seeds[size] = path
+    return seeds
+
+
+def user_file(workdir, seeds, uid, size):
+    path = os.path.join(workdir, f"lg{uid}-{size}mb.txt")
+    if not os.path.exists(path):
+        try:
+            os.link(seeds[size], path)
+        except OSError:
+            with open(seeds[size], "rb") as src, open(path, "wb") as dst:
+                dst.write(src.read())
+    return path
+
+
+def simulated_user(uid, credentials, workdir, seeds, mix, deadline, results, rng):
+    ops, weights = zip(*mix.items())
+    session = client.open_session(dict(credentials))
+    stored = set()          # names this user has on the server
+    try:
+        while time.perf_counter() < deadline:
+            op = rng.choices(ops, weights)[0]
+            if op in ("download", "delete") and not stored:
+                op = "upload"
+            start = time.perf_counter()
+            num_bytes = 0
+            try:
+                stream = session.open_stream()
+                try:
+                    if op == "upload":
+                        size = rng.choice(list(seeds))
+                        path = user_file(workdir, seeds, uid, size)
+                        client.upload_file(stream, path, overwrite=True)
+                        ok = True
+                        stored.add(os.path.basename(path))
+                        num_bytes = size * MB
+                    elif op == "download":
+                        name = rng.choice(sorted(stored))
+                        result = client.download_file(stream, name)
+                        ok = True
+                        num_bytes = result["bytes"]
+                        os.remove(result["path"])
+                    elif op == "dir":
+                        stream.send_msg("DIR")
+                        ok = client.split_reply(stream.recv_msg())[0] == "OK"
+                    else:
+                        name = rng.choice(sorted(stored))
+                        stream.send_msg("DELETE", name)
+                        ok = client.split_reply(stream.recv_msg())[0] == "OK"
+                        stored.discard(name)
+                finally:
+                    stream.release()
+            except (OSError, ValueError, client.ProtocolError, client.ClientError):
+                ok = False
+            results.add(op, time.perf_counter() - start, ok, num_bytes)
+            if not ok and op != "dir":
+                # The connection may be out of step after a failure; start a fresh one
+                client.disconnect(session)
+                session = client.open_session(dict(credentials))
+    finally:
+        for name in stored:
+            try:
+                stream = session.open_stream()
+                stream.send_msg("DELETE", name)
+                stream.recv_msg()
+                stream.release()
+            except (OSError, client.ProtocolError):
+                break
+        client.logout(session)
+
+
+def run_load(host, port, credentials, users=8, duration=10.0, mix=DEFAULT_MIX, sizes=DEFAULT_SIZES, seed=None):
+    """Run the load and return the summary dict (see Results.summary)."""
+    mix = parse_mix(mix) if isinstance(mix, str) else mix
+    sizes = [int(s) for s in sizes.split(",")] if isinstance(sizes, str) else list(sizes)
+    client.ADDR = (host, port)
+    results = Results()
+    rng = random.Random(seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        seeds = make_seed_files(workdir, sizes)
+        threads = []
+        errors = []
+        # client.py reports every step on stdout; keep it out of the report
+        with client_workdir(workdir), contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            deadline = start + duration
+
+            def run(uid, user_rng):
+                try:
+                    simulated_user(uid, credentials, workdir, seeds, mix, deadline, results, user_rng)
+                except Exception as e:
+                    errors.append(f"user {uid}: {e}")
+
+            for uid in range(users):
+                t = threading.Thread(target=run, args=(uid, random.Random(rng.random())))
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+
+    summary = results.summary(elapsed)
+    summary["users"] = users
+    summary["user_errors"] = errors
+    return summary
+
+
+def print_summary(summary):
+    print(
+        f"\n{summary['users']} users, {summary['elapsed_sec']}s: {summary['ops']} ops "
+        f"({summary['ops_per_sec']}/s), {summary['MBps']} MB/s, {summary['errors']} errors"
+    )
+    print(f"{'op':<10} {'count':>7} {'errors':>7} {'ops/s':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for op, r in summary["per_op"].items():
+        print(f"{op:<10} {r['count']:>7} {r['errors']:>7} {r['ops_per_sec']:>8} {r['p50_ms']:>9} {r['p99_ms']:>9}")
+    for line in summary["user_errors"]:
+        print("  !", line)
+
+
+@contextlib.contextmanager
+def local_server(engine="threaded", processes=1):
+    """
+    A throwaway server-basic.py on a free port, with `processes` worker
+    processes; yields (port, credentials).
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        write_users_file(workdir)
+        port = free_port()
+        proc = start_server(engine, port, workdir, {"SERVER_PROCESSES": str(processes)})
+        try:
+            yield port, {"username": BENCH_USER, "password": BENCH_PASSWORD}
+        finally:
+            # SIGTERM, so a multi-process server stops its workers too
+            proc.terminate()
+            proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="File server load generator")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=client.PORT)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="upload sizes in MB, comma separated")
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    parser.add_argument("--start-server", action="store_true")
+    parser.add_argument("--engine", default="threaded")
+    parser.add_argument("--processes", type=int, default=1, help="server worker processes with --start-server")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+
+    if args.start_server:
+        with local_server(args.engine, args.processes) as (port, credentials):
+            summary = run_load("localhost", port, credentials, args.users, args.duration, args.mix, args.sizes, args.seed)
+    else:
+        if not args.username or not args.password:
+            parser.error("--username and --password are required without --start-server")
+        credentials = {"username": args.username, "password": args.password}
+        summary = run_load(args.host, args.port, credentials, args.users, args.duration, args.mix, args.sizes, args.seed)
+
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary["errors"] or summary["user_errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
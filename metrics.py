@@ -0,0 +1,278 @@
+# metrics.py
+"""
+In-process metrics: counters (with a recent rate), gauges and latency
+histograms, kept in a registry that renders as a dict (the STATS command)
+or as Prometheus text (the optional HTTP endpoint).
+
+Updates are an integer add under a per-metric lock; anything more costly
+(quantiles, callback gauges, formatting) happens when metrics are read.
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "fileserver_"
+# Counters remember this many seconds of per-second totals for rate()
+RATE_WINDOW = 60
+
+# Histograms are log-linear like HDR histograms: every power of two (in
+# microseconds) is split into 2**SUB_BITS buckets, i.e. ~12% resolution
+SUB_BITS = 3
+_SUB = 1 << SUB_BITS
+HISTOGRAM_BUCKETS = 64 * _SUB
+
+
+def _bucket(us: int) -> int:
+    if us < _SUB:
+        return max(us, 0)
+    exp = us.bit_length() - 1 - SUB_BITS
+    return ((exp + 1) << SUB_BITS) + ((us >> exp) - _SUB)
+
+
+def _bucket_upper(index: int) -> int:
+    """Smallest microsecond value above bucket `index`."""
+    if index < _SUB:
+        return index + 1
+    exp = (index >> SUB_BITS) - 1
+    return ((index & (_SUB - 1)) + _SUB + 1) << exp
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str = "", labels: dict = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+        self._slots = [0] * RATE_WINDOW
+        self._slot_time = [0] * RATE_WINDOW
+
+    def inc(self, n: int = 1):
+        second = int(time.monotonic())
+        i = second % RATE_WINDOW
+        with self._lock:
+            self.value += n
+            if self._slot_time[i] != second:
+                self._slot_time[i] = second
+                self._slots[i] = 0
+            self._slots[i] += n
+
+    def rate(self, window: int = 10) -> float:
+        """Average increase per second over the last `window` seconds."""
+        now = int(time.monotonic())
+        with self._lock:
+            total = sum(v for v, t in zip(self._slots, self._slot_time) if 0 < now - t <= window)
+        return total / window
+
+    def snapshot(self):
+        return {"total": self.value, "rate_10s": round(self.rate(), 3)}
+
+    def render(self):
+        return [f"{PREFIX}{self.name}{_labels(self.labels)} {self.value}"]
+
+
+class Gauge:
+    """A value that is set/inc/dec'd, or computed by `fn` when read."""
+
+    def __init__(self, name: str, help: str = "", labels: dict = None, fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.fn = fn
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n: int = 1):
+        with self._lock:
+            self._value += n
+
+    def dec(self, n: int = 1):
+        with self._lock:
+            self._value -= n
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self.fn() if self.fn else self._value
+
+    def snapshot(self):
+        return self.value
+
+    def render(self):
+        return [f"{PREFIX}{self.name}{_labels(self.labels)} {self.value}"]
+
+
+class Histogram:
+    """Latency histogram; observe() takes seconds."""
+
+    def __init__(self, name: str, help: str = "", labels: dict = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.count = 0
+        self.sum = 0.0
+        self._counts = [0] * HISTOGRAM_BUCKETS
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        index = min(_bucket(int(seconds * 1_000_000)), HISTOGRAM_BUCKETS - 1)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """Upper bound (seconds) of the bucket holding the q-th quantile."""
+        with self._lock:
+            counts = list(self._counts)
+            count = self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if n and seen >= rank:
+                return _bucket_upper(index) / 1_000_000
+        return _bucket_upper(HISTOGRAM_BUCKETS - 1) / 1_000_000
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.sum / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.50) * 1000, 3),
+            "p90_ms": round(self.quantile(0.90) * 1000, 3),
+            "p99_ms": round(self.quantile(0.99) * 1000, 3),
+            "max_ms": round(self.quantile(1.0) * 1000, 3),
+        }
+
+    def render(self):
+        # Cumulative buckets at every power-of-two boundary up to the largest value seen
+        with self._lock:
+            counts = list(self._counts)
+            count, total = self.count, self.sum
+        name = PREFIX + self.name
+        lines = []
+        cumulative = 0
+        last = max((i for i, n in enumerate(counts) if n), default=-1)
+        for index in range(0, last + _SUB, _SUB):
+            cumulative += sum(counts[index:index + _SUB])
+            le = _bucket_upper(index + _SUB - 1) / 1_000_000
+            lines.append(f"{name}_bucket{_labels(dict(self.labels, le=f'{le:g}'))} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(dict(self.labels, le='+Inf'))} {count}")
+        lines.append(f"{name}_sum{_labels(self.labels)} {total}")
+        lines.append(f"{name}_count{_labels(self.labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(name, help, labels, **kwargs)
+        return metric
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str = "", fn=None, **labels) -> Gauge:
+        return self._get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name: str, help: str = "", **labels) -> Histogram:
+        return self._get(Histogram, name, help, labels)
+
+    def snapshot(self) -> dict:
+        """{"name" or "name{label=...}": value} for every metric."""
+        out = {"uptime_sec": round(time.time() - self.started, 1)}
+        for (name, labels), metric in sorted(self._metrics.items()):
+            key = name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+            out[key] = metric.snapshot()
+        return out
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for (name, _), metric in sorted(self._metrics.items()):
+            if name not in described:
+                described.add(name)
+                kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+                if metric.help:
+                    lines.append(f"# HELP {PREFIX}{name} {metric.help}")
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def merge_snapshots(snapshots) -> dict:
+    """
+    One snapshot for several server processes. Counters and gauges add
+    up, as do histogram counts, with mean_ms weighted by them; quantiles
+    can't be combined from summaries, so the highest is kept.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            old = merged.get(key)
+            if old is None:
+                merged[key] = dict(value) if isinstance(value, dict) else value
+            elif key == "uptime_sec":
+                merged[key] = max(old, value)
+            elif not isinstance(value, dict):
+                merged[key] = old + value
+            elif "count" in value:
+                count = old["count"] + value["count"]
+                mean = (old["mean_ms"] * old["count"] + value["mean_ms"] * value["count"]) / count if count else 0.0
+                for field, v in value.items():
+                    old[field] = max(old[field], v)
+                old.update(count=count, mean_ms=round(mean, 3))
+            else:
+                for field, v in value.items():
+                    old[field] = round(old[field] + v, 3)
+    return merged
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def serve_http(port: int, host: str = "localhost", registry: Registry = REGISTRY):
+    """Serve registry.render() at http://host:port/metrics from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+    return httpd
@@ -0,0 +1,609 @@
+# protocol.py
+"""
+Message channels shared by server-basic.py and client.py.
+
+Two wire formats carry the same messages, a tag plus string arguments
+(e.g. "UPLOAD", "notes.txt", "123"):
+
+  text   - the original "TAG@arg@arg" strings, one per send()/recv()
+  framed - length-prefixed binary frames:
+
+             opcode (1) | flags (1) | request id (4) | payload length (4)
+
+           followed by the payload. Known tags travel as their opcode with
+           the arguments joined by NUL; anything else (usernames, "y", new
+           commands) goes as a TEXT frame holding the whole message.
+           File data travels in DATA frames, the last one flagged END.
+
+A connection starts in text mode. The client may answer the first
+AUTH@USERNAME prompt with "PROTO@FRAMED"; the server replies "PROTO@FRAMED"
+(switch) or "PROTO@TEXT" (stay), then waits for the username in that mode.
+
+After login a framed connection is multiplexed: every request gets its own
+request id, its first frame carries the NEW flag, and all frames of that
+request (replies, follow-ups, DATA) carry the same id. Many requests can be
+in flight at once and their DATA frames interleave on the one socket.
+
+A receiver that can't keep up with a request's data (a throttled upload)
+sends WINDOW frames for it, each holding the total number of DATA bytes
+the sender may have sent on that request so far; once a request has had
+a WINDOW the sender waits for more before going past it. This keeps one
+slow request from filling the socket and holding up the others.
+"""
+import os
+import queue
+import socket
+import struct
+import threading
+
+from transfer import recv_to_file, send_file
+
+SIZE = 64 * 1024
+FORMAT = "utf-8"
+
+PROTO_TEXT = "TEXT"
+PROTO_FRAMED = "FRAMED"
+
+HEADER = struct.Struct("!BBII")
+FLAG_END = 0x01
+FLAG_NEW = 0x02
+# File data is split into DATA frames of at most this many bytes
+FRAME_DATA_SIZE = 1024 * 1024
+# Largest non-DATA payload accepted, guards against garbage length fields
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+# DATA bytes a paced recv_file lets the sender get ahead of it
+STREAM_WINDOW = 4 * FRAME_DATA_SIZE
+WINDOW = struct.Struct("!Q")
+
+OP_TEXT = 0
+OP_DATA = 1
+OP_WINDOW = 13
+OPCODES = {
+    "AUTH": 2,
+    "OK": 3,
+    "ERR": 4,
+    "READY": 5,
+    "PROTO": 6,
+    "UPLOAD": 7,
+    "DOWNLOAD": 8,
+    "DELETE": 9,
+    "DIR": 10,
+    "SUBFOLDER": 11,
+    "LOGOUT": 12,
+}
+TAGS = {op: tag for tag, op in OPCODES.items()}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Transfer options a command may carry as trailing "key=value" arguments
+OPTION_KEYS = ("sum", "zip", "ranges")
+
+
+def split_options(parts, keys=OPTION_KEYS):
+    """[cmd, arg, "sum=sha256", ...] -> ([cmd, arg, ...], {"sum": "sha256"})."""
+    args = []
+    options = {}
+    for part in parts:
+        key, sep, value = part.partition("=")
+        if sep and args and key in keys:
+            options[key] = value
+        else:
+            args.append(part)
+    return args, options
+
+
+def _decode(opcode: int, payload: bytes):
+    """Payload of a non-DATA frame -> [tag, *args]."""
+    args = payload.decode(FORMAT).split("\0") if payload else []
+    if opcode == OP_TEXT:
+        return args or [""]
+    tag = TAGS.get(opcode)
+    if tag is None:
+        raise ProtocolError(f"unknown opcode {opcode}")
+    return [tag] + args
+
+
+class TextChannel:
+    """The original "@"-delimited protocol; one message per send()/recv()."""
+
+    mode = PROTO_TEXT
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send_msg(self, tag: str, *args):
+        self.sock.send("@".join((tag,) + args).encode(FORMAT))
+
+    def recv_msg(self):
+        """Next message as [tag, *args], or None once the peer closed."""
+        data = self.sock.recv(SIZE).decode(FORMAT)
+        if not data:
+            return None
+        return data.strip().split("@")
+
+    def send_file(self, f, offset: int = 0, count: int = None):
+        return send_file(self.sock, f, offset, count)
+
+    def recv_file(self, f, count: int) -> int:
+        return recv_to_file(self.sock, f, count)
+
+    def buffered(self) -> bool:
+        return False
+
+    def open_stream(self):
+        # No multiplexing in text mode: every request uses the connection itself
+        return self
+
+    def release(self):
+        pass
+
+    def close(self):
+        self.sock.close()
+
+
+class FramedChannel:
+    """Length-prefixed frames; see the module docstring for the layout."""
+
+    mode = PROTO_FRAMED
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.request_id = 0
+        self._rbuf = bytearray()
+        # Frames from concurrent requests must not interleave mid-frame
+        self.send_lock = threading.Lock()
+
+    # ----- writing -----
+
+    def _send_frame(self, opcode: int, payload: bytes = b"", flags: int = 0, req_id: int = None):
+        rid = self.request_id if req_id is None else req_id
+        with self.send_lock:
+            self.sock.sendall(HEADER.pack(opcode, flags, rid, len(payload)) + payload)
+
+    def send_msg(self, tag: str, *args, req_id: int = None, flags: int = 0):
+        opcode = OPCODES.get(tag)
+        if opcode is None:
+            opcode, args = OP_TEXT, (tag,) + args
+        self._send_frame(opcode, "\0".join(args).encode(FORMAT), flags, req_id)
+
+    def send_file(self, f, offset: int = 0, count: int = None, req_id: int = None, pace=None):
+        """
+        Send a file range as DATA frames; returns (bytes_sent, io_path).
+        pace(n), if given, is called before each frame of n bytes, outside
+        the send lock so a wait there doesn't hold up other requests.
+        """
+        if count is None:
+            f.seek(0, os.SEEK_END)
+            count = f.tell() - offset
+        rid = self.request_id if req_id is None else req_id
+        if count == 0:
+            self._send_frame(OP_DATA, flags=FLAG_END, req_id=rid)
+            return 0, "buffered"
+        return self._send_range(f, offset, count, rid, pace, end=True)
+
+    def _send_range(self, f, offset: int, count: int, rid: int, pace, end: bool):
+        sent = 0
+        io_path = "sendfile"
+        while sent < count:
+            n = min(FRAME_DATA_SIZE, count - sent)
+            flags = FLAG_END if end and sent + n >= count else 0
+            if pace:
+                pace(n)
+            with self.send_lock:
+                self.sock.sendall(HEADER.pack(OP_DATA, flags, rid, n))
+                k, path = send_file(self.sock, f, offset + sent, n)
+            if k < n:
+                # The frame header already promised n bytes
+                raise ProtocolError("file shrank while sending")
+            if path != "sendfile":
+                io_path = path
+            sent += k
+        return sent, io_path
+
+    def send_blocks(self, blocks, req_id: int = None, pace=None) -> int:
+        """
+        Send every bytes object from `blocks` as a DATA frame, then an empty
+        END frame; for data whose length isn't known up front. An
+        (f, offset, count) item is sent from the file as send_file does.
+        Returns bytes sent. pace works as for send_file.
+        """
+        rid = self.request_id if req_id is None else req_id
+        sent = 0
+        for block in blocks:
+            if isinstance(block, tuple):
+                n, _ = self._send_range(*block, rid, pace, end=False)
+                sent += n
+                continue
+            if pace:
+                pace(len(block))
+            with self.send_lock:
+                self.sock.sendall(HEADER.pack(OP_DATA, 0, rid, len(block)))
+                self.sock.sendall(block)
+            sent += len(block)
+        self._send_frame(OP_DATA, flags=FLAG_END, req_id=rid)
+        return sent
+
+    def send_window(self, limit: int, req_id: int):
+        self._send_frame(OP_WINDOW, WINDOW.pack(limit), req_id=req_id)
+
+    # ----- reading -----
+
+    def _fill(self, n: int) -> bool:
+        while len(self._rbuf) < n:
+            chunk = self.sock.recv(max(SIZE, n - len(self._rbuf)))
+            if not chunk:
+                return False
+            self._rbuf += chunk
+        return True
+
+    def _read_header(self):
+        if not self._fill(HEADER.size):
+            if self._rbuf:
+                raise ProtocolError("connection closed mid-frame")
+            return None
+        header = HEADER.unpack_from(self._rbuf)
+        del self._rbuf[:HEADER.size]
+        return header
+
+    def _read_payload(self, length: int) -> bytes:
+        if not self._fill(length):
+            raise ProtocolError("connection closed mid-frame")
+        payload = bytes(self._rbuf[:length])
+        del self._rbuf[:length]
+        return payload
+
+    def recv_msg(self):
+        """Next message as [tag, *args], or None once the peer closed."""
+        header = self._read_header()
+        if header is None:
+            return None
+        opcode, _, rid, length = header
+        if opcode == OP_DATA or length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"unexpected frame (opcode {opcode}, {length} bytes)")
+        self.request_id = rid
+        return _decode(opcode, self._read_payload(length))
+
+    def _recv_payload_to(self, f, length: int) -> int:
+        # Whatever is already buffered first, then straight from the socket
+        take = min(length, len(self._rbuf))
+        if take:
+            f.write(self._rbuf[:take])
+            del self._rbuf[:take]
+        return take + recv_to_file(self.sock, f, length - take)
+
+    def recv_file(self, f, count: int, pace=None) -> int:
+        """
+        Write DATA frames to f until the END frame; returns bytes received.
+        pace(n), if given, is called before reading each frame of n bytes.
+        """
+        received = 0
+        while True:
+            header = self._read_header()
+            if header is None:
+                return received
+            opcode, flags, _, length = header
+            if opcode != OP_DATA:
+                raise ProtocolError(f"expected DATA frame, got opcode {opcode}")
+            if received + length > count:
+                raise ProtocolError("more data than announced")
+            if pace:
+                pace(length)
+            n = self._recv_payload_to(f, length)
+            received += n
+            if n < length or flags & FLAG_END:
+                return received
+
+    def buffered(self) -> bool:
+        """True if a frame is already waiting in the read buffer."""
+        return bool(self._rbuf)
+
+    def close(self):
+        # shutdown() first: close() alone doesn't wake a reader thread blocked
+        # in recv() on this socket, and the peer wouldn't see the FIN
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def open_channel(sock, mode: str):
+    return FramedChannel(sock) if mode == PROTO_FRAMED else TextChannel(sock)
+
+
+class Stream:
+    """
+    One request on a multiplexed connection. Same send/recv methods as a
+    channel, so the command handlers don't care which one they are given.
+    """
+
+    mode = PROTO_FRAMED
+
+    def __init__(self, mux, req_id: int, started: bool):
+        self.mux = mux
+        self.request_id = req_id
+        # The first frame a client sends on a new stream carries FLAG_NEW
+        self._started = started
+        self._inbox = queue.Queue()
+        self._lock = threading.Lock()
+        # While recv_file waits, the reader writes DATA payloads straight here
+        self._sink = None
+        self._sink_limit = 0
+        self._sink_received = 0
+        self._sink_done = threading.Event()
+        # DATA bytes received so far, and those waiting in the inbox
+        # (bounded while a paced recv_file runs)
+        self._received = 0
+        self._space = threading.Condition()
+        self._queued = 0
+        self._paced = False
+        # Sending side of the flow control; no limit until the peer sends a WINDOW
+        self._credit = threading.Condition()
+        self._window = None
+        self._sent = 0
+
+    def _new_flag(self) -> int:
+        if self._started:
+            return 0
+        self._started = True
+        return FLAG_NEW
+
+    def send_msg(self, tag: str, *args):
+        self.mux.chan.send_msg(tag, *args, req_id=self.request_id, flags=self._new_flag())
+
+    def send_file(self, f, offset: int = 0, count: int = None, pace=None):
+        def before_frame(n):
+            if pace:
+                pace(n)
+            self._take_credit(n)
+        return self.mux.chan.send_file(f, offset, count, req_id=self.request_id, pace=before_frame)
+
+    def send_blocks(self, blocks, pace=None) -> int:
+        def before_frame(n):
+            if pace:
+                pace(n)
+            self._take_credit(n)
+        return self.mux.chan.send_blocks(blocks, req_id=self.request_id, pace=before_frame)
+
+    def _take_credit(self, n: int):
+        with self._credit:
+            while self._window is not None and self._sent + n > self._window:
+                self._credit.wait()
+            self._sent += n
+
+    def _grant(self, limit: int):
+        with self._credit:
+            self._window = max(self._window or 0, limit)
+            self._credit.notify_all()
+
+    def recv_msg(self):
+        """Next message for this request, or None once the connection closed."""
+        item = self._inbox.get()
+        if item is None:
+            self._inbox.put(None)
+            return None
+        opcode, _, payload = item
+        if opcode == OP_DATA:
+            raise ProtocolError("unexpected DATA frame")
+        return _decode(opcode, payload)
+
+    def _dequeued(self, n: int):
+        with self._space:
+            self._queued -= n
+            self._space.notify()
+
+    def recv_file(self, f, count: int, pace=None) -> int:
+        """
+        Write this request's DATA frames to f until END; returns bytes received.
+
+        Normally the reader thread writes them to f itself. With pace, they
+        are queued instead and written here, pace(n) being called before
+        each frame, so a slow pace doesn't stall the reader thread and the
+        other requests on the connection. The sender is kept at most
+        STREAM_WINDOW bytes ahead with WINDOW frames.
+        """
+        if pace is not None:
+            return self._recv_paced(f, count, pace)
+        received = 0
+        with self._lock:
+            # Frames that arrived before we got here were queued
+            while not self._inbox.empty():
+                item = self._inbox.get_nowait()
+                if item is None:
+                    self._inbox.put(None)
+                    return received
+                opcode, flags, payload = item
+                if opcode != OP_DATA:
+                    raise ProtocolError(f"expected DATA frame, got opcode {opcode}")
+                self._dequeued(len(payload))
+                f.write(payload)
+                received += len(payload)
+                self._received += len(payload)
+                if flags & FLAG_END:
+                    return received
+            self._sink = f
+            self._sink_limit = count
+            self._sink_received = received
+            self._sink_done.clear()
+        self._sink_done.wait()
+        return self._sink_received
+
+    def _recv_paced(self, f, count: int, pace) -> int:
+        with self._space:
+            self._paced = True
+        chan = self.mux.chan
+        chan.send_window(self._received + STREAM_WINDOW, self.request_id)
+        received = 0
+        try:
+            while True:
+                item = self._inbox.get()
+                if item is None:
+                    self._inbox.put(None)
+                    return received
+                opcode, flags, payload = item
+                if opcode != OP_DATA:
+                    raise ProtocolError(f"expected DATA frame, got opcode {opcode}")
+                self._dequeued(len(payload))
+                if received + len(payload) > count:
+                    raise ProtocolError("more data than announced")
+                pace(len(payload))
+                f.write(payload)
+                received += len(payload)
+                self._received += len(payload)
+                if flags & FLAG_END:
+                    return received
+                chan.send_window(self._received + STREAM_WINDOW, self.request_id)
+        finally:
+            # Don't leave the reader waiting for a consumer that's gone
+            with self._space:
+                self._paced = False
+                self._space.notify()
+
+    def _deliver(self, opcode: int, flags: int, length: int):
+        """Called on the reader thread with the frame's payload still on the socket."""
+        chan = self.mux.chan
+        if opcode == OP_WINDOW:
+            if length != WINDOW.size:
+                raise ProtocolError(f"bad WINDOW frame ({length} bytes)")
+            self._grant(WINDOW.unpack(chan._read_payload(length))[0])
+            return
+        with self._lock:
+            if opcode == OP_DATA and self._sink is not None:
+                if self._sink_received + length > self._sink_limit:
+                    raise ProtocolError("more data than announced")
+                n = chan._recv_payload_to(self._sink, length)
+                self._sink_received += n
+                self._received += n
+                if n < length or flags & FLAG_END:
+                    self._sink = None
+                    self._sink_done.set()
+                return
+            if opcode == OP_DATA:
+                with self._space:
+                    # A peer ignoring the window is stopped at twice its size
+                    while self._paced and self._queued >= 2 * STREAM_WINDOW:
+                        self._space.wait()
+                    self._queued += length
+            self._inbox.put((opcode, flags, chan._read_payload(length)))
+
+    def _abort(self):
+        with self._lock:
+            self._inbox.put(None)
+            self._sink = None
+            self._sink_done.set()
+        # A sender waiting for credit finds the connection closed instead
+        self._grant(2 ** 64 - 1)
+
+    def open_stream(self):
+        return self
+
+    def release(self):
+        """The request is finished; later frames with its id are dropped."""
+        self.mux._remove(self)
+
+
+class Multiplexer:
+    """
+    Routes the frames of a FramedChannel to Streams by request id.
+
+    One thread calls read_frame() in a loop. On the server, a frame flagged
+    NEW starts a request and is passed to on_request(stream, parts); returning
+    False from it (LOGOUT) stops the loop. On the client, open_stream()
+    allocates ids for outgoing requests.
+    """
+
+    def __init__(self, chan: FramedChannel, on_request=None):
+        self.chan = chan
+        self.on_request = on_request
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._closing = False
+
+    def open_stream(self) -> Stream:
+        with self._lock:
+            while self._next_id in self._streams or self._next_id == 0:
+                self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+            stream = Stream(self, self._next_id, started=False)
+            self._streams[self._next_id] = stream
+            self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        return stream
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._streams)
+
+    def read_frame(self) -> bool:
+        """Read and route one frame. Returns False on LOGOUT or once the peer closed."""
+        try:
+            return self._read_frame()
+        except Exception:
+            # Wake up every request still waiting on this connection
+            self._abort_all()
+            raise
+
+    def _read_frame(self) -> bool:
+        header = self.chan._read_header()
+        if header is None:
+            self._abort_all()
+            return False
+        opcode, flags, rid, length = header
+        if length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"frame too large ({length} bytes)")
+
+        if flags & FLAG_NEW and self.on_request is not None:
+            parts = _decode(opcode, self.chan._read_payload(length))
+            stream = Stream(self, rid, started=True)
+            with self._lock:
+                busy = rid in self._streams
+                if not busy:
+                    self._streams[rid] = stream
+            if busy:
+                self.chan.send_msg("ERR", f"Request id {rid} already in use", req_id=rid)
+                return True
+            return self.on_request(stream, parts) is not False
+
+        with self._lock:
+            stream = self._streams.get(rid)
+        if stream is None:
+            # Late frame for a finished request
+            self.chan._read_payload(length)
+            return True
+        stream._deliver(opcode, flags, length)
+        return True
+
+    def run(self):
+        """Reader loop for the client side."""
+        try:
+            while self.read_frame():
+                pass
+        except (OSError, ProtocolError):
+            pass
+
+    def _abort_all(self):
+        with self._lock:
+            streams = list(self._streams.values())
+        for stream in streams:
+            stream._abort()
+
+    def _remove(self, stream: Stream):
+        with self._lock:
+            if self._streams.get(stream.request_id) is stream:
+                del self._streams[stream.request_id]
+            close = self._closing and not self._streams
+        if close:
+            self.chan.close()
+
+    def shutdown(self):
+        """Close the connection once every in-flight request has finished."""
+        with self._lock:
+            self._closing = True
+            close = not self._streams
+        if close:
+            self.chan.close()
+
+    def buffered(self) -> bool:
+        return self.chan.buffered()
@@ -1,13 +1,37 @@
+import contextlib
+import json
 import os
+import queue
+import selectors
+import shutil
 import socket
 import threading
-import hashlib
 import logging
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import metrics
+import checksum
+import compression
+import workers
+from checksum import DigestCache, HashingReader, HashingWriter
+from credentials import CredentialStore
+from dirindex import DirectoryIndex
+from filecache import FileCache
+from filelocks import FileLocks
+from sessions import SessionTable
+from protocol import PROTO_FRAMED, PROTO_TEXT, Multiplexer, TextChannel, open_channel, split_options
+from storage import DIGEST_SIZE, ChunkError, ChunkStore, DigestListWriter
+from throttle import Limiter, ThrottledChannel
+from transfer import OffsetWriter, preallocate, tune_socket
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 try:
     from analytics import record_transfer, record_event
+    from analytics import stats as analytics_stats
+    from analytics import flush as analytics_flush, set_worker as analytics_worker
 except Exception:
     def record_transfer(*args, **kwargs):
         pass
@@ -15,6 +39,15 @@ except Exception:
     def record_event(*args, **kwargs):
         pass
 
+    def analytics_stats():
+        return {}
+
+    def analytics_flush(*args, **kwargs):
+        pass
+
+    def analytics_worker(*args, **kwargs):
+        pass
+
 # Logging setup
 logging.basicConfig(
     filename="server.log",
@@ -23,266 +56,1655 @@ logging.basicConfig(
 )
 
 IP = "localhost"          # Listen on all interfaces
-PORT = 4450
+PORT = int(os.environ.get("SERVER_PORT", 4450))
 ADDR = (IP, PORT)
 SIZE = 64 * 1024
 FORMAT = "utf-8"
-SERVER_PATH = os.path.join(BASE_DIR, "server")
+# Stored files and all server state below them; SERVER_PATH moves it, e.g. for a scratch server
+SERVER_PATH = os.environ.get("SERVER_PATH") or os.path.join(BASE_DIR, "server")
 os.makedirs(SERVER_PATH, exist_ok=True)
+# Parallel uploads are assembled here before being renamed into SERVER_PATH
+PARTS_PATH = os.path.join(SERVER_PATH, ".parts")
+# Interrupted uploads are kept here (data + JSON record) so they can be resumed
+PARTIAL_PATH = os.path.join(SERVER_PATH, ".partial")
+# Unfinished uploads (resumable or parallel) nothing has written to for this
+# many seconds are removed, checked at startup and by DIR / RESUME
+PARTIAL_MAX_AGE = float(os.environ.get("SERVER_PARTIAL_MAX_AGE", 24 * 3600))
+PARTIAL_SWEEP_INTERVAL = 60
+# Unfinished uploads one user may have at a time; each holds its full size on disk
+MAX_PARTIAL_UPLOADS = int(os.environ.get("SERVER_MAX_PARTIALS", 16))
+# Deduplicated uploads: chunks stored once by content hash, plus a manifest per name
+STORE = ChunkStore(os.path.join(SERVER_PATH, ".store"))
+# Per-name locks, shared by every worker process
+LOCKS = FileLocks(os.path.join(SERVER_PATH, ".locks"))
+# Chunk sizes a client may pick for DEDUP_UPLOAD
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# Chunks one DEDUP_UPLOAD may announce; bounds its digest list and NEED bitmap
+MAX_DEDUP_CHUNKS = int(os.environ.get("SERVER_MAX_DEDUP_CHUNKS", 65536))
+# DIR is served from this in-memory index of SERVER_PATH (and the chunk store)
+INDEX = DirectoryIndex()
+# Entries per DIR page by default, and at most
+DIR_PAGE_SIZE = int(os.environ.get("SERVER_DIR_PAGE", 100))
+DIR_MAX_PAGE = 250
+# In text mode a reply must fit one recv() on the client, so DIR pages are
+# also cut to this many bytes of entries (the rest is room for the framing)
+DIR_TEXT_BYTES = SIZE - 1024
+
+# Byte ranges one DOWNLOAD@...@ranges= request may ask for
+MAX_RANGES = 256
+
+ALLOWED_EXTS = [".txt", ".mp3", ".wav", ".mp4", ".avi", ".mkv"]
+
+# "threaded": one thread per connection (default)
+# "eventloop": one selector loop holds every connection and hands ready
+#              sockets to a bounded pool that runs the command (and its file I/O)
+ENGINE = os.environ.get("SERVER_ENGINE", "threaded")
+# Worker processes (see workers.py); 1 serves from this process as before
+PROCESSES = int(os.environ.get("SERVER_PROCESSES", 1))
+# Worker metrics snapshots, for STATS across processes
+WORKERS_PATH = os.path.join(SERVER_PATH, ".workers")
+# Index of this worker process, None with a single process
+WORKER = None
+MAX_WORKERS = int(os.environ.get("SERVER_WORKERS", 32))
+# Admission control: connections beyond MAX_CONNECTIONS, or arriving while
+# BACKLOG of them already wait for a handler, get ERR@BUSY@<RETRY_AFTER> and
+# are closed straight away instead of slowing everyone down
+MAX_CONNECTIONS = int(os.environ.get("SERVER_MAX_CONNECTIONS", 1024))
+BACKLOG = int(os.environ.get("SERVER_BACKLOG", 256))
+RETRY_AFTER = int(os.environ.get("SERVER_RETRY_AFTER", 1))
+# Threaded engine: fixed number of connection handler threads. A handler is
+# held for the whole connection, so one queued for QUEUE_WAIT seconds without
+# getting one gets ERR@BUSY too (0 = wait as long as it takes)
+HANDLERS = int(os.environ.get("SERVER_HANDLERS", 256))
+QUEUE_WAIT = float(os.environ.get("SERVER_QUEUE_WAIT", 5))
+# Transfers one user may run at once (UPLOAD, DOWNLOAD, DEDUP_UPLOAD, UPLOAD_PART)
+USER_TRANSFERS = int(os.environ.get("SERVER_USER_TRANSFERS", 8))
+# Transfer bandwidth caps in bytes/sec (0 = unlimited): the whole server, each
+# user and each connection. Transfers under a cap share it evenly (throttle.py)
+RATE_LIMIT = float(os.environ.get("SERVER_RATE_LIMIT", 0))
+USER_RATE_LIMIT = float(os.environ.get("SERVER_USER_RATE_LIMIT", 0))
+CONNECTION_RATE_LIMIT = float(os.environ.get("SERVER_CONNECTION_RATE_LIMIT", 0))
+# Let clients switch to the length-prefixed framed protocol (see protocol.py)
+ALLOW_FRAMING = os.environ.get("SERVER_FRAMING", "1") != "0"
+# Requests in flight on multiplexed (framed) connections run on this pool
+REQUEST_WORKERS = int(os.environ.get("SERVER_REQUEST_WORKERS", 64))
+REQUEST_POOL = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix="request")
+# Loaded once, reloaded when users.txt changes; see credentials.py
+CREDENTIALS = CredentialStore("users.txt")
+# Serve Prometheus text at http://localhost:<port>/metrics; 0 = off (STATS still works)
+METRICS_PORT = int(os.environ.get("SERVER_METRICS_PORT", 0))
+
+# Accepted sockets; closed or collected ones stop counting as active
+LIVE_CONNECTIONS = weakref.WeakSet()
+CONNECTIONS_TOTAL = metrics.counter("connections_total", "Accepted connections")
+metrics.gauge("connections_active", "Open client connections", fn=lambda: active_connections())
+metrics.gauge("threads", "Live threads in the server process", fn=threading.active_count)
+metrics.gauge("analytics_rows_dropped", "Analytics rows lost to a full queue",
+              fn=lambda: analytics_stats().get("dropped", 0))
+COMMANDS_IN_FLIGHT = metrics.gauge("commands_in_flight", "Commands being handled")
+QUEUE_DEPTH = metrics.gauge("handler_queue_depth", "Connections or steps waiting for a handler")
+TRANSFERS_ACTIVE = metrics.gauge("transfers_active", "Transfers in progress")
+DIGESTS = DigestCache()
+metrics.gauge("digest_cache_hits", "Downloads whose checksum came from the cache", fn=lambda: DIGESTS.hits)
+metrics.gauge("digest_cache_misses", "Downloads whose checksum had to be computed", fn=lambda: DIGESTS.misses)
+# Hot files served from memory / shared mmaps (see filecache.py)
+FILE_CACHE = FileCache()
+metrics.gauge("file_cache_hits", "Downloads served from the file cache", fn=lambda: FILE_CACHE.hits)
+metrics.gauge("file_cache_misses", "Downloads that had to (re)load the file", fn=lambda: FILE_CACHE.misses)
+metrics.gauge("file_cache_evictions", "Files evicted from the file cache", fn=lambda: FILE_CACHE.evictions)
+metrics.gauge("file_cache_bytes", "Bytes of file data in the file cache", fn=lambda: FILE_CACHE.bytes)
+THROTTLE_WAIT = metrics.counter("throttle_wait_seconds_total", "Time transfers spent waiting for bandwidth")
+BYTES_IN = metrics.counter("bytes_received_total", "File bytes received from clients")
+BYTES_OUT = metrics.counter("bytes_sent_total", "File bytes sent to clients")
+LOGINS_OK = metrics.counter("logins_total", "Login attempts", result="ok")
+LOGINS_FAIL = metrics.counter("logins_total", "Login attempts", result="fail")
+# Latency histograms are kept per command; anything else is counted as "OTHER"
+COMMANDS = {
+    "LOGOUT", "UPLOAD", "DOWNLOAD", "RESUME", "DEDUP_UPLOAD", "UPLOAD_INIT",
+    "UPLOAD_PART", "UPLOAD_COMMIT", "DELETE", "DIR", "SUBFOLDER", "STATS",
+}
+
+
+def track_connection(conn):
+    LIVE_CONNECTIONS.add(conn)
+    CONNECTIONS_TOTAL.inc()
+
+
+def active_connections() -> int:
+    return sum(1 for sock in list(LIVE_CONNECTIONS) if sock.fileno() != -1)
+
+
+def reject(conn, addr, reason: str):
+    """Turn a connection away with ERR@BUSY@<retry after> before any login."""
+    metrics.counter("rejections_total", "Requests turned away as busy", reason=reason).inc()
+    logging.warning("Rejected %s: busy (%s)", addr, reason)
+    try:
+        conn.send(f"ERR@BUSY@{RETRY_AFTER}".encode(FORMAT))
+    except OSError:
+        pass
+    conn.close()
+
+
+def admit(conn, addr) -> bool:
+    """Apply the connection limit and the handler backlog to a new connection."""
+    if active_connections() > MAX_CONNECTIONS:
+        reject(conn, addr, "connections")
+        return False
+    if QUEUE_DEPTH.value >= BACKLOG:
+        reject(conn, addr, "backlog")
+        return False
+    return True
+
+
+# Transfers running per user, for USER_TRANSFERS
+RUNNING_TRANSFERS = {}
+RUNNING_TRANSFERS_LOCK = threading.Lock()
+TRANSFER_COMMANDS = {"UPLOAD", "DOWNLOAD", "DEDUP_UPLOAD", "UPLOAD_PART"}
+
+
+def start_transfer(username) -> bool:
+    with RUNNING_TRANSFERS_LOCK:
+        running = RUNNING_TRANSFERS.get(username, 0)
+        if running >= USER_TRANSFERS:
+            return False
+        RUNNING_TRANSFERS[username] = running + 1
+    TRANSFERS_ACTIVE.inc()
+    return True
+
+
+def end_transfer(username):
+    with RUNNING_TRANSFERS_LOCK:
+        running = RUNNING_TRANSFERS.get(username, 1) - 1
+        if running:
+            RUNNING_TRANSFERS[username] = running
+        else:
+            RUNNING_TRANSFERS.pop(username, None)
+    TRANSFERS_ACTIVE.dec()
+
+
+THROTTLE = Limiter(RATE_LIMIT, USER_RATE_LIMIT, CONNECTION_RATE_LIMIT)
+
+# Tokens handed out with AUTH@OK; TOKEN@<token> in place of the username resumes
+SESSIONS = SessionTable()
+# The token each connection logged in with (socket -> token), revoked on LOGOUT
+CONNECTION_TOKENS = weakref.WeakKeyDictionary()
 
 
 def check_credentials(username: str, password: str) -> bool:
+    # The KDF runs on the auth pool, which bounds how many logins hash at once
+    return CREDENTIALS.submit(username, password).result()
+
+
+def finish_login(chan, addr, username: str, password: str):
+    """Check the credentials and send AUTH@OK or AUTH@FAIL."""
+    return report_login(chan, addr, username, check_credentials(username, password))
+
+
+def report_login(chan, addr, username: str, ok: bool):
+    if ok:
+        LOGINS_OK.inc()
+        token = SESSIONS.issue(username)
+        CONNECTION_TOKENS[chan.sock] = token
+        chan.send_msg("AUTH", "OK", token)
+        logging.info("Authentication successful for %s from %s", username, addr)
+        record_event("server", "LOGIN_OK", 0, 0, status="OK", note=username)
+        return username
+    else:
+        LOGINS_FAIL.inc()
+        chan.send_msg("AUTH", "FAIL")
+        logging.warning("Authentication FAILED for %s from %s", username, addr)
+        record_event("server", "LOGIN_FAIL", 0, 0, status="FAIL", note=username)
+        return None
+
+
+def resume_session(chan, addr, parts):
+    """
+    Answer TOKEN@<token>: AUTH@OK@<token> and the username if it is valid,
+    otherwise AUTH@USERNAME again so the client falls back to a full login.
+    """
+    token = parts[1] if len(parts) > 1 else ""
+    username = SESSIONS.resolve(token)
+    if not username:
+        logging.info("Rejected session token from %s", addr)
+        chan.send_msg("AUTH", "USERNAME")
+        return None
+    LOGINS_OK.inc()
+    CONNECTION_TOKENS[chan.sock] = token
+    chan.send_msg("AUTH", "OK", token)
+    logging.info("Session resumed for %s from %s", username, addr)
+    record_event("server", "LOGIN_OK", 0, 0, status="OK", note=f"{username};token")
+    return username
+
+
+def logout(sock, addr):
+    """LOGOUT: the token this connection logged in with stops working everywhere."""
+    logging.info("[%s] requested LOGOUT", addr)
+    token = CONNECTION_TOKENS.pop(sock, None)
+    if token:
+        SESSIONS.revoke(token)
+
+
+def auth_error(chan, addr, e):
+    logging.error("Authentication error for %s: %s", addr, e)
     try:
-        with open("users.txt", "r") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                stored_user, stored_hash, stored_salt = line.split(":")
-                if username == stored_user:
-                    salt = bytes.fromhex(stored_salt)
-                    candidate = hashlib.sha256(
-                        password.encode() + salt
-                    ).hexdigest()
-                    return candidate == stored_hash
-    except FileNotFoundError:
-        logging.error("users.txt not found for authentication")
-    except ValueError:
-        logging.error("Malformed line in users.txt")
-    return False
+        chan.send_msg("ERR", f"Authentication error: {e}")
+    except Exception:
+        pass
+
+
+def negotiate(chan, addr, parts):
+    """
+    Answer a PROTO@<mode> request sent in place of the username.
+    Returns the channel to use from now on.
+    """
+    wanted = parts[1] if len(parts) > 1 else PROTO_TEXT
+    mode = PROTO_FRAMED if wanted == PROTO_FRAMED and ALLOW_FRAMING else PROTO_TEXT
+    chan.send_msg("PROTO", mode)
+    logging.info("[%s] using %s protocol", addr, mode.lower())
+    return open_channel(chan.sock, mode)
 
 
-def authenticate(conn: socket.socket, addr):
+def authenticate(chan, addr):
+    """Run the AUTH handshake. Returns (username or None, channel)."""
     try:
         # Ask for username
-        conn.send("AUTH@USERNAME".encode(FORMAT))
-        username = conn.recv(SIZE).decode(FORMAT).strip()
+        chan.send_msg("AUTH", "USERNAME")
+        parts = chan.recv_msg() or [""]
+        if parts[0] == "PROTO":
+            chan = negotiate(chan, addr, parts)
+            parts = chan.recv_msg() or [""]
+        if parts[0] == "TOKEN":
+            username = resume_session(chan, addr, parts)
+            if username:
+                return username, chan
+            parts = chan.recv_msg() or [""]
+        username = parts[0].strip()
 
         # Ask for password
-        conn.send("AUTH@PASSWORD".encode(FORMAT))
-        password = conn.recv(SIZE).decode(FORMAT).strip()
-
-        if check_credentials(username, password):
-            conn.send("AUTH@OK".encode(FORMAT))
-            logging.info("Authentication successful for %s from %s", username, addr)
-            record_event("server", "LOGIN_OK", 0, 0, status="OK", note=username)
-            return username
-        else:
-            conn.send("AUTH@FAIL".encode(FORMAT))
-            logging.warning("Authentication FAILED for %s from %s", username, addr)
-            record_event("server", "LOGIN_FAIL", 0, 0, status="FAIL", note=username)
-            return None
+        chan.send_msg("AUTH", "PASSWORD")
+        parts = chan.recv_msg() or [""]
+        password = parts[0].strip()
+
+        return finish_login(chan, addr, username, password), chan
 
     except Exception as e:
-        logging.error("Authentication error for %s: %s", addr, e)
-        try:
-            conn.send(f"ERR@Authentication error: {e}".encode(FORMAT))
-        except Exception:
-            pass
+        auth_error(chan, addr, e)
+        return None, chan
+
+
+def size_error(ext: str, size: int):
+    """The per-type minimum size rule a file of `size` bytes breaks, if any."""
+    if ext == ".txt" and size < 25 * 1024 * 1024:
+        return "Text file too small (min 25MB)"
+    elif ext in [".mp3", ".wav"] and size < 1 * 1024 * 1024 * 1024:
+        return "Audio file too small (min 1GB)"
+    elif ext in [".mp4", ".avi", ".mkv"] and size < 2 * 1024 * 1024 * 1024:
+        return "Video file too small (min 2GB)"
+    return None
+
+
+def confirm_overwrite(chan, addr, filename: str, filepath: str) -> bool:
+    """If the file exists, ask the client whether to overwrite it."""
+    if not os.path.exists(filepath) and not STORE.exists(filename):
+        return True
+    chan.send_msg("ERR", "File exists. Overwrite? (y/n)")
+    reply = chan.recv_msg() or [""]
+    choice = reply[0].strip().lower()
+    if choice != "y":
+        chan.send_msg("OK", "Upload cancelled.")
+        logging.info("[%s] cancelled upload of %s", addr, filename)
+        return False
+    return True
+
+
+def index_file(filename: str):
+    """Record a file that was just written to SERVER_PATH in the index (and drop the old copy's cache)."""
+    filepath = os.path.join(SERVER_PATH, filename)
+    FILE_CACHE.invalidate(filepath)
+    st = os.stat(filepath)
+    INDEX.add_file(filename, st.st_size, st.st_mtime)
+
+
+def stored_files():
+    """(name, size, mtime) of every file kept in the chunk store."""
+    for name in STORE.names():
+        manifest = STORE.stat(name)
+        yield name, manifest["size"], manifest["mtime"]
+
+
+def drop_stored(filename: str):
+    """Forget the deduplicated copy of `filename` once a plain file replaced it."""
+    if STORE.exists(filename):
+        STORE.delete(filename)
+
+
+def partial_paths(filename: str):
+    """(data path, record path) of the resumable upload for `filename`."""
+    key = quote(filename, safe="")
+    return os.path.join(PARTIAL_PATH, key), os.path.join(PARTIAL_PATH, key + ".json")
+
+
+def committed_offset(filename: str, filesize: int) -> int:
+    """
+    Bytes of `filename` already stored by an earlier, interrupted upload of
+    the same size; 0 if there is none.
+    """
+    data_path, record_path = partial_paths(filename)
+    try:
+        with open(record_path, "r") as f:
+            record = json.load(f)
+        if record.get("size") != filesize:
+            return 0
+        # The data file is preallocated, so its size says nothing about
+        # progress; records from before preallocation lack "received"
+        size = os.path.getsize(data_path)
+        return min(record.get("received", size), size, filesize)
+    except (OSError, ValueError):
+        return 0
+
+
+def transfer_codec(chan, filename: str, options: dict):
+    """
+    Compression for a transfer: the client's zip=<codec|auto>, unless the
+    file is compressed already or the connection is text mode (see
+    compression.py). Raises ValueError for a codec we don't have.
+    """
+    codec = options.get("zip")
+    if not codec or codec == "none":
+        return None
+    if codec != "auto" and codec not in compression.CODECS:
+        raise ValueError(f"Unsupported compression {codec}")
+    if chan.mode != PROTO_FRAMED:
         return None
+    return compression.choose(filename, codec)
+
+
+def parse_ranges(spec: str, filesize: int):
+    """
+    "offset:length,offset:length,..." -> [(offset, length)], clipped to the
+    file, with empty ranges dropped. Raises ValueError for a malformed range
+    or one starting past the end of the file.
+    """
+    items = spec.split(",")
+    if len(items) > MAX_RANGES:
+        raise ValueError(f"at most {MAX_RANGES} ranges")
+    ranges = []
+    for item in items:
+        offset, _, length = item.partition(":")
+        offset, length = int(offset), int(length)
+        if offset < 0 or length < 0 or offset > filesize:
+            raise ValueError(item)
+        length = min(length, filesize - offset)
+        if length:
+            ranges.append((offset, length))
+    return ranges
+
 
+def write_partial_record(record_path: str, filename: str, filesize: int, received: int, username=None):
+    with open(record_path, "w") as f:
+        json.dump({"filename": filename, "size": filesize, "received": received, "user": username}, f)
 
-def handle_upload(conn, addr, parts):
-    # parts: ["UPLOAD", filename, filesize]
+
+def handle_upload(chan, addr, parts, username=None):
+    # parts: ["UPLOAD", filename, filesize, (offset | "resume"), ("sum=<algorithm>"), ("zip=<codec>")]
+    parts, options = split_options(parts)
     if len(parts) < 3:
-        conn.send("ERR@Invalid UPLOAD command".encode(FORMAT))
+        chan.send_msg("ERR", "Invalid UPLOAD command")
         return
 
     filename = parts[1]
     try:
         filesize = int(parts[2])
     except ValueError:
-        conn.send("ERR@Invalid file size".encode(FORMAT))
+        chan.send_msg("ERR", "Invalid file size")
         return
 
     filepath = os.path.join(SERVER_PATH, filename)
     ext = os.path.splitext(filename)[1].lower()
 
-    allowed_exts = [".txt", ".mp3", ".wav", ".mp4", ".avi", ".mkv"]
-    if ext not in allowed_exts:
-        conn.send("ERR@Unsupported file type.".encode(FORMAT))
+    if ext not in ALLOWED_EXTS:
+        chan.send_msg("ERR", "Unsupported file type.")
+        return
+    # Reject on the announced size, before a single byte is sent
+    error = size_error(ext, filesize) if filesize >= 0 else "Invalid file size"
+    if error:
+        chan.send_msg("ERR", error)
+        return
+    algorithm = options.get("sum")
+    if algorithm and algorithm not in checksum.ALGORITHMS:
+        chan.send_msg("ERR", f"Unsupported checksum {algorithm}")
+        return
+    try:
+        codec = transfer_codec(chan, filename, options)
+    except ValueError as e:
+        chan.send_msg("ERR", str(e))
+        return
+
+    if not confirm_overwrite(chan, addr, filename, filepath):
         return
 
-    # If file exists, ask about overwrite
-    if os.path.exists(filepath):
-        conn.send("ERR@File exists. Overwrite? (y/n)".encode(FORMAT))
-        choice = conn.recv(SIZE).decode(FORMAT).strip().lower()
-        if choice != "y":
-            conn.send("OK@Upload cancelled.".encode(FORMAT))
-            logging.info("[%s] cancelled upload of %s", addr, filename)
+    with LOCKS.hold(f"upload:{filename}", wait=False) as held:
+        if not held:
+            chan.send_msg("ERR", f"Upload of {filename} already in progress")
             return
+        reply = receive_upload(chan, addr, parts, filename, filesize, filepath, algorithm, codec, username)
+    # Answered only once the lock is free, so a client going straight on to
+    # upload the same name again doesn't find it still held
+    send_final(chan, reply)
 
-    conn.send("OK@READY".encode(FORMAT))
 
-    received = 0
+def send_final(chan, reply):
+    """Send an upload's closing OK/ERR reply, if its client is still there."""
+    try:
+        chan.send_msg(*reply)
+    except OSError:
+        pass    # the client of an interrupted upload is usually gone
+
+
+def receive_upload(chan, addr, parts, filename, filesize, filepath, algorithm=None, codec=None, username=None):
+    """
+    Stream an upload into its partial file (preallocated to the full size)
+    and rename it into place once complete, so readers never see a
+    half-written file. An interrupted upload leaves the partial file and its
+    record behind, and a later UPLOAD@name@size@resume continues from there.
+
+    With a checksum `algorithm`, the client follows the data with
+    SUM@<algorithm>@<hex digest> of the bytes it sent; a mismatch discards
+    the upload. With a compression `codec`, the data arrives as compressed
+    blocks and is decompressed on a worker thread as it comes in.
+
+    Returns the closing reply for the caller to send.
+    """
+    committed = committed_offset(filename, filesize)
+    offset = 0
+    if len(parts) > 3:
+        if parts[3] == "resume":
+            offset = committed
+        else:
+            try:
+                offset = int(parts[3])
+            except ValueError:
+                return "ERR", "Invalid offset"
+            if offset < 0 or offset > committed:
+                return "ERR", f"Can only resume from offset {committed}"
+
+    data_path, record_path = partial_paths(filename)
+    if not os.path.exists(record_path) and not partial_slot_free(username):
+        return "ERR", f"Too many unfinished uploads (max {MAX_PARTIAL_UPLOADS}); resume one first"
+    os.makedirs(PARTIAL_PATH, exist_ok=True)
+    f = open(data_path, "r+b" if offset else "wb")
+    try:
+        preallocate(f.fileno(), filesize)
+    except OSError as e:
+        f.close()
+        os.remove(data_path)
+        return "ERR", f"Not enough space on server: {e.strerror}"
+    write_partial_record(record_path, filename, filesize, offset, username)
+
+    # Clients that didn't ask to resume get the original reply
+    reply = ["READY", str(offset)] if len(parts) > 3 else ["READY"]
+    if codec:
+        reply.append(f"zip={codec}")
+    chan.send_msg("OK", *reply)
+
+    hasher = checksum.new(algorithm) if algorithm else None
     start = time.perf_counter()
-    with open(filepath, "wb") as f:
-        while received < filesize:
-            chunk = conn.recv(min(SIZE, filesize - received))
-            if not chunk:
-                break
-            f.write(chunk)
-            received += len(chunk)
+    with f:
+        f.seek(offset)
+        sink = HashingWriter(f, hasher) if hasher else f
+        if codec:
+            sink = compression.DecompressingWriter(sink, codec, filesize - offset)
+            wire = chan.recv_file(sink, compression.wire_bound(filesize - offset))
+            try:
+                received = sink.close()
+            except compression.CompressionError as e:
+                f.close()
+                os.remove(data_path)
+                os.remove(record_path)
+                logging.warning("[%s] upload of %s: bad compressed data (%s)", addr, filename, e)
+                if hasher:
+                    chan.recv_msg()     # the SUM trailer, to stay in step
+                return "ERR", "Invalid compressed data; upload discarded"
+        else:
+            wire = received = chan.recv_file(sink, filesize - offset)
     end = time.perf_counter()
+    BYTES_IN.inc(wire)
 
-    actual_size = os.path.getsize(filepath)
-    if ext == ".txt" and actual_size < 25 * 1024 * 1024:
-        os.remove(filepath)
-        conn.send("ERR@Text file too small (min 25MB)".encode(FORMAT))
-        return
-    elif ext in [".mp3", ".wav"] and actual_size < 1 * 1024 * 1024 * 1024:
-        os.remove(filepath)
-        conn.send("ERR@Audio file too small (min 1GB)".encode(FORMAT))
-        return
-    elif ext in [".mp4", ".avi", ".mkv"] and actual_size < 2 * 1024 * 1024 * 1024:
-        os.remove(filepath)
-        conn.send("ERR@Video file too small (min 2GB)".encode(FORMAT))
-        return
+    total = offset + received
+    if total < filesize:
+        write_partial_record(record_path, filename, filesize, total, username)
+        logging.warning("[%s] upload of %s interrupted at %d of %d bytes", addr, filename, total, filesize)
+        record_transfer("server", "UPLOAD", filename, received, start, end, status="PARTIAL", note=f"offset={offset}")
+        return "ERR", f"Upload interrupted at {total} bytes; resume to continue"
+    if total != filesize:
+        # More than announced; sizes and quotas were checked against filesize
+        os.remove(data_path)
+        os.remove(record_path)
+        logging.warning("[%s] upload of %s sent %d bytes, announced %d", addr, filename, total, filesize)
+        record_transfer("server", "UPLOAD", filename, received, start, end, status="FAIL", note=f"offset={offset}")
+        if hasher:
+            chan.recv_msg()
+        return "ERR", "More data than announced; upload discarded"
+
+    note = f"resumed_from={offset}" if offset else ""
+    if hasher:
+        trailer = chan.recv_msg() or [""]
+        digest = hasher.hexdigest()
+        if trailer[0] != "SUM" or trailer[-1] != digest:
+            os.remove(data_path)
+            os.remove(record_path)
+            logging.warning("[%s] upload of %s failed its %s check", addr, filename, algorithm)
+            record_transfer("server", "UPLOAD", filename, received, start, end, status="CORRUPT", note=note)
+            return "ERR", "Checksum mismatch; upload discarded"
+        note = f"{note};sum={algorithm}" if note else f"sum={algorithm}"
+    if codec:
+        note = ";".join(n for n in (note, f"zip={codec}", f"wire={wire}") if n)
+
+    # Swapping the file in and reindexing it is one step for every worker
+    with LOCKS.hold(f"file:{filename}"):
+        os.replace(data_path, filepath)
+        os.remove(record_path)
+        drop_stored(filename)
+        index_file(filename)
+        if hasher and not offset:
+            # The digest covers the whole file, so the first download needn't hash it;
+            # keyed before the lock is released, so it can't describe a newer upload
+            DIGESTS.put(filepath, algorithm, digest, checksum.stat_key(filepath))
 
     logging.info("[%s] uploaded file %s (%d bytes)", addr, filename, received)
-    record_transfer("server", "UPLOAD", filename, received, start, end, status="OK")
-    conn.send(f"OK@Uploaded {filename}".encode(FORMAT))
+    record_transfer("server", "UPLOAD", filename, received, start, end, status="OK", note=note)
+    return "OK", f"Uploaded {filename}"
+
+
+def handle_download(chan, addr, parts):
+    """
+    DOWNLOAD@name[@offset[@length]] sends the file, or one byte range of it:
+
+        server: OK@<length>     client: READY     server: <data>
 
+    DOWNLOAD@name@ranges=<offset>:<length>,... sends several ranges, clipped
+    to the file, back to back in the order given (each one its own run of
+    DATA frames on a framed connection):
 
-def handle_download(conn, addr, parts):
+        server: OK@<total length>@ranges=<offset>:<length>,...   (as clipped)
+
+    Options: sum=<algorithm> follows the data with SUM@<algorithm>@<hex
+    digest> of everything sent; zip=<codec> compresses a single range.
+    """
+    parts, options = split_options(parts)
     if len(parts) < 2:
-        conn.send("ERR@Invalid DOWNLOAD command".encode(FORMAT))
+        chan.send_msg("ERR", "Invalid DOWNLOAD command")
         return
 
     filename = parts[1]
     filepath = os.path.join(SERVER_PATH, filename)
+    # Files uploaded with DEDUP_UPLOAD are rebuilt from the chunk store
+    stored = not os.path.exists(filepath) and STORE.exists(filename)
 
-    if not os.path.exists(filepath):
-        conn.send("ERR@File not found.".encode(FORMAT))
+    if not stored and not os.path.exists(filepath):
+        chan.send_msg("ERR", "File not found.")
         return
 
-    filesize = os.path.getsize(filepath)
+    filesize = STORE.stat(filename)["size"] if stored else os.path.getsize(filepath)
     ext = os.path.splitext(filename)[1].lower()
-    allowed_exts = [".txt", ".mp3", ".wav", ".mp4", ".avi", ".mkv"]
 
-    if ext not in allowed_exts:
-        conn.send("ERR@Unsupported file type.".encode(FORMAT))
+    if ext not in ALLOWED_EXTS:
+        chan.send_msg("ERR", "Unsupported file type.")
         return
 
-    # Send size and wait for READY
-    conn.send(f"OK@{filesize}".encode(FORMAT))
-    ack = conn.recv(SIZE).decode(FORMAT).strip()
-    if ack != "READY":
+    # Optional byte range: DOWNLOAD@name@offset[@length], or several with ranges=
+    spec = options.get("ranges")
+    try:
+        if spec is not None:
+            ranges = parse_ranges(spec, filesize)
+        else:
+            offset = int(parts[2]) if len(parts) > 2 else 0
+            length = int(parts[3]) if len(parts) > 3 else filesize - offset
+    except ValueError:
+        chan.send_msg("ERR", "Invalid byte range")
+        return
+    if spec is not None:
+        offset, length = 0, sum(n for _, n in ranges)
+    elif offset < 0 or length < 0 or offset > filesize:
+        chan.send_msg("ERR", "Invalid byte range")
+        return
+    else:
+        # Even an empty range is sent (as an empty END frame when framed)
+        length = min(length, filesize - offset)
+        ranges = [(offset, length)]
+    algorithm = options.get("sum")
+    if algorithm and algorithm not in checksum.ALGORITHMS:
+        chan.send_msg("ERR", f"Unsupported checksum {algorithm}")
         return
+    try:
+        codec = transfer_codec(chan, filename, options)
+    except ValueError as e:
+        chan.send_msg("ERR", str(e))
+        return
+    if spec is not None:
+        # Ranges go out zero-copy; they are mostly seeks into media files anyway
+        codec = None
+
+    # Send size (and the compression or ranges we agreed to) and wait for READY
+    extra = [f"zip={codec}"] if codec else []
+    if spec is not None:
+        extra.append("ranges=" + ",".join(f"{o}:{n}" for o, n in ranges))
+    chan.send_msg("OK", str(length), *extra)
+    ack = chan.recv_msg() or [""]
+    if ack[0].strip() != "READY":
+        return
+
+    # With a checksum, the data is followed by SUM@<algorithm>@<hex digest> of
+    # the bytes sent. Whole plain files use the cached digest when it's still
+    # valid (and keep sendfile); otherwise the digest is computed as they stream.
+    digest = hasher = key = None
+    cacheable = algorithm and not stored and spec is None and length == filesize
+    if cacheable:
+        key = checksum.stat_key(filepath)
+        digest = DIGESTS.get(filepath, algorithm)
+    if algorithm and digest is None:
+        hasher = checksum.new(algorithm)
 
     start = time.perf_counter()
-    with open(filepath, "rb") as f:
-        while True:
-            chunk = f.read(SIZE)
-            if not chunk:
-                break
-            conn.sendall(chunk)
+    cached = None if stored else FILE_CACHE.open(filepath)
+    with (STORE.open(filename) if stored else cached or open(filepath, "rb")) as f:
+        source = HashingReader(f, hasher) if hasher else f
+        if codec:
+            blocks = compression.BlockCompressor(source, offset, length, codec)
+            wire = chan.send_blocks(blocks)
+            sent, io_path = blocks.raw, "compressed"
+        else:
+            sent, io_path = 0, "sendfile"
+            for range_offset, range_length in ranges:
+                n, io_path = chan.send_file(source, range_offset, range_length)
+                sent += n
+                if n < range_length:
+                    break
+            wire = sent
+    end = time.perf_counter()
+    BYTES_OUT.inc(wire)
+
+    status = "OK" if sent == length else "SHORT"
+    if algorithm and sent == length:
+        if hasher:
+            digest = hasher.hexdigest()
+            if cacheable:
+                DIGESTS.put(filepath, algorithm, digest, key)
+        chan.send_msg("SUM", algorithm, digest)
+
+    notes = []
+    if spec is not None:
+        notes.append(f"ranges={len(ranges)}")
+    elif length != filesize:
+        notes.append(f"range={offset}-{offset + length}")
+    if stored:
+        notes.append("dedup")
+    if algorithm:
+        notes.append(f"sum={algorithm}")
+    if codec:
+        notes.append(f"zip={codec};wire={wire}")
+    if cached:
+        notes.append("cache=hit" if cached.hit else "cache=miss")
+    note = ";".join(notes)
+    logging.info("[%s] downloaded file %s (%d bytes, %s)", addr, filename, sent, io_path)
+    record_transfer("server", "DOWNLOAD", filename, sent, start, end, status=status, note=note, io_path=io_path)
+
+
+def handle_dedup_upload(chan, addr, parts):
+    """
+    DEDUP_UPLOAD@filename@filesize@chunk_size stores a file in the chunk store:
+
+        server: OK@READY
+        client: SHA-256 digest of every chunk (raw, 32 bytes each)
+        server: OK@NEED@<hex bitmap>     bit i set = chunk i must be sent
+        client: each needed chunk, in order
+        server: OK@Uploaded ...
+
+    Chunks already in the store are never sent again.
+    """
+    if len(parts) < 4:
+        chan.send_msg("ERR", "Invalid DEDUP_UPLOAD command")
+        return
+
+    filename = parts[1]
+    try:
+        filesize = int(parts[2])
+        chunk_size = int(parts[3])
+    except ValueError:
+        chan.send_msg("ERR", "Invalid file or chunk size")
+        return
+    if filesize < 0 or not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        chan.send_msg("ERR", "Invalid file or chunk size")
+        return
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in ALLOWED_EXTS:
+        chan.send_msg("ERR", "Unsupported file type.")
+        return
+    error = size_error(ext, filesize)
+    if error:
+        chan.send_msg("ERR", error)
+        return
+    if (filesize + chunk_size - 1) // chunk_size > MAX_DEDUP_CHUNKS:
+        chan.send_msg("ERR", f"Too many chunks (max {MAX_DEDUP_CHUNKS}); use a larger chunk size")
+        return
+    # As UPLOAD's preallocation would: a file that can't fit is refused up front
+    if filesize > shutil.disk_usage(STORE.root).free:
+        chan.send_msg("ERR", "Not enough space on server")
+        return
+
+    filepath = os.path.join(SERVER_PATH, filename)
+    if not confirm_overwrite(chan, addr, filename, filepath):
+        return
+
+    with LOCKS.hold(f"upload:{filename}", wait=False) as held:
+        if not held:
+            chan.send_msg("ERR", f"Upload of {filename} already in progress")
+            return
+        reply = receive_chunks(chan, addr, filename, filesize, chunk_size, filepath)
+    # Answered only once the lock is free, so a client going straight on to
+    # upload the same name again doesn't find it still held
+    send_final(chan, reply)
+
+
+def receive_chunks(chan, addr, filename, filesize, chunk_size, filepath):
+    count = (filesize + chunk_size - 1) // chunk_size
+    chan.send_msg("OK", "READY")
+
+    start = time.perf_counter()
+    listing = DigestListWriter()
+    if chan.recv_file(listing, count * DIGEST_SIZE) != count * DIGEST_SIZE:
+        return "ERR", "Short chunk list"
+    digests = listing.digests
+
+    # Ask for the first copy of every chunk the store doesn't have yet
+    needed = []
+    seen = set()
+    bits = bytearray((count + 7) // 8)
+    for index, digest in enumerate(digests):
+        if digest not in seen and not STORE.has(digest):
+            needed.append(index)
+            bits[index // 8] |= 1 << (index % 8)
+        seen.add(digest)
+    chan.send_msg("OK", "NEED", format(int.from_bytes(bits, "little"), "x"))
+
+    received = 0
+    for index in needed:
+        length = min(chunk_size, filesize - index * chunk_size)
+        writer = STORE.writer(digests[index])
+        got = chan.recv_file(writer, length)
+        received += got
+        BYTES_IN.inc(got)
+        if got != length:
+            writer.abort()
+            logging.warning("[%s] dedup upload of %s interrupted", addr, filename)
+            return "ERR", f"Short chunk ({got} of {length} bytes)"
+        try:
+            writer.commit()
+        except ChunkError as e:
+            return "ERR", str(e)
+
+    with LOCKS.hold(f"file:{filename}"):
+        try:
+            STORE.put(filename, filesize, chunk_size, digests)
+        except ChunkError as e:
+            return "ERR", str(e)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        FILE_CACHE.invalidate(filepath)
+        INDEX.add_file(filename, filesize)
+    end = time.perf_counter()
+
+    logging.info(
+        "[%s] uploaded file %s (%d bytes, %d of %d chunks sent)",
+        addr, filename, filesize, len(needed), count,
+    )
+    record_transfer(
+        "server", "UPLOAD", filename, received, start, end,
+        status="OK", note=f"dedup;chunks={len(needed)}/{count};size={filesize}",
+    )
+    return "OK", f"Uploaded {filename} ({len(needed)} of {count} chunks sent)"
+
+
+def parallel_paths(upload_id: str):
+    """
+    (data, record, ranges) paths of a parallel upload. The parts of one
+    upload may arrive at different worker processes, so its state lives
+    on disk: the record holds filename, size and start time, and every
+    part received appends "offset length" to the ranges file.
+    """
+    base = os.path.join(PARTS_PATH, upload_id)
+    return base, base + ".json", base + ".ranges"
+
+
+def parallel_upload(upload_id: str):
+    """The record of parallel upload `upload_id`, or None if there is no such upload."""
+    if len(upload_id) != 16 or any(c not in "0123456789abcdef" for c in upload_id):
+        return None
+    try:
+        with open(parallel_paths(upload_id)[1], "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _unfinished_uploads(directory: str) -> dict:
+    """{base path: [its files]} for the uploads under PARTIAL_PATH or PARTS_PATH."""
+    groups = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return groups
+    for name in names:
+        base = name
+        for suffix in (".json", ".ranges"):
+            if name.endswith(suffix):
+                base = name[:-len(suffix)]
+        groups.setdefault(os.path.join(directory, base), []).append(os.path.join(directory, name))
+    return groups
+
+
+def sweep_partials(max_age: float = None) -> int:
+    """
+    Remove the resumable and parallel uploads nothing has written to for
+    `max_age` seconds (PARTIAL_MAX_AGE); returns how many were removed.
+    A resumable upload in progress holds its upload lock and is skipped.
+    """
+    cutoff = time.time() - (PARTIAL_MAX_AGE if max_age is None else max_age)
+    removed = 0
+    for directory in (PARTIAL_PATH, PARTS_PATH):
+        for base, paths in _unfinished_uploads(directory).items():
+            if directory == PARTIAL_PATH:
+                lock = LOCKS.hold(f"upload:{unquote(os.path.basename(base))}", wait=False)
+            else:
+                lock = contextlib.nullcontext(True)
+            with lock as free:
+                try:
+                    if not free or max(os.path.getmtime(p) for p in paths) > cutoff:
+                        continue
+                except OSError:
+                    # Finished or removed meanwhile
+                    continue
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            removed += 1
+    if removed:
+        logging.info("Removed %d stale unfinished uploads", removed)
+    return removed
+
+
+_last_sweep = 0.0
+
+
+def sweep_partials_now_and_then():
+    """sweep_partials(), at most once per PARTIAL_SWEEP_INTERVAL."""
+    global _last_sweep
+    now = time.monotonic()
+    if now - _last_sweep >= PARTIAL_SWEEP_INTERVAL:
+        _last_sweep = now
+        sweep_partials()
+
+
+def partial_slot_free(username) -> bool:
+    """
+    True if `username` may start another unfinished upload: they hold fewer
+    than MAX_PARTIAL_UPLOADS (resumable or parallel, running or not) after
+    stale ones have been swept.
+    """
+    def count():
+        held = 0
+        for base in list(_unfinished_uploads(PARTIAL_PATH)) + list(_unfinished_uploads(PARTS_PATH)):
+            try:
+                with open(base + ".json", "r") as f:
+                    held += json.load(f).get("user") == username
+            except (OSError, ValueError):
+                pass
+        return held
+
+    if count() < MAX_PARTIAL_UPLOADS:
+        return True
+    sweep_partials()
+    return count() < MAX_PARTIAL_UPLOADS
+
+
+def handle_upload_init(chan, addr, parts, username=None):
+    """
+    UPLOAD_INIT@filename@filesize starts a parallel upload. The file is
+    preallocated under PARTS_PATH and the reply is OK@<upload id>.
+    """
+    if len(parts) < 3:
+        chan.send_msg("ERR", "Invalid UPLOAD_INIT command")
+        return
+
+    filename = parts[1]
+    try:
+        filesize = int(parts[2])
+    except ValueError:
+        chan.send_msg("ERR", "Invalid file size")
+        return
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in ALLOWED_EXTS:
+        chan.send_msg("ERR", "Unsupported file type.")
+        return
+    # The size is known up front, so reject before any data is sent
+    error = size_error(ext, filesize)
+    if error:
+        chan.send_msg("ERR", error)
+        return
+
+    if not confirm_overwrite(chan, addr, filename, os.path.join(SERVER_PATH, filename)):
+        return
+    if not partial_slot_free(username):
+        chan.send_msg("ERR", f"Too many unfinished uploads (max {MAX_PARTIAL_UPLOADS}); resume one first")
+        return
+
+    upload_id = os.urandom(8).hex()
+    os.makedirs(PARTS_PATH, exist_ok=True)
+    part_path, record_path, _ = parallel_paths(upload_id)
+    with open(part_path, "wb") as f:
+        try:
+            preallocate(f.fileno(), filesize)
+        except OSError as e:
+            f.close()
+            os.remove(part_path)
+            chan.send_msg("ERR", f"Not enough space on server: {e.strerror}")
+            return
+
+    with open(record_path, "w") as f:
+        json.dump({"filename": filename, "size": filesize, "started": time.time(), "user": username}, f)
+    logging.info("[%s] started parallel upload %s of %s (%d bytes)", addr, upload_id, filename, filesize)
+    chan.send_msg("OK", upload_id)
+
+
+def handle_upload_part(chan, addr, parts):
+    """UPLOAD_PART@upload_id@offset@length: OK@READY, the bytes, then OK@<length>."""
+    if len(parts) < 4:
+        chan.send_msg("ERR", "Invalid UPLOAD_PART command")
+        return
+
+    upload = parallel_upload(parts[1])
+    if upload is None:
+        chan.send_msg("ERR", "Unknown upload id")
+        return
+    try:
+        offset = int(parts[2])
+        length = int(parts[3])
+    except ValueError:
+        chan.send_msg("ERR", "Invalid byte range")
+        return
+    if offset < 0 or length < 0 or offset + length > upload["size"]:
+        chan.send_msg("ERR", "Invalid byte range")
+        return
+
+    chan.send_msg("OK", "READY")
+
+    # Every part writes its own region of the preallocated file with pwrite
+    part_path, _, ranges_path = parallel_paths(parts[1])
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        received = chan.recv_file(OffsetWriter(fd, offset), length)
+    finally:
+        os.close(fd)
+    BYTES_IN.inc(received)
+
+    if received != length:
+        chan.send_msg("ERR", f"Short part ({received} of {length} bytes)")
+        return
+    # One O_APPEND write per part, so parts finishing together don't interleave
+    fd = os.open(ranges_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, f"{offset} {length}\n".encode())
+    finally:
+        os.close(fd)
+    chan.send_msg("OK", str(received))
+
+
+def handle_upload_commit(chan, addr, parts):
+    """UPLOAD_COMMIT@upload_id: once every byte has arrived, rename into place."""
+    if len(parts) < 2:
+        chan.send_msg("ERR", "Invalid UPLOAD_COMMIT command")
+        return
+
+    upload_id = parts[1]
+    upload = parallel_upload(upload_id)
+    if upload is None:
+        chan.send_msg("ERR", "Unknown upload id")
+        return
+
+    part_path, record_path, ranges_path = parallel_paths(upload_id)
+    try:
+        with open(ranges_path, "r") as f:
+            ranges = [tuple(map(int, line.split())) for line in f if line.endswith("\n")]
+    except FileNotFoundError:
+        ranges = []
+    covered = 0
+    for offset, length in sorted(ranges):
+        if offset > covered:
+            break
+        covered = max(covered, offset + length)
+    if covered < upload["size"]:
+        chan.send_msg("ERR", f"Upload incomplete ({covered} of {upload['size']} bytes)")
+        return
+
+    filename = upload["filename"]
+    with LOCKS.hold(f"file:{filename}"):
+        try:
+            os.replace(part_path, os.path.join(SERVER_PATH, filename))
+        except FileNotFoundError:
+            # Committed by a concurrent UPLOAD_COMMIT
+            chan.send_msg("ERR", "Unknown upload id")
+            return
+        for path in (record_path, ranges_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        drop_stored(filename)
+        index_file(filename)
     end = time.perf_counter()
 
-    logging.info("[%s] downloaded file %s (%d bytes)", addr, filename, filesize)
-    record_transfer("server", "DOWNLOAD", filename, filesize, start, end, status="OK")
+    logging.info("[%s] uploaded file %s (%d bytes, parallel)", addr, filename, upload["size"])
+    # The start time was taken as epoch seconds, possibly by another worker
+    record_transfer(
+        "server", "UPLOAD", filename, upload["size"], end - (time.time() - upload["started"]), end,
+        status="OK", note=f"parts={len(ranges)}",
+    )
+    chan.send_msg("OK", f"Uploaded {filename}")
+
+
+def handle_command(chan, addr, parts, username=None) -> bool:
+    """
+    Run one command ([cmd, *args]) from an authenticated client.
+    Returns False once the client asked to LOGOUT.
+    """
+    name = parts[0] if parts[0] in COMMANDS else "OTHER"
+    transfer = parts[0] in TRANSFER_COMMANDS
+    if transfer and not start_transfer(username):
+        metrics.counter("rejections_total", "Requests turned away as busy", reason="user_transfers").inc()
+        chan.send_msg("ERR", "BUSY", str(RETRY_AFTER))
+        return True
+
+    # Streams of one multiplexed connection share its per-connection limit
+    throttle = THROTTLE.start(username, getattr(chan, "mux", chan)) if transfer else None
+    COMMANDS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    try:
+        return dispatch_command(ThrottledChannel(chan, throttle) if throttle else chan, addr, parts, username)
+    finally:
+        if throttle:
+            THROTTLE.finish(throttle)
+            THROTTLE_WAIT.inc(round(throttle.waited, 3))
+        if transfer:
+            end_transfer(username)
+        metrics.histogram("command_seconds", "Command latency", command=name).observe(time.perf_counter() - start)
+        COMMANDS_IN_FLIGHT.dec()
+
+
+# DIR@key=value options -> DirectoryIndex.page() arguments
+DIR_OPTIONS = {"path": "folder", "recursive": "recursive", "offset": "offset", "limit": "limit",
+               "type": "kind", "ext": "ext", "match": "match"}
+
+
+def fit_entries(entries: list, budget: int, encode) -> list:
+    """The leading entries (at least one) whose encode(entry) sizes add up to at most `budget`."""
+    used = 0
+    for i, entry in enumerate(entries):
+        used += len(encode(entry)) + 1
+        if used > budget and i:
+            return entries[:i]
+    return entries
+
+
+def _page_json(value) -> str:
+    return json.dumps(value, separators=(",", ":"))
+
+
+def handle_dir(chan, addr, parts):
+    """
+    Plain DIR lists the names in the top folder, newline-joined, as it
+    always has (one page of them at most). DIR@key=value@... returns a page
+    of entries as JSON:
+
+        path=<folder>  recursive=1  offset=N  limit=N  type=file|folder
+        ext=.txt  match=<glob on the name>  zip=<codec|auto>
+
+        -> OK@{"total": N, "offset": N, "next": N or null,
+               "entries": [{"name", "path", "size", "mtime", "type", "folder"}]}
+
+    With zip, a page of MIN_MESSAGE_SIZE or more comes back compressed as
+    OK@<codec>@<base64> (see compression.pack_text) when that is shorter.
+    In text mode a page holds fewer entries if they wouldn't fit in
+    DIR_TEXT_BYTES; "next" says where to continue either way.
+    """
+    text_mode = chan.mode == PROTO_TEXT
+    # Pick up changes made through other worker processes
+    INDEX.refresh()
+    sweep_partials_now_and_then()
+    if len(parts) == 1:
+        entries, total = INDEX.page(limit=DIR_MAX_PAGE)
+        if not entries:
+            chan.send_msg("OK", "Directory is empty.")
+            return
+        if text_mode:
+            entries = fit_entries(entries, DIR_TEXT_BYTES, lambda e: e["name"].encode(FORMAT))
+        lines = [e["name"] for e in entries]
+        if total > len(entries):
+            lines.append(f"... {total - len(entries)} more (DIR@offset={len(entries)})")
+        chan.send_msg("OK", "\n".join(lines))
+        return
+
+    options = {"limit": DIR_PAGE_SIZE}
+    codec = None
+    for part in parts[1:]:
+        key, _, value = part.partition("=")
+        if key == "zip":
+            codec = compression.choose("", value)
+            if codec and codec not in compression.CODECS:
+                chan.send_msg("ERR", f"Unsupported compression {codec}")
+                return
+            continue
+        if key not in DIR_OPTIONS:
+            chan.send_msg("ERR", f"Unknown DIR option '{key}'")
+            return
+        options[DIR_OPTIONS[key]] = value
+    try:
+        offset = options["offset"] = max(int(options.get("offset", 0)), 0)
+        options["limit"] = min(max(int(options["limit"]), 1), DIR_MAX_PAGE)
+    except ValueError:
+        chan.send_msg("ERR", "Invalid offset or limit")
+        return
+    options["recursive"] = options.get("recursive", "0") not in ("0", "", "false")
+
+    try:
+        entries, total = INDEX.page(**options)
+    except KeyError:
+        chan.send_msg("ERR", "Folder not found")
+        return
+    if text_mode:
+        entries = fit_entries(entries, DIR_TEXT_BYTES, _page_json)
+    end = offset + len(entries)
+    page = _page_json({"total": total, "offset": offset, "next": end if end < total else None, "entries": entries})
+    if codec and len(page) >= compression.MIN_MESSAGE_SIZE:
+        packed = compression.pack_text(page, codec)
+        if len(packed) < len(page):
+            chan.send_msg("OK", codec, packed)
+            return
+    chan.send_msg("OK", page)
+
+
+def dispatch_command(chan, addr, parts, username=None) -> bool:
+    cmd = parts[0]
+
+    if cmd == "LOGOUT":
+        logout(chan.sock, addr)
+        return False
+
+    elif cmd == "UPLOAD":
+        handle_upload(chan, addr, parts, username)
+
+    elif cmd == "DOWNLOAD":
+        handle_download(chan, addr, parts)
+
+    elif cmd == "RESUME":
+        # RESUME@filename@filesize -> OK@<bytes already stored>
+        if len(parts) < 3 or not parts[2].isdigit():
+            chan.send_msg("ERR", "Usage: RESUME@<filename>@<filesize>")
+            return True
+        sweep_partials_now_and_then()
+        chan.send_msg("OK", str(committed_offset(parts[1], int(parts[2]))))
+
+    elif cmd == "DEDUP_UPLOAD":
+        handle_dedup_upload(chan, addr, parts)
+
+    elif cmd == "UPLOAD_INIT":
+        handle_upload_init(chan, addr, parts, username)
+
+    elif cmd == "UPLOAD_PART":
+        handle_upload_part(chan, addr, parts)
+
+    elif cmd == "UPLOAD_COMMIT":
+        handle_upload_commit(chan, addr, parts)
+
+    elif cmd == "DELETE":
+        if len(parts) < 2:
+            chan.send_msg("ERR", "Missing filename for DELETE")
+            return True
+        filename = parts[1]
+        filepath = os.path.join(SERVER_PATH, filename)
+        with LOCKS.hold(f"file:{filename}"):
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            elif STORE.exists(filename):
+                STORE.delete(filename)
+            else:
+                chan.send_msg("ERR", "File not found.")
+                return True
+            FILE_CACHE.invalidate(filepath)
+            INDEX.remove(filename)
+        logging.info("[%s] deleted file %s", addr, filename)
+        chan.send_msg("OK", f"Deleted {filename}")
+
+    elif cmd == "DIR":
+        handle_dir(chan, addr, parts)
+
+    elif cmd == "STATS":
+        # Live counters, gauges and per-command latency percentiles as JSON
+        chan.send_msg("OK", json.dumps(server_stats()))
+
+    elif cmd == "SUBFOLDER":
+        if len(parts) < 3:
+            chan.send_msg("ERR", "Usage: SUBFOLDER@<create|delete>@<name>")
+            return True
+        action = parts[1].lower()
+        folder_name = parts[2]
+        folder_path = os.path.join(SERVER_PATH, folder_name)
+
+        try:
+            if action == "create":
+                os.makedirs(folder_path, exist_ok=True)
+                INDEX.add_folder(folder_name, os.path.getmtime(folder_path))
+                chan.send_msg("OK", f"Subfolder '{folder_name}' created")
+            elif action == "delete":
+                if os.path.isdir(folder_path) and not os.listdir(folder_path):
+                    os.rmdir(folder_path)
+                    FILE_CACHE.invalidate(folder_path)
+                    INDEX.remove(folder_name)
+                    chan.send_msg("OK", f"Subfolder '{folder_name}' deleted")
+                else:
+                    chan.send_msg("ERR", "Subfolder not empty or not found")
+            else:
+                chan.send_msg("ERR", "Invalid SUBFOLDER action")
+        except Exception as e:
+            chan.send_msg("ERR", f"Subfolder error: {e}")
+
+    else:
+        chan.send_msg("ERR", "Unknown command")
+
+    return True
+
+
+def server_stats() -> dict:
+    """The metrics snapshot for STATS; with worker processes, merged over all of them."""
+    snapshot = metrics.REGISTRY.snapshot()
+    if WORKER is None:
+        return snapshot
+    # The other workers' snapshots are up to workers.PUBLISH_INTERVAL old
+    merged = metrics.merge_snapshots([snapshot] + workers.collect(WORKERS_PATH, skip=WORKER))
+    merged["workers"] = PROCESSES
+    return merged
+
+
+def command_error(chan, addr, e):
+    logging.error("Error while handling client %s: %s", addr, e)
+    try:
+        chan.send_msg("ERR", str(e))
+    except Exception:
+        pass
+
+
+def run_request(stream, addr, parts, username):
+    try:
+        handle_command(stream, addr, parts, username)
+    except Exception as e:
+        command_error(stream, addr, e)
+    finally:
+        stream.release()
+
+
+def open_multiplexer(chan, addr, username) -> Multiplexer:
+    """
+    Framed sessions are multiplexed: every request runs on REQUEST_POOL with
+    its own stream, so a client can pipeline commands and interleave transfers.
+    """
+    def on_request(stream, parts):
+        if parts[0] == "LOGOUT":
+            logout(chan.sock, addr)
+            stream.release()
+            return False
+        REQUEST_POOL.submit(run_request, stream, addr, parts, username)
+
+    return Multiplexer(chan, on_request)
 
 
 def handle_client(conn: socket.socket, addr):
     logging.info("Client connected from %s", addr)
-    username = authenticate(conn, addr)
+    username, chan = authenticate(TextChannel(conn), addr)
     if not username:
         logging.info("Closing connection for unauthenticated client %s", addr)
         conn.close()
         return
 
     # After successful login, send welcome message
-    conn.send(f"OK@Welcome {username}".encode(FORMAT))
+    chan.send_msg("OK", f"Welcome {username}")
+
+    if chan.mode == PROTO_FRAMED:
+        mux = open_multiplexer(chan, addr, username)
+        try:
+            while mux.read_frame():
+                pass
+        except Exception as e:
+            logging.error("Error while handling client %s: %s", addr, e)
+        finally:
+            logging.info("Client disconnected %s", addr)
+            mux.shutdown()
+        return
 
     try:
         while True:
-            data = conn.recv(SIZE).decode(FORMAT)
-            if not data:
+            parts = chan.recv_msg()
+            if not parts:
+                break
+            if not handle_command(chan, addr, parts, username):
                 break
 
-            parts = data.strip().split("@")
-            cmd = parts[0]
+    except Exception as e:
+        command_error(chan, addr, e)
+    finally:
+        logging.info("Client disconnected %s", addr)
+        conn.close()
 
-            if cmd == "LOGOUT":
-                logging.info("[%s] requested LOGOUT", addr)
-                break
 
-            elif cmd == "UPLOAD":
-                handle_upload(conn, addr, parts)
+# A queued connection is taken by a handler or turned away by expire_waiting, once
+WAITING_LOCK = threading.Lock()
 
-            elif cmd == "DOWNLOAD":
-                handle_download(conn, addr, parts)
 
-            elif cmd == "DELETE":
-                if len(parts) < 2:
-                    conn.send("ERR@Missing filename for DELETE".encode(FORMAT))
-                    continue
-                filename = parts[1]
-                filepath = os.path.join(SERVER_PATH, filename)
-                if not os.path.exists(filepath):
-                    conn.send("ERR@File not found.".encode(FORMAT))
+def claim(entry: dict) -> bool:
+    with WAITING_LOCK:
+        if entry["claimed"]:
+            return False
+        entry["claimed"] = True
+    QUEUE_DEPTH.dec()
+    return True
+
+
+def connection_worker(backlog: queue.Queue):
+    while True:
+        entry = backlog.get()
+        if not claim(entry):
+            continue
+        conn, addr = entry["conn"], entry["addr"]
+        try:
+            handle_client(conn, addr)
+        except Exception as e:
+            logging.error("Error while handling client %s: %s", addr, e)
+            conn.close()
+
+
+def serve_threaded(server: socket.socket):
+    """
+    HANDLERS threads each serve one connection at a time; accepted
+    connections wait in a queue of at most BACKLOG for a free handler, and
+    for at most QUEUE_WAIT seconds.
+    """
+    backlog = queue.Queue()
+    for _ in range(HANDLERS):
+        threading.Thread(target=connection_worker, args=(backlog,), daemon=True).start()
+    waiting = queue.Queue()
+    if QUEUE_WAIT > 0:
+        threading.Thread(target=expire_waiting, args=(waiting,), daemon=True).start()
+
+    while True:
+        conn, addr = server.accept()
+        track_connection(conn)
+        if not admit(conn, addr):
+            continue
+        entry = {"conn": conn, "addr": addr, "claimed": False, "deadline": time.monotonic() + QUEUE_WAIT}
+        QUEUE_DEPTH.inc()
+        backlog.put(entry)
+        if QUEUE_WAIT > 0:
+            waiting.put(entry)
+
+
+def expire_waiting(waiting: queue.Queue):
+    """
+    Turn away connections still queued QUEUE_WAIT seconds after they arrived,
+    e.g. while every handler is held by an idle interactive session. Entries
+    arrive in deadline order, so one sleeping thread covers all of them.
+    """
+    while True:
+        entry = waiting.get()
+        if entry["claimed"]:
+            continue
+        delay = entry["deadline"] - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if claim(entry):
+            reject(entry["conn"], entry["addr"], "wait")
+
+
+def serve_event_loop(server: socket.socket):
+    """
+    Single selector loop over every connection. Idle clients only cost a
+    registered socket; when one becomes readable it is unregistered and the
+    next step (login prompt or one command, including its file I/O) runs on
+    a bounded pool. The worker hands the socket back to the loop afterwards.
+    """
+    sel = selectors.DefaultSelector()
+    pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="handler")
+    rearm = queue.SimpleQueue()
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False)
+
+    def hand_back(conn, state):
+        rearm.put((conn, state))
+        try:
+            wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def disconnect(chan, addr):
+        logging.info("Client disconnected %s", addr)
+        chan.close()
+
+    def submit(conn, state):
+        QUEUE_DEPTH.inc()
+        pool.submit(step, conn, state)
+
+    def step(conn, state):
+        QUEUE_DEPTH.dec()
+        addr = state["addr"]
+        chan = state["chan"]
+        try:
+            # A framed channel may already hold the next frame in its buffer,
+            # which the selector can't see, so keep going until it is drained
+            while True:
+                if "mux" in state:
+                    if not state["mux"].read_frame():
+                        logging.info("Client disconnected %s", addr)
+                        state["mux"].shutdown()
+                        return
+                    if not chan.buffered():
+                        break
                     continue
-                os.remove(filepath)
-                logging.info("[%s] deleted file %s", addr, filename)
-                conn.send(f"OK@Deleted {filename}".encode(FORMAT))
 
-            elif cmd == "DIR":
+                parts = chan.recv_msg()
+                if not parts:
+                    disconnect(chan, addr)
+                    return
+
+                if state["stage"] == "username":
+                    if parts[0] == "PROTO":
+                        chan = state["chan"] = negotiate(chan, addr, parts)
+                    elif parts[0] == "TOKEN":
+                        username = resume_session(chan, addr, parts)
+                        if username:
+                            logged_in(chan, state, username)
+                    else:
+                        state["username"] = parts[0].strip()
+                        state["stage"] = "password"
+                        chan.send_msg("AUTH", "PASSWORD")
+
+                elif state["stage"] == "password":
+                    # Hashing is slow on purpose; free this worker while the
+                    # auth pool checks it, and carry on in login_checked
+                    state["stage"] = "verifying"
+                    future = CREDENTIALS.submit(state["username"], parts[0].strip())
+                    future.add_done_callback(lambda f: login_checked(conn, state, f))
+                    return
+
+                elif not handle_command(chan, addr, parts, state["username"]):
+                    disconnect(chan, addr)
+                    return
+
+                if not chan.buffered():
+                    break
+
+        except Exception as e:
+            if "mux" in state:
+                logging.error("Error while handling client %s: %s", addr, e)
+                logging.info("Client disconnected %s", addr)
+                state["mux"].shutdown()
+            elif state["stage"] == "ready":
+                command_error(chan, addr, e)
+                disconnect(chan, addr)
+            else:
+                auth_error(chan, addr, e)
+                chan.close()
+            return
+
+        hand_back(conn, state)
+
+    def logged_in(chan, state, username):
+        state["stage"] = "ready"
+        state["username"] = username
+        chan.send_msg("OK", f"Welcome {username}")
+        if chan.mode == PROTO_FRAMED:
+            state["mux"] = open_multiplexer(chan, state["addr"], username)
+
+    def login_checked(conn, state, future):
+        addr = state["addr"]
+        chan = state["chan"]
+        try:
+            username = report_login(chan, addr, state["username"], future.result())
+            if not username:
+                logging.info("Closing connection for unauthenticated client %s", addr)
+                chan.close()
+                return
+            logged_in(chan, state, username)
+        except Exception as e:
+            auth_error(chan, addr, e)
+            chan.close()
+            return
+        if chan.buffered():
+            submit(conn, state)
+        else:
+            hand_back(conn, state)
+
+    server.setblocking(False)
+    sel.register(server, selectors.EVENT_READ)
+    sel.register(wake_r, selectors.EVENT_READ)
+
+    while True:
+        for key, _ in sel.select():
+            sock = key.fileobj
+            if sock is server:
+                try:
+                    conn, addr = server.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(True)
+                track_connection(conn)
+                if not admit(conn, addr):
+                    continue
+                logging.info("Client connected from %s", addr)
+                chan = TextChannel(conn)
                 try:
-                    items = os.listdir(SERVER_PATH)
-                    listing = "\n".join(items) if items else "Directory is empty."
-                    conn.send(f"OK@{listing}".encode(FORMAT))
-                except Exception as e:
-                    conn.send(f"ERR@Directory error: {e}".encode(FORMAT))
-
-            elif cmd == "SUBFOLDER":
-                if len(parts) < 3:
-                    conn.send("ERR@Usage: SUBFOLDER@<create|delete>@<name>".encode(FORMAT))
+                    chan.send_msg("AUTH", "USERNAME")
+                except OSError as e:
+                    auth_error(chan, addr, e)
+                    conn.close()
                     continue
-                action = parts[1].lower()
-                folder_name = parts[2]
-                folder_path = os.path.join(SERVER_PATH, folder_name)
+                state = {"addr": addr, "stage": "username", "chan": chan}
+                sel.register(conn, selectors.EVENT_READ, state)
 
+            elif sock is wake_r:
                 try:
-                    if action == "create":
-                        os.makedirs(folder_path, exist_ok=True)
-                        conn.send(f"OK@Subfolder '{folder_name}' created".encode(FORMAT))
-                    elif action == "delete":
-                        if os.path.isdir(folder_path) and not os.listdir(folder_path):
-                            os.rmdir(folder_path)
-                            conn.send(f"OK@Subfolder '{folder_name}' deleted".encode(FORMAT))
-                        else:
-                            conn.send("ERR@Subfolder not empty or not found".encode(FORMAT))
-                    else:
-                        conn.send("ERR@Invalid SUBFOLDER action".encode(FORMAT))
-                except Exception as e:
-                    conn.send(f"ERR@Subfolder error: {e}".encode(FORMAT))
+                    while wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
 
             else:
-                conn.send("ERR@Unknown command".encode(FORMAT))
+                sel.unregister(sock)
+                submit(sock, key.data)
 
-    except Exception as e:
-        logging.error("Error while handling client %s: %s", addr, e)
-        try:
-            conn.send(f"ERR@{e}".encode(FORMAT))
-        except Exception:
-            pass
+        while not rearm.empty():
+            conn, state = rearm.get()
+            if conn.fileno() != -1:
+                sel.register(conn, selectors.EVENT_READ, state)
+
+
+def serve(server: socket.socket):
+    if ENGINE == "eventloop":
+        serve_event_loop(server)
+    else:
+        serve_threaded(server)
+
+
+def start_worker(index: int, server: socket.socket = None):
+    """
+    Body of worker process `index`: per-worker settings, then serve() on
+    the socket inherited from the parent or, with SO_REUSEPORT, its own.
+    """
+    global WORKER, THROTTLE
+    WORKER = index
+    analytics_worker(index)
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(f"%(asctime)s - %(levelname)s - [worker {index}] %(message)s"))
+    # The server-wide rate is split between the workers; per-user and
+    # per-connection limits (and USER_TRANSFERS) apply in each worker
+    THROTTLE = Limiter(RATE_LIMIT / PROCESSES, USER_RATE_LIMIT, CONNECTION_RATE_LIMIT)
+    if server is None:
+        server = workers.listen(ADDR, tune_socket, reuseport=True)
+    workers.publish(WORKERS_PATH, index, metrics.REGISTRY.snapshot)
+    logging.info("Worker %d (pid %d) serving", index, os.getpid())
+    if METRICS_PORT:
+        metrics.serve_http(METRICS_PORT + index)
+        logging.info("Metrics at http://localhost:%s/metrics", METRICS_PORT + index)
+    try:
+        serve(server)
     finally:
-        logging.info("Client disconnected %s", addr)
-        conn.close()
+        analytics_flush()
+
+
+def serve_processes():
+    """
+    Run PROCESSES workers (workers.py). The index, sessions and chunk store
+    are shared before forking; nothing here may start a thread, since a
+    forked child only keeps the thread that forked it.
+    """
+    shutil.rmtree(WORKERS_PATH, ignore_errors=True)
+    os.makedirs(WORKERS_PATH)
+    INDEX.share(os.path.join(WORKERS_PATH, "index.journal"))
+    SESSIONS.share(os.path.join(WORKERS_PATH, "sessions"))
+    STORE.share()
+    # Without SO_REUSEPORT the workers accept from one socket bound here
+    server = None if workers.REUSEPORT else workers.listen(ADDR, tune_socket)
+    mode = "SO_REUSEPORT" if workers.REUSEPORT else "shared socket"
+    print(f"[SERVER] Listening on {IP}:{PORT} ({ENGINE} engine, {PROCESSES} processes, {mode})")
+    logging.info("Server listening on %s:%s (%s engine, %d processes, %s)", IP, PORT, ENGINE, PROCESSES, mode)
+    workers.run(PROCESSES, lambda index: start_worker(index, server))
 
 
 def main():
     os.makedirs(SERVER_PATH, exist_ok=True)
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(ADDR)
-    server.listen()
-    print(f"[SERVER] Listening on {IP}:{PORT}")
-    logging.info("Server listening on %s:%s", IP, PORT)
-
-    while True:
-        conn, addr = server.accept()
-        thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-        thread.start()
+    INDEX.build(SERVER_PATH, stored_files())
+    sweep_partials()
+    if PROCESSES > 1:
+        serve_processes()
+        return
+    server = workers.listen(ADDR, tune_socket)
+    print(f"[SERVER] Listening on {IP}:{PORT} ({ENGINE} engine)")
+    logging.info("Server listening on %s:%s (%s engine)", IP, PORT, ENGINE)
+    if METRICS_PORT:
+        metrics.serve_http(METRICS_PORT)
+        logging.info("Metrics at http://localhost:%s/metrics", METRICS_PORT)
+    serve(server)
 
 
 if __name__ == "__main__":
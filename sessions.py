@@ -0,0 +1,116 @@
+# sessions.py
+"""
+Server-issued session tokens, so a client that already logged in can skip
+the username/password round trips on its next connection.
+
+A token is "<session id>.<expiry>.<signature>", all hex or decimal, where
+the signature is HMAC-SHA256 over the id and expiry. Forged or expired
+tokens are rejected before the in-memory session table is consulted; the
+table maps the id to its user, and revoke() (on LOGOUT) drops the id so the
+token stops working before it expires.
+
+Server processes forked from one parent share its SECRET; with share() they
+also keep every session as a small file in one directory, so a token issued
+by one process is accepted by all of them. The file is then what decides:
+once it is removed the token is rejected by every process.
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+# Tokens don't survive a restart unless the secret is pinned
+SECRET = bytes.fromhex(os.environ["SESSION_SECRET"]) if "SESSION_SECRET" in os.environ else os.urandom(32)
+# Seconds a token stays valid after it was issued
+TTL = int(os.environ.get("SESSION_TTL", 3600))
+# Shared session files are swept for expired ones at most this often
+PURGE_INTERVAL = 60
+
+
+def _sign(session_id: str, expires: int) -> str:
+    return hmac.new(SECRET, f"{session_id}.{expires}".encode(), hashlib.sha256).hexdigest()
+
+
+def _is_session_id(session_id: str) -> bool:
+    # Also keeps a token from naming any path outside the session directory
+    return len(session_id) == 32 and all(c in "0123456789abcdef" for c in session_id)
+
+
+class SessionTable:
+    def __init__(self, ttl: int = TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}         # session id -> (username, expires)
+        self.directory = None
+        self._purged = 0.0
+
+    def share(self, directory: str):
+        """Keep sessions as files in `directory` too, for the other processes using it."""
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def issue(self, username: str) -> str:
+        session_id = os.urandom(16).hex()
+        expires = int(time.time()) + self.ttl
+        with self._lock:
+            self._purge()
+            self._sessions[session_id] = (username, expires)
+        if self.directory:
+            with open(os.path.join(self.directory, session_id), "w") as f:
+                f.write(f"{username}\n{expires}\n")
+        return f"{session_id}.{expires}.{_sign(session_id, expires)}"
+
+    def revoke(self, token: str):
+        """End the session behind `token`, in every process sharing the directory."""
+        session_id = token.split(".")[0]
+        if not _is_session_id(session_id):
+            return
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        if self.directory:
+            try:
+                os.remove(os.path.join(self.directory, session_id))
+            except FileNotFoundError:
+                pass
+
+    def resolve(self, token: str):
+        """Username the token was issued to, or None if it's invalid or expired."""
+        try:
+            session_id, expires, signature = token.split(".")
+            expires = int(expires)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(_sign(session_id, expires), signature):
+            return None
+        if expires < time.time():
+            return None
+        if not _is_session_id(session_id):
+            return None
+        if self.directory:
+            # Another process may have revoked it, so the file wins over memory
+            try:
+                with open(os.path.join(self.directory, session_id)) as f:
+                    return f.readline().strip() or None
+            except OSError:
+                return None
+        with self._lock:
+            entry = self._sessions.get(session_id)
+        return entry[0] if entry else None
+
+    def _purge(self):
+        now = time.time()
+        for session_id in [s for s, (_, expires) in self._sessions.items() if expires < now]:
+            del self._sessions[session_id]
+        if not self.directory or now - self._purged < PURGE_INTERVAL:
+            return
+        self._purged = now
+        for session_id in os.listdir(self.directory):
+            path = os.path.join(self.directory, session_id)
+            try:
+                with open(path) as f:
+                    expired = int(f.read().split()[1]) < now
+                if expired:
+                    os.remove(path)
+            except (OSError, ValueError, IndexError):
+                pass
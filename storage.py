@@ -0,0 +1,249 @@
+# storage.py
+"""
+Content-addressed, deduplicating file store.
+
+A file is cut into fixed-size chunks; each chunk is stored once under its
+SHA-256 digest and a per-name manifest lists the digests in order:
+
+    <root>/objects/ab/abcdef...        chunk data
+    <root>/manifests/<quoted name>     {"name", "size", "chunk_size", "chunks"}
+
+Reference counts are rebuilt from the manifests at start-up and a chunk is
+removed once no manifest uses it. A store shared by several server
+processes (share()) recounts them from disk under a lock instead.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import threading
+from urllib.parse import quote, unquote
+
+from filelocks import FileLocks
+
+CHUNK_SIZE = 4 * 1024 * 1024
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+class ChunkError(Exception):
+    pass
+
+
+class ChunkWriter:
+    """
+    File-like sink for one incoming chunk. Bytes are hashed as they are
+    written; commit() checks the digest and moves the chunk into the store.
+    """
+
+    def __init__(self, store, digest: str):
+        self.store = store
+        self.digest = digest
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._tmp_path = store.object_path(digest) + f".tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(os.path.dirname(self._tmp_path), exist_ok=True)
+        self._file = open(self._tmp_path, "wb")
+
+    def write(self, data) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def commit(self):
+        self._file.close()
+        if self._hash.hexdigest() != self.digest:
+            os.remove(self._tmp_path)
+            raise ChunkError(f"chunk {self.digest[:12]} failed verification")
+        os.replace(self._tmp_path, self.store.object_path(self.digest))
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class DigestListWriter:
+    """
+    File-like sink for a raw list of chunk digests, kept as hex strings as
+    the bytes arrive so the whole list is never buffered twice.
+    """
+
+    def __init__(self):
+        self.digests = []
+        self._rest = b""
+
+    def write(self, data) -> int:
+        size = len(data)
+        data = self._rest + bytes(data)
+        whole = len(data) - len(data) % DIGEST_SIZE
+        self.digests.extend(data[i:i + DIGEST_SIZE].hex() for i in range(0, whole, DIGEST_SIZE))
+        self._rest = data[whole:]
+        return size
+
+
+class ManifestReader:
+    """Read-only, seekable file object over the chunks of a stored file."""
+
+    def __init__(self, store, manifest: dict):
+        self.store = store
+        self.size = manifest["size"]
+        self.chunk_size = manifest["chunk_size"]
+        self.chunks = manifest["chunks"]
+        self._pos = 0
+        # The chunk being read stays open until a read moves past it
+        self._index = None
+        self._file = None
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, n: int = -1) -> bytes:
+        if n < 0:
+            n = self.size - self._pos
+        n = min(n, self.size - self._pos)
+        out = []
+        while n > 0:
+            index, within = divmod(self._pos, self.chunk_size)
+            f = self._chunk(index)
+            f.seek(within)
+            data = f.read(min(n, self.chunk_size - within))
+            if not data:
+                break
+            out.append(data)
+            self._pos += len(data)
+            n -= len(data)
+        return b"".join(out)
+
+    def _chunk(self, index: int):
+        if index != self._index:
+            self.close()
+            self._file = open(self.store.object_path(self.chunks[index]), "rb")
+            self._index = index
+        return self._file
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file, self._index = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ChunkStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.objects_path = os.path.join(root, "objects")
+        self.manifests_path = os.path.join(root, "manifests")
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.manifests_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._locks = None
+        self._count_refs()
+
+    def _count_refs(self):
+        self._refs = {}
+        for name in self.names():
+            for digest in self._load(name)["chunks"]:
+                self._refs[digest] = self._refs.get(digest, 0) + 1
+
+    def share(self):
+        """
+        Let several processes use the store. Each one's reference counts
+        would miss the others' manifests, so put() and delete() then hold a
+        lock shared with them and recount from disk first.
+        """
+        self._locks = FileLocks(os.path.join(self.root, ".locks"))
+
+    @contextlib.contextmanager
+    def _updating(self):
+        with self._lock:
+            if self._locks is None:
+                yield
+                return
+            with self._locks.hold("manifests"):
+                self._count_refs()
+                yield
+
+    # ----- chunks -----
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_path, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.object_path(digest))
+
+    def writer(self, digest: str) -> ChunkWriter:
+        return ChunkWriter(self, digest)
+
+    # ----- manifests -----
+
+    def _manifest_path(self, name: str) -> str:
+        return os.path.join(self.manifests_path, quote(name, safe=""))
+
+    def _load(self, name: str) -> dict:
+        with open(self._manifest_path(name), "r") as f:
+            return json.load(f)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._manifest_path(name))
+
+    def names(self):
+        return sorted(unquote(n) for n in os.listdir(self.manifests_path) if not n.startswith("."))
+
+    def stat(self, name: str) -> dict:
+        """The manifest of `name` (size, chunk_size, chunks) plus its mtime."""
+        manifest = self._load(name)
+        manifest["mtime"] = os.path.getmtime(self._manifest_path(name))
+        return manifest
+
+    def open(self, name: str) -> ManifestReader:
+        return ManifestReader(self, self._load(name))
+
+    def put(self, name: str, size: int, chunk_size: int, chunks):
+        """Record `name` as the given chunks, replacing any earlier version."""
+        with self._updating():
+            missing = [d for d in set(chunks) if not self.has(d)]
+            if missing:
+                # A chunk reported as present was collected in the meantime
+                raise ChunkError(f"{len(missing)} chunk(s) no longer stored, retry the upload")
+            old = self._load(name)["chunks"] if self.exists(name) else []
+            manifest = {"name": name, "size": size, "chunk_size": chunk_size, "chunks": list(chunks)}
+            tmp_path = os.path.join(self.manifests_path, "." + quote(name, safe="") + ".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self._manifest_path(name))
+            for digest in chunks:
+                self._refs[digest] = self._refs.get(digest, 0) + 1
+            self._release(old)
+
+    def delete(self, name: str):
+        with self._updating():
+            chunks = self._load(name)["chunks"]
+            os.remove(self._manifest_path(name))
+            self._release(chunks)
+
+    def _release(self, chunks):
+        for digest in chunks:
+            count = self._refs.get(digest, 0) - 1
+            if count > 0:
+                self._refs[digest] = count
+                continue
+            self._refs.pop(digest, None)
+            try:
+                os.remove(self.object_path(digest))
+            except OSError:
+                pass
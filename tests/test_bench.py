@@ -0,0 +1,34 @@
+# test_bench.py
+"""
+The bench_suite scenarios as tests: each runs briefly through loadgen
+against a throwaway loopback server and must finish without errors. The
+numbers are attached to the test report (record_property) for comparison
+across runs; bench_suite.py compares them against a saved baseline.
+
+    python -m pytest tests/test_bench.py
+"""
+import pytest
+
+from bench_suite import SCENARIOS
+from loadgen import local_server, run_load
+
+# Seconds per scenario; long enough for a few 25 MB transfers on loopback
+DURATION = 2.0
+
+
+@pytest.fixture(scope="module", params=["threaded", "eventloop"])
+def server(request):
+    with local_server(request.param) as (port, credentials):
+        yield port, credentials
+
+
+@pytest.mark.parametrize("scenario", sorted(SCENARIOS))
+def test_scenario(server, scenario, record_property):
+    port, credentials = server
+    summary = run_load("localhost", port, credentials, duration=DURATION, seed=0, **SCENARIOS[scenario])
+
+    for key in ("ops_per_sec", "MBps"):
+        record_property(key, summary[key])
+    assert summary["user_errors"] == []
+    assert summary["errors"] == 0, summary["per_op"]
+    assert summary["ops"] > 0
@@ -0,0 +1,198 @@
+# throttle.py
+"""
+Bandwidth limits for file transfers: token buckets at three levels
+(whole server, per user, per connection) with fair sharing.
+
+A limit at any level is shared by the transfers currently under it: with
+N of them active, each gets its own bucket refilling at rate / N, so a
+transfer that started first can't take more than its share. Shares are
+rebalanced whenever a transfer starts or finishes. A transfer waits for
+tokens from every level that applies to it.
+
+On framed channels and multiplexed streams, tokens are taken once per
+DATA frame through the channel's pace hook: before the frame is sent
+(outside the send lock), or before a received frame is written (on the
+request's own thread, not the connection's reader). In text mode, where
+a connection carries one request at a time, the file object the channel
+reads from or writes to is wrapped instead, and a throttled download goes
+through the buffered send loop rather than sendfile.
+"""
+import threading
+import time
+
+from protocol import PROTO_FRAMED
+
+# Bytes a bucket may hold when idle, in seconds of its rate
+BURST_SECONDS = 0.25
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate * BURST_SECONDS
+        self._last = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.rate * BURST_SECONDS, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+    def reserve(self, n: int) -> float:
+        """Take n tokens (going into debt if need be); returns seconds to wait."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class SharedLimit:
+    """A rate split evenly between the transfers currently using it."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._buckets = set()
+
+    def join(self) -> TokenBucket:
+        bucket = TokenBucket(self.rate)
+        with self._lock:
+            self._buckets.add(bucket)
+            self._rebalance()
+        return bucket
+
+    def leave(self, bucket: TokenBucket) -> bool:
+        """Returns True once nobody is using the limit any more."""
+        with self._lock:
+            self._buckets.discard(bucket)
+            self._rebalance()
+            return not self._buckets
+
+    def _rebalance(self):
+        for bucket in self._buckets:
+            bucket.set_rate(self.rate / len(self._buckets))
+
+
+class Throttle:
+    """The buckets one transfer draws from; consume() blocks until allowed."""
+
+    def __init__(self, members):
+        self.members = members      # [(table, key, SharedLimit, TokenBucket)]
+        self.buckets = [bucket for *_, bucket in members]
+        self.waited = 0.0
+
+    def consume(self, n: int):
+        delay = max(bucket.reserve(n) for bucket in self.buckets)
+        if delay > 0:
+            self.waited += delay
+            time.sleep(delay)
+
+
+class Limiter:
+    """
+    Global, per-user and per-connection limits in bytes per second;
+    0 leaves that level unlimited.
+    """
+
+    def __init__(self, global_rate: float = 0, user_rate: float = 0, connection_rate: float = 0):
+        self.user_rate = user_rate
+        self.connection_rate = connection_rate
+        self._global = SharedLimit(global_rate) if global_rate else None
+        self._lock = threading.Lock()
+        self._users = {}            # username -> SharedLimit
+        self._connections = {}      # connection object -> SharedLimit
+
+    def _limit(self, table, key, rate):
+        with self._lock:
+            limit = table.get(key)
+            if limit is None:
+                limit = table[key] = SharedLimit(rate)
+            return limit
+
+    def start(self, username, connection):
+        """Join every limit that applies; returns a Throttle, or None if unlimited."""
+        members = []
+        if self._global:
+            members.append((None, None, self._global))
+        if self.user_rate:
+            members.append((self._users, username, self._limit(self._users, username, self.user_rate)))
+        if self.connection_rate:
+            members.append((self._connections, connection,
+                            self._limit(self._connections, connection, self.connection_rate)))
+        if not members:
+            return None
+        return Throttle([(table, key, limit, limit.join()) for table, key, limit in members])
+
+    def finish(self, throttle: Throttle):
+        for table, key, limit, bucket in throttle.members:
+            if limit.leave(bucket) and table is not None:
+                with self._lock:
+                    if table.get(key) is limit:
+                        del table[key]
+
+
+class ThrottledReader:
+    """Read side of a throttled download; no fileno(), so sendfile isn't used."""
+
+    def __init__(self, f, throttle: Throttle):
+        self.f = f
+        self.throttle = throttle
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.f.read(n)
+        self.throttle.consume(len(data))
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.f.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.f.tell()
+
+
+class ThrottledWriter:
+    """Write side of a throttled upload; waiting here backs the sender off via TCP."""
+
+    def __init__(self, f, throttle: Throttle):
+        self.f = f
+        self.throttle = throttle
+
+    def write(self, data) -> int:
+        n = self.f.write(data)
+        self.throttle.consume(len(data))
+        return n
+
+
+class ThrottledChannel:
+    """A channel (or stream) whose send_file / recv_file go through a Throttle."""
+
+    def __init__(self, chan, throttle: Throttle):
+        self.chan = chan
+        self.throttle = throttle
+
+    def send_file(self, f, offset: int = 0, count: int = None):
+        if self.chan.mode == PROTO_FRAMED:
+            return self.chan.send_file(f, offset, count, pace=self.throttle.consume)
+        return self.chan.send_file(ThrottledReader(f, self.throttle), offset, count)
+
+    def recv_file(self, f, count: int) -> int:
+        if self.chan.mode == PROTO_FRAMED:
+            return self.chan.recv_file(f, count, pace=self.throttle.consume)
+        return self.chan.recv_file(ThrottledWriter(f, self.throttle), count)
+
+    def send_blocks(self, blocks) -> int:
+        if self.chan.mode == PROTO_FRAMED:
+            return self.chan.send_blocks(blocks, pace=self.throttle.consume)
+
+        def throttled():
+            for block in blocks:
+                self.throttle.consume(len(block))
+                yield block
+        return self.chan.send_blocks(throttled())
+
+    def __getattr__(self, name):
+        return getattr(self.chan, name)
@@ -0,0 +1,198 @@
+# transfer.py
+"""
+Socket <-> file streaming helpers shared by the server and the client.
+"""
+import errno
+import io
+import os
+import selectors
+import socket
+import threading
+
+SIZE = 64 * 1024
+
+# Receive buffer reused across chunks (and transfers) by each thread
+RECV_BUFFER_SIZE = int(os.environ.get("TRANSFER_BUFFER", 1024 * 1024))
+# SO_RCVBUF / SO_SNDBUF in bytes; 0 keeps the kernel's (auto-tuned) default
+SOCKET_BUFFER = int(os.environ.get("TRANSFER_SOCKBUF", 0))
+
+# Zero-copy sends can be switched off to compare against the buffered loop
+USE_SENDFILE = os.environ.get("TRANSFER_SENDFILE", "1") != "0"
+SENDFILE_CHUNK = 8 * 1024 * 1024
+
+# errno values meaning "sendfile can't be used here", as opposed to a broken connection
+_SENDFILE_UNSUPPORTED = {
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTSOCK,
+    errno.EBADF,
+}
+
+# errno values meaning "the filesystem can't preallocate", as opposed to a full disk
+_FALLOCATE_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP}
+
+
+def _send_buffered(conn, f, offset: int, count: int) -> int:
+    f.seek(offset)
+    sent = 0
+    while sent < count:
+        chunk = f.read(min(SIZE, count - sent))
+        if not chunk:
+            break
+        conn.sendall(chunk)
+        sent += len(chunk)
+    return sent
+
+
+def send_file(conn, f, offset: int = 0, count: int = None):
+    """
+    Send `count` bytes of the open file `f`, starting at `offset`, to `conn`.
+
+    Uses os.sendfile so the kernel copies straight from the page cache to the
+    socket; falls back to the read/sendall loop when the platform, the file
+    object or the socket can't do that. A socket with a timeout is
+    non-blocking underneath, so then each sendfile call first waits (up to
+    the timeout) for the socket to be writable, as socket.sendfile does.
+
+    Returns (bytes_sent, path) where path is "sendfile" or "buffered".
+    """
+    if count is None:
+        f.seek(0, os.SEEK_END)
+        count = f.tell() - offset
+
+    sent = 0
+    if USE_SENDFILE and hasattr(os, "sendfile"):
+        selector = None
+        try:
+            file_fd = f.fileno()
+            sock_fd = conn.fileno()
+            timeout = conn.gettimeout()
+            if timeout is not None:
+                selector = selectors.DefaultSelector()
+                selector.register(sock_fd, selectors.EVENT_WRITE)
+            while sent < count:
+                if selector and not selector.select(timeout):
+                    raise socket.timeout("timed out")
+                try:
+                    n = os.sendfile(sock_fd, file_fd, offset + sent, min(SENDFILE_CHUNK, count - sent))
+                except BlockingIOError:
+                    if selector is None:
+                        raise
+                    continue
+                if n == 0:
+                    # File is shorter than announced
+                    return sent, "sendfile"
+                sent += n
+            return sent, "sendfile"
+        except (AttributeError, io.UnsupportedOperation):
+            pass
+        except OSError as e:
+            if e.errno not in _SENDFILE_UNSUPPORTED:
+                raise
+        finally:
+            if selector:
+                selector.close()
+
+    sent += _send_buffered(conn, f, offset + sent, count - sent)
+    return sent, "buffered"
+
+
+_local = threading.local()
+
+
+def recv_buffer() -> memoryview:
+    """The calling thread's preallocated receive buffer."""
+    view = getattr(_local, "view", None)
+    if view is None or len(view) != RECV_BUFFER_SIZE:
+        view = memoryview(bytearray(RECV_BUFFER_SIZE))
+        _local.view = view
+    return view
+
+
+def recv_to_file(conn, f, count: int, buf: memoryview = None) -> int:
+    """
+    Receive `count` bytes from `conn` and write them to `f`.
+
+    Data lands in one preallocated buffer via recv_into and is written from a
+    memoryview slice, so no bytes object is allocated per chunk.
+    Returns the number of bytes received (less than count if the peer closed).
+    """
+    view = buf if buf is not None else recv_buffer()
+    size = len(view)
+    received = 0
+    while received < count:
+        n = conn.recv_into(view, min(size, count - received))
+        if not n:
+            break
+        f.write(view[:n])
+        received += n
+    return received
+
+
+def preallocate(fd: int, size: int):
+    """
+    Reserve `size` bytes for the file behind `fd` before writing it, so a
+    full disk is reported up front and the blocks can be laid out in one
+    piece. Falls back to extending the file where fallocate isn't supported.
+    """
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in _FALLOCATE_UNSUPPORTED:
+                raise
+    if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+
+
+def tune_socket(sock, rcvbuf: int = None, sndbuf: int = None):
+    """Apply SO_RCVBUF / SO_SNDBUF (defaults to TRANSFER_SOCKBUF when set)."""
+    rcvbuf = SOCKET_BUFFER if rcvbuf is None else rcvbuf
+    sndbuf = SOCKET_BUFFER if sndbuf is None else sndbuf
+    try:
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    except OSError:
+        pass
+
+
+class SinkWriter:
+    """
+    File-like writer that hands each piece written to sink(offset, data),
+    counting offsets up from `offset`. `data` may be a view of a reused
+    receive buffer, so a sink that keeps it must copy it.
+    """
+
+    def __init__(self, sink, offset: int):
+        self.sink = sink
+        self.offset = offset
+
+    def write(self, data) -> int:
+        self.sink(self.offset, data)
+        self.offset += len(data)
+        return len(data)
+
+
+class OffsetWriter:
+    """
+    File-like writer that pwrite()s to `fd` starting at `offset`, so several
+    connections can fill different ranges of one file at the same time.
+    """
+
+    def __init__(self, fd: int, offset: int):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.pwrite(self.fd, view[written:], self.offset + written)
+        self.offset += written
+        return written
@@ -1,5 +1,7 @@
-import hashlib
 import os
+import sys
+
+from credentials import hash_password, migrate_line
 
 users = {
     "naibys": "admin123",
@@ -7,14 +9,37 @@ users = {
     "diego": "admin123"
 }
 
-with open("users.txt", "w") as f:
-    for username, password in users.items():
-        salt = os.urandom(16)
 
-        hashed_pw = hashlib.sha256(password.encode() + salt).hexdigest()
+def create_users(path="users.txt"):
+    with open(path, "w") as f:
+        for username, password in users.items():
+            f.write(hash_password(username, password) + "\n")
+
+    print(f"{path} created successfully with users:")
+    for username in users.keys():
+        print("-", username)
+
+
+def migrate_users(path="users.txt"):
+    """Rewrite original sha256 entries in PBKDF2 form; passwords are unchanged."""
+    with open(path, "r") as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    migrated = [migrate_line(line) for line in lines]
+    changed = sum(1 for old, new in zip(lines, migrated) if old != new)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for line in migrated:
+            f.write(line + "\n")
+    os.replace(tmp_path, path)
+    print(f"{path}: migrated {changed} of {len(lines)} users")
 
-        f.write(f"{username}:{hashed_pw}:{salt.hex()}\n")
 
-print("users.txt created successfully with users:")
-for username in users.keys():
-    print("-", username)
\ No newline at end of file
+if __name__ == "__main__":
+    # python users.py            create users.txt from the table above
+    # python users.py --migrate  upgrade an existing users.txt in place
+    if "--migrate" in sys.argv[1:]:
+        migrate_users()
+    else:
+        create_users()
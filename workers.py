@@ -0,0 +1,139 @@
+# workers.py
+"""
+Pre-fork multi-process serving, so one server can use more than one core.
+
+The parent builds the shared state (see the share() methods of the index,
+session table and chunk store), then forks N workers and only supervises
+them: a worker that dies is restarted, and SIGTERM / SIGINT are passed on.
+With SO_REUSEPORT every worker binds the address itself and the kernel
+spreads new connections across their listening sockets; without it the
+parent binds one socket before forking and the workers accept from it
+together.
+
+Each worker publishes its metrics snapshot to a directory once a second,
+so any of them can answer STATS for the whole server (collect()). The
+publishing thread also stops a worker whose parent has gone away.
+"""
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+# SO_REUSEPORT where the platform has it, unless SERVER_REUSEPORT=0
+REUSEPORT = hasattr(socket, "SO_REUSEPORT") and os.environ.get("SERVER_REUSEPORT", "1") != "0"
+# Seconds between metrics snapshots written by each worker
+PUBLISH_INTERVAL = 1.0
+# Seconds to wait before restarting a worker that died
+RESPAWN_DELAY = 1.0
+
+
+def listen(addr, tune=None, reuseport: bool = False) -> socket.socket:
+    """A listening TCP socket on `addr`; `tune(sock)` runs before bind()."""
+    # Options set before listen() are inherited by accepted sockets, and the
+    # TCP window scale is negotiated from them
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if tune:
+        tune(server)
+    server.bind(addr)
+    server.listen()
+    return server
+
+
+def run(count: int, serve):
+    """
+    Fork `count` workers, each running serve(index), and keep them running
+    until SIGTERM or SIGINT; returns once they have all exited.
+    """
+    children = {}                   # pid -> worker index
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid:
+            children[pid] = index
+            return
+        code = 0
+        try:
+            # Ctrl-C reaches the whole process group; the parent stops workers itself
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            serve(index)
+        except SystemExit:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(count):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logging.warning("Worker %d (pid %d) exited with status %d; restarting", index, pid, status)
+        time.sleep(RESPAWN_DELAY)
+        if not stopping:
+            spawn(index)
+
+
+def publish(directory: str, index: int, snapshot):
+    """Start the thread writing snapshot() to <directory>/<index>.json."""
+    parent = os.getppid()
+    path = os.path.join(directory, f"{index}.json")
+
+    def loop():
+        while True:
+            if os.getppid() != parent:
+                # Orphaned: the parent was killed without stopping us
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(snapshot(), f)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.warning("Could not publish worker metrics: %s", e)
+            time.sleep(PUBLISH_INTERVAL)
+
+    threading.Thread(target=loop, name="publish", daemon=True).start()
+
+
+def collect(directory: str, skip: int = None) -> list:
+    """The latest snapshot published by every worker except `skip`."""
+    snapshots = []
+    for name in os.listdir(directory):
+        if not name.endswith(".json") or name == f"{skip}.json":
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return snapshots